@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+aneurysm pipeline的合成影像benchmark
+
+不需要病人資料也不需要GPU: 先合成一個類似TOF-MRA的volume(彎曲的管狀血管加上幾顆球狀aneurysm)，
+輸出成nnUNet資料夾的格式(MRA_BRAIN/Pred/Prob/Vessel/Vessel_16的nii.gz跟一組MRA_BRAIN dicom)，
+再用CPU依序計時pipeline後半段的stage:
+    standin_inference(隨機初始化的小型3D conv，模擬sliding window) -> reslice_nifti_pred_nobrain
+    -> create_MIP_pred -> AneurysmPipeline.run_all -> execute_dicomseg_platform_json
+另外用合成的腦部遮罩計時modify_brain_mask的各種morphology method，記錄跟原本ball結果的Dice。
+結果存成json(每個stage的wall/cpu時間、peak RSS)，給--baseline比對，變慢超過門檻就回傳exit code 1。
+
+使用:
+    python benchmark_aneurysm.py --work_dir /tmp/aneurysm_bench --shape 256 256 120 --repeat 3 --out result.json
+    python benchmark_aneurysm.py --work_dir /tmp/aneurysm_bench --baseline result.json
+
+@author: chuan
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import pathlib
+import platform
+import argparse
+import resource
+import datetime
+
+import numpy as np
+import nibabel as nib
+import pydicom
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+from scipy import ndimage
+
+CASE_ID = '00000000_20250101_MR_00000000000'  #pipeline用ID前8碼當PatientID、9~17碼當StudyDate
+GROUP_ID = 56
+
+
+#--- 合成影像 ---
+def _tube_centerline(rng, shape, spacing, length_mm, step_mm=0.5):
+    #隨機方向、曲率慢慢改變的中心線，回傳voxel座標(float)
+    shape = np.array(shape, dtype=np.float64)
+    spacing = np.array(spacing, dtype=np.float64)
+    point = rng.uniform(0.2, 0.8, 3) * shape * spacing  #mm
+    direction = rng.normal(size=3)
+    direction /= np.linalg.norm(direction)
+    points = []
+    for _ in range(int(length_mm / step_mm)):
+        direction += rng.normal(scale=0.08, size=3)
+        direction /= np.linalg.norm(direction)
+        point = point + direction * step_mm
+        voxel = point / spacing
+        if np.any(voxel < 0) or np.any(voxel > shape - 1):
+            break
+        points.append(voxel)
+    return np.array(points).reshape(-1, 3)
+
+
+def synthesize_volume(shape=(256, 256, 120), spacing=(0.4, 0.4, 0.8), n_vessels=24, n_aneurysms=3, seed=0):
+    """
+    回傳dicom方向(rows, cols, slices)的陣列:
+        image int16, vessel uint8, vessel16 uint8(1~16), pred int16(1~n_aneurysms), prob float32
+    """
+    rng = np.random.default_rng(seed)
+    spacing = np.array(spacing, dtype=np.float64)
+
+    #血管依半徑分3組，每組一次EDT(以mm計)
+    radius_bins = [0.6, 1.1, 1.8]
+    vessel = np.zeros(shape, dtype=bool)
+    centerlines = []
+    for radius in radius_bins:
+        skeleton = np.ones(shape, dtype=bool)
+        for _ in range(n_vessels // len(radius_bins)):
+            line = _tube_centerline(rng, shape, spacing, length_mm=rng.uniform(30, 90))
+            if len(line) == 0:
+                continue
+            idx = np.round(line).astype(int)
+            skeleton[idx[:, 0], idx[:, 1], idx[:, 2]] = False
+            centerlines.append((radius, line))
+        vessel |= ndimage.distance_transform_edt(skeleton, sampling=spacing) <= radius
+
+    #aneurysm: 在較粗的血管旁邊放球
+    pred = np.zeros(shape, dtype=np.int16)
+    prob = np.zeros(shape, dtype=np.float32)
+    thick = [item for item in centerlines if item[0] >= radius_bins[1]] or centerlines
+    grid = np.indices(shape, dtype=np.float32)
+    for label in range(1, n_aneurysms + 1):
+        radius, line = thick[rng.integers(len(thick))]
+        base = line[rng.integers(len(line))] * spacing
+        offset = rng.normal(size=3)
+        offset /= np.linalg.norm(offset)
+        blob_radius = rng.uniform(1.5, 4.0)
+        center = (base + offset * (radius + blob_radius * 0.6)) / spacing
+        lo = np.maximum(np.floor(center - blob_radius / spacing) - 1, 0).astype(int)
+        hi = np.minimum(np.ceil(center + blob_radius / spacing) + 2, shape).astype(int)
+        box = tuple(slice(a, b) for a, b in zip(lo, hi))
+        dist = np.sqrt(sum(((grid[i][box] - center[i]) * spacing[i]) ** 2 for i in range(3)))
+        inside = dist <= blob_radius
+        pred[box][inside] = label
+        prob[box][inside] = np.maximum(prob[box][inside], 0.6 + 0.35 * (1 - dist[inside] / blob_radius))
+    del grid
+    vessel |= pred > 0
+
+    #16個血管分區: 左右4等分 x 前後4等分
+    vessel16 = np.zeros(shape, dtype=np.uint8)
+    zone = (np.arange(shape[0])[:, None] * 4 // shape[0]) * 4 + (np.arange(shape[1])[None, :] * 4 // shape[1]) + 1
+    vessel16[vessel] = np.broadcast_to(zone[:, :, None], shape)[vessel]
+
+    #影像: 頭部橢球內的組織雜訊 + 部分容積效應的血管亮訊號
+    center = (np.array(shape) - 1) / 2
+    axes = np.array(shape) * 0.47
+    yy, xx, zz = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    head = ((yy - center[0]) / axes[0]) ** 2 + ((xx - center[1]) / axes[1]) ** 2 + ((zz - center[2]) / axes[2]) ** 2 <= 1
+    image = rng.normal(150, 25, size=shape).astype(np.float32) * head
+    image += ndimage.gaussian_filter(vessel.astype(np.float32), 0.7) * rng.uniform(450, 650)
+    image = np.clip(image, 0, 4095).astype(np.int16)
+    return image, vessel.astype(np.uint8), vessel16, pred, prob
+
+
+#--- 輸出nifti跟dicom ---
+def dicom_affine(rows, spacing, position):
+    #跟dcm2niix一樣: axial(IOP=[1,0,0,0,1,0])、列方向上下翻轉，LPS轉RAS
+    dy, dx, dz = spacing
+    affine = np.eye(4)
+    affine[:3, 0] = [-dx, 0, 0]
+    affine[:3, 1] = [0, dy, 0]
+    affine[:3, 2] = [0, 0, dz]
+    origin_lps = np.array(position, dtype=np.float64) + np.array([0, (rows - 1) * dy, 0])
+    affine[:3, 3] = origin_lps * np.array([-1, -1, 1])
+    return affine
+
+
+def save_case_nifti(arrays, spacing, position, path_dir):
+    #arrays: {檔名: (rows, cols, slices)陣列}，轉成dcm2niix的nifti排列
+    rows = next(iter(arrays.values())).shape[0]
+    affine = dicom_affine(rows, spacing, position)
+    for name, array in arrays.items():
+        data = np.ascontiguousarray(np.transpose(array[::-1], (1, 0, 2)))
+        nii = nib.Nifti1Image(data, affine)
+        nii.set_qform(affine, code=1)
+        nii.set_sform(affine, code=1)
+        nib.save(nii, os.path.join(path_dir, name))
+
+
+def save_case_dicom(image, spacing, position, path_dir, case_id=CASE_ID):
+    rows, cols, n_slices = image.shape
+    study_uid, series_uid, frame_uid = generate_uid(), generate_uid(), generate_uid()
+    study_date = case_id[9:17]
+    for k in range(n_slices):
+        sop_uid = generate_uid()
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = MRImageStorage
+        file_meta.MediaStorageSOPInstanceUID = sop_uid
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        path_file = os.path.join(path_dir, f'MR.{k + 1:04d}.dcm')
+        ds = FileDataset(path_file, {}, file_meta=file_meta, preamble=b'\0' * 128)
+        ds.SOPClassUID = MRImageStorage
+        ds.SOPInstanceUID = sop_uid
+        ds.StudyInstanceUID = study_uid
+        ds.SeriesInstanceUID = series_uid
+        ds.FrameOfReferenceUID = frame_uid
+        ds.Modality = 'MR'
+        ds.ImageType = ['ORIGINAL', 'PRIMARY', 'M', 'ND']
+        ds.PatientName = 'SYNTHETIC^BENCHMARK'
+        ds.PatientID = case_id[:8]
+        ds.PatientSex = 'F'
+        ds.PatientAge = '060Y'
+        ds.PatientBirthDate = ''
+        ds.StudyDate = study_date
+        ds.SeriesDate = study_date
+        ds.StudyTime = '120000'
+        ds.AccessionNumber = case_id.split('_')[3]
+        ds.StudyID = '1'
+        ds.StudyDescription = 'MRA BRAIN SYNTHETIC'
+        ds.SeriesDescription = 'MRA_BRAIN'
+        ds.SeriesNumber = 1
+        ds.InstanceNumber = k + 1
+        ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        ds.ImagePositionPatient = [float(position[0]), float(position[1]), float(position[2] + k * spacing[2])]
+        ds.SliceLocation = float(position[2] + k * spacing[2])
+        ds.PixelSpacing = [float(spacing[0]), float(spacing[1])]
+        ds.SliceThickness = float(spacing[2])
+        ds.SpacingBetweenSlices = float(spacing[2])
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.Rows = rows
+        ds.Columns = cols
+        ds.BitsAllocated = 16
+        ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 1
+        ds.WindowCenter = 300
+        ds.WindowWidth = 600
+        ds.RescaleIntercept = 0
+        ds.RescaleSlope = 1
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.PixelData = np.ascontiguousarray(image[:, :, k]).tobytes()
+        ds.save_as(path_file)
+
+
+def build_case(path_case, shape, spacing, n_vessels, n_aneurysms, seed):
+    """
+    建立跟pipeline_aneurysm的nnUNet資料夾相同的結構:
+        MRA_BRAIN/Pred/Prob/Vessel/Vessel_16.nii.gz、Image_nii/、Image_reslice/、excel/、JSON/、Dicom/MRA_BRAIN/
+    """
+    image, vessel, vessel16, pred, prob = synthesize_volume(shape, spacing, n_vessels, n_aneurysms, seed)
+    position = [-shape[1] * spacing[1] / 2, -shape[0] * spacing[0] / 2, -shape[2] * spacing[2] / 2]
+    path_nii = os.path.join(path_case, 'Image_nii')
+    path_dcm = os.path.join(path_case, 'Dicom', 'MRA_BRAIN')
+    for path_dir in [path_nii, path_dcm, os.path.join(path_case, 'Image_reslice'), os.path.join(path_case, 'excel'),
+                     os.path.join(path_case, 'JSON'), os.path.join(path_case, 'Dicom', 'Dicom-Seg')]:
+        os.makedirs(path_dir, exist_ok=True)
+
+    arrays = {'MRA_BRAIN.nii.gz': image, 'Pred.nii.gz': pred, 'Prob.nii.gz': prob,
+              'Vessel.nii.gz': vessel, 'Vessel_16.nii.gz': vessel16}
+    save_case_nifti(arrays, spacing, position, path_case)
+    for name in ['MRA_BRAIN.nii.gz', 'Pred.nii.gz', 'Vessel.nii.gz']:
+        shutil.copy(os.path.join(path_case, name), os.path.join(path_nii, name))
+    save_case_dicom(image, spacing, position, path_dcm)
+    return {'aneurysms': int(pred.max()), 'vessel_voxels': int(vessel.sum())}
+
+
+#--- stand-in model ---
+def standin_inference(path_case, patch_size=64, seed=0):
+    #隨機初始化的小型3D conv網路，用跟nnU-Net相同的sliding window(step 0.5)走過整個volume，只量時間不用結果
+    import torch
+    torch.manual_seed(seed)
+    net = torch.nn.Sequential(torch.nn.Conv3d(2, 8, 3, padding=1), torch.nn.LeakyReLU(),
+                              torch.nn.Conv3d(8, 8, 3, padding=1), torch.nn.LeakyReLU(),
+                              torch.nn.Conv3d(8, 2, 1)).eval()
+    image = np.asanyarray(nib.load(os.path.join(path_case, 'MRA_BRAIN.nii.gz')).dataobj).astype(np.float32)
+    vessel = np.asanyarray(nib.load(os.path.join(path_case, 'Vessel.nii.gz')).dataobj).astype(np.float32)
+    image = (image - image.mean()) / (image.std() + 1e-6)
+    x = torch.from_numpy(np.stack([image, vessel]))[None]
+    logits = torch.zeros((2,) + image.shape)
+    step = patch_size // 2
+    starts = [sorted(set(list(range(0, max(s - patch_size, 0) + 1, step)) + [max(s - patch_size, 0)])) for s in image.shape]
+    with torch.no_grad():
+        for i in starts[0]:
+            for j in starts[1]:
+                for k in starts[2]:
+                    sl = (slice(i, i + patch_size), slice(j, j + patch_size), slice(k, k + patch_size))
+                    logits[(slice(None),) + sl] += net(x[(slice(None), slice(None)) + sl])[0]
+    return {'tiles': len(starts[0]) * len(starts[1]) * len(starts[2])}
+
+
+def synthesize_brain_mask(shape=(256, 256, 120), spacing=(0.4, 0.4, 0.8), seed=0):
+    #表面不平整的橢球，裡面挖幾個洞、外面放一小塊分開的，模擬get_brain_seg|BET的結果
+    rng = np.random.default_rng(seed)
+    center = (np.array(shape) - 1) / 2
+    axes = np.array(shape) * 0.38
+    yy, xx, zz = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    dist = ((yy - center[0]) / axes[0]) ** 2 + ((xx - center[1]) / axes[1]) ** 2 + ((zz - center[2]) / axes[2]) ** 2
+    bumps = ndimage.gaussian_filter(rng.normal(size=shape).astype(np.float32), sigma=6)
+    mask = dist + bumps / (bumps.std() + 1e-6) * 0.08 <= 1
+    for _ in range(4):
+        hole = rng.uniform(0.3, 0.7, size=3) * np.array(shape)
+        radius = rng.uniform(2.0, 5.0) / np.array(spacing)
+        mask &= ((yy - hole[0]) / radius[0]) ** 2 + ((xx - hole[1]) / radius[1]) ** 2 + ((zz - hole[2]) / radius[2]) ** 2 > 1
+    blob = np.array([shape[0] * 0.08, shape[1] * 0.5, shape[2] * 0.5])
+    radius = 3.0 / np.array(spacing)
+    mask |= ((yy - blob[0]) / radius[0]) ** 2 + ((xx - blob[1]) / radius[1]) ** 2 + ((zz - blob[2]) / radius[2]) ** 2 <= 1
+    return mask
+
+
+#--- 計時 ---
+def _peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024 if sys.platform != 'darwin' else usage / 1024 ** 2
+
+
+def time_stage(name, func):
+    wall, cpu = time.perf_counter(), time.process_time()
+    info = func()
+    record = {'stage': name, 'wall_sec': time.perf_counter() - wall, 'cpu_sec': time.process_time() - cpu,
+              'peak_rss_mb': _peak_rss_mb()}
+    if isinstance(info, dict):
+        record['info'] = info
+    print(f"[Done {name}... ] spend {record['wall_sec']:.2f} sec")
+    return record
+
+
+def run_stages(path_case, path_png, use_ctx=False, skip_inference=False):
+    from util_aneurysm import reslice_nifti_pred_nobrain, create_MIP_pred, AneurysmPipeline
+    from code_ai.pipeline.dicomseg.aneurysm import execute_dicomseg_platform_json
+    from case_context import CaseContext
+
+    ctx = CaseContext(CASE_ID, path_case) if use_ctx else None
+    path_dcm = os.path.join(path_case, 'Dicom')
+    path_nii = os.path.join(path_case, 'Image_nii')
+    path_reslice = os.path.join(path_case, 'Image_reslice')
+    path_excel = os.path.join(path_case, 'excel')
+
+    records = []
+    if not skip_inference:
+        try:
+            records.append(time_stage('standin_inference', lambda: standin_inference(path_case)))
+        except ImportError:
+            print('torch不存在，略過standin_inference')
+    records.append(time_stage('reslice_nifti_pred_nobrain', lambda: reslice_nifti_pred_nobrain(path_nii, path_reslice, ctx=ctx)))
+    records.append(time_stage('create_MIP_pred', lambda: create_MIP_pred(path_dcm, path_reslice, path_png, -1, ctx=ctx)))
+    records.append(time_stage('AneurysmPipeline.run_all',
+                              lambda: AneurysmPipeline(path_dcm, path_case, path_excel, CASE_ID, ctx=ctx).run_all()))
+    records.append(time_stage('execute_dicomseg_platform_json',
+                              lambda: execute_dicomseg_platform_json(CASE_ID, pathlib.Path(path_case), GROUP_ID)))
+    return records
+
+
+def morphology_stages(brain_mask, spacing, methods):
+    #每個method計時一次modify_brain_mask，跟ball(原本的做法)比Dice
+    from brain_morphology import modify_brain_mask, dice
+
+    records, results = [], {}
+    for method in ['ball'] + [y for y in methods if y != 'ball']:
+        def stage(method=method):
+            results[method] = modify_brain_mask(brain_mask, spacing, method=method)
+            if method != 'ball' and 'ball' in results:
+                return {'dice_vs_ball': float(dice(results[method], results['ball'])),
+                        'diff_voxels': int(np.count_nonzero(results[method] != results['ball']))}
+        records.append(time_stage(f'modify_brain_mask[{method}]', stage))
+    return records
+
+
+def summarize(runs):
+    #每個stage取中位數跟最小值
+    stages = {}
+    for records in runs:
+        for record in records:
+            stages.setdefault(record['stage'], []).append(record)
+    summary = {}
+    for name, records in stages.items():
+        walls = [r['wall_sec'] for r in records]
+        summary[name] = {'wall_median': float(np.median(walls)), 'wall_min': float(np.min(walls)),
+                         'cpu_median': float(np.median([r['cpu_sec'] for r in records])),
+                         'peak_rss_mb': float(max(r['peak_rss_mb'] for r in records))}
+    return summary
+
+
+def compare(summary, baseline, threshold):
+    #回傳變慢超過threshold倍的stage
+    regressions = {}
+    for name, stats in summary.items():
+        base = baseline.get('summary', {}).get(name)
+        if base is None or base['wall_median'] <= 0:
+            continue
+        ratio = stats['wall_median'] / base['wall_median']
+        print(f"{name}: {base['wall_median']:.2f} -> {stats['wall_median']:.2f} sec ({ratio:.2f}x)")
+        if ratio > threshold:
+            regressions[name] = ratio
+    return regressions
+
+
+#其意義是「模組名稱」。如果該檔案是被引用，其值會是模組名稱；但若該檔案是(透過命令列)直接執行，其值會是 __main__；。
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--work_dir', type=str, default='/tmp/aneurysm_bench', help='合成case跟每次執行的暫存資料夾')
+    parser.add_argument('--shape', type=int, nargs=3, default=[256, 256, 120], help='rows cols slices')
+    parser.add_argument('--spacing', type=float, nargs=3, default=[0.4, 0.4, 0.8], help='mm')
+    parser.add_argument('--n_vessels', type=int, default=24)
+    parser.add_argument('--n_aneurysms', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='每次都從乾淨的合成case開始')
+    parser.add_argument('--use_ctx', action='store_true', help='用CaseContext共用解碼後的nifti')
+    parser.add_argument('--skip_inference', action='store_true', help='不跑stand-in model')
+    parser.add_argument('--morph_methods', type=str, nargs='*', default=['edt'],
+                        help='modify_brain_mask要比較的morphology method，不給就不跑')
+    parser.add_argument('--path_png', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'png'))
+    parser.add_argument('--out', type=str, default='', help='結果json，預設存在work_dir')
+    parser.add_argument('--baseline', type=str, default='', help='之前的結果json，用來比對')
+    parser.add_argument('--threshold', type=float, default=1.2, help='比baseline慢幾倍算regression')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.makedirs(args.work_dir, exist_ok=True)
+    path_template = os.path.join(args.work_dir, 'template')
+    if os.path.isdir(path_template):
+        shutil.rmtree(path_template)
+
+    start = time.time()
+    case_info = build_case(path_template, tuple(args.shape), tuple(args.spacing), args.n_vessels, args.n_aneurysms,
+                           args.seed)
+    print(f"[Done synthesize... ] spend {time.time() - start:.0f} sec", case_info)
+
+    brain_mask = synthesize_brain_mask(tuple(args.shape), tuple(args.spacing), args.seed) if args.morph_methods else None
+
+    runs = []
+    for r in range(args.repeat):
+        path_case = os.path.join(args.work_dir, f'run{r}')
+        if os.path.isdir(path_case):
+            shutil.rmtree(path_case)
+        shutil.copytree(path_template, path_case)
+        records = run_stages(path_case, args.path_png, args.use_ctx, args.skip_inference)
+        if brain_mask is not None:
+            records += morphology_stages(brain_mask, tuple(args.spacing), args.morph_methods)
+        runs.append(records)
+        shutil.rmtree(path_case)
+
+    try:
+        import torch
+        torch_version, num_threads = torch.__version__, torch.get_num_threads()
+    except ImportError:
+        torch_version, num_threads = None, None
+    result = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+              'config': vars(args), 'case': case_info,
+              'env': {'python': platform.python_version(), 'platform': platform.platform(),
+                      'cpu_count': os.cpu_count(), 'numpy': np.__version__, 'torch': torch_version,
+                      'torch_threads': num_threads, 'pydicom': pydicom.__version__},
+              'runs': runs, 'summary': summarize(runs)}
+
+    path_out = args.out or os.path.join(args.work_dir, 'benchmark_' + datetime.datetime.now().strftime('%Y%m%d_%H%M%S') + '.json')
+    with open(path_out, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+    print('結果:', path_out)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(result['summary'], baseline, args.threshold)
+        if regressions:
+            print('regression:', regressions)
+            sys.exit(1)
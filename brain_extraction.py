@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+腦部遮罩(brain extraction)的backend，結果依影像內容hash快取在硬碟
+
+原本get_BET_brain_mask每個case都跑1000次BrainExtractor的表面演化，是CPU上最久的步驟之一，
+但get_brain_seg已經有SynthSeg的腦部分割。這邊把brain extraction做成可替換的backend：
+    bet      : 原本的BrainExtractor(BET)表面演化，結果跟之前一樣
+    synthseg : 從SynthSeg腦部分割用形態學推得，在SynthSeg外圍一圈(grow_mm)內把亮度高於Otsu門檻、
+               並且跟腦連在一起的組織補進來，再closing、補洞，全部用distance transform做，跟半徑大小無關
+預設還是bet，synthseg要跟BET做過Dice驗證之後才能當預設，目前只能手動指定。
+同一張影像(內容、spacing、backend參數都一樣)重跑時直接讀cache，不再重算。
+
+@author: chuan
+"""
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+from scipy import ndimage as ndi
+from scipy.ndimage import binary_fill_holes
+from scipy.ndimage import distance_transform_edt as dist_field
+from skimage.filters import threshold_otsu
+
+
+# 跟gpu_aneurysm.resize_volume相同，複製一份避免import整個tensorflow
+def resize_volume(arr, spacing=None, target_spacing=None, target_size=None, order=3, dtype='float32'):
+    if ("int8" in dtype)or(dtype == "bool"):
+        order = 0
+
+    if (spacing is not None)and(target_spacing is not None):
+        # from spacing to target_spacing
+        scale = np.array(spacing) / np.array(target_spacing)
+        out_vol = ndi.zoom(arr, zoom=scale, order=order,
+                           mode='grid-mirror', prefilter=True, grid_mode=False)
+    elif target_size is not None:
+        # to target_size
+        scale = np.array(target_size) / np.array(arr.shape)
+        out_vol = ndi.zoom(arr, zoom=scale, output=np.zeros(target_size, dtype=dtype), order=order,
+                           mode='grid-mirror', prefilter=True, grid_mode=False)
+
+    if 'int' in dtype:  # clip values
+        dtype_info = np.iinfo(dtype)
+        out_vol = np.clip(out_vol, dtype_info.min, dtype_info.max)
+    return out_vol.astype(dtype)
+
+
+def keep_largest(mask):
+    label_arr, n = ndi.label(mask)
+    if n <= 1:
+        return mask > 0
+    area = np.bincount(label_arr.ravel())
+    area[0] = 0
+    return label_arr == np.argmax(area)
+
+
+class BETBackend:
+    """原本的BET (w/ isotropic(spacing-z, spacing-z, spacing-z) vol)"""
+    name = 'bet'
+    use_seg = False
+
+    def __init__(self, bet_iter=1000, pad=32):
+        self.bet_iter = bet_iter
+        self.pad = pad
+
+    def params(self):
+        return {'bet_iter': self.bet_iter, 'pad': self.pad}
+
+    def __call__(self, image_arr, spacing, brain_seg=None):
+        import nibabel as nib
+        from brainextractor import BrainExtractor
+
+        pad = self.pad
+        # resize to isotropic
+        target_spacing = np.array([spacing[2], spacing[2], spacing[2]], dtype=np.float32)
+        print("BET target_spacing =", target_spacing)
+        image_iso = resize_volume(image_arr, spacing, target_spacing=target_spacing, order=0, dtype='int16')
+
+        pv = np.percentile(image_iso.ravel(), 15)
+        print("pad value =", pv)
+        image_iso = np.pad(image_iso, ((pad,pad),(pad,pad),(pad,pad)), 'constant', constant_values=pv)  # minimum, mean
+
+        # nibabel obj
+        affine = np.array([ [target_spacing[0], 0, 0, 0],
+                            [0, target_spacing[1], 0, 0],
+                            [0, 0, target_spacing[2], 0],
+                            [0, 0, 0, 1]], dtype=np.float32)
+        nib_image = nib.Nifti1Image(image_iso[::-1, ::-1, :], affine=affine)  # LPS to RAS orientation
+
+        # BET process
+        bet = BrainExtractor(img=nib_image)
+        bet.run(iterations=self.bet_iter)
+        brain_mask_iso = bet.compute_mask()[::-1, ::-1, :] > 0  # RAS to LPS orientation
+        brain_mask_iso = brain_mask_iso[pad:-pad, pad:-pad, pad:-pad]
+
+        # back to original spacing
+        return resize_volume(brain_mask_iso, target_size=image_arr.shape, dtype='bool')
+
+
+class SynthSegBackend:
+    """從SynthSeg腦部分割用形態學推得腦部遮罩，需要brain_seg"""
+    name = 'synthseg'
+    use_seg = True
+
+    def __init__(self, grow_mm=6.0, close_mm=4.0):
+        self.grow_mm = grow_mm
+        self.close_mm = close_mm
+
+    def params(self):
+        return {'grow_mm': self.grow_mm, 'close_mm': self.close_mm}
+
+    def __call__(self, image_arr, spacing, brain_seg=None):
+        if brain_seg is None:
+            raise ValueError('synthseg backend需要brain_seg')
+        # 跟BET一樣在isotropic(spacing-z)上做，體積小很多
+        target_spacing = np.array([spacing[2], spacing[2], spacing[2]], dtype=np.float32)
+        image_iso = resize_volume(image_arr, spacing, target_spacing=target_spacing, order=0, dtype='int16')
+        seg_iso = resize_volume((brain_seg > 0).astype(np.uint8), spacing, target_spacing=target_spacing, dtype='uint8') > 0
+        if not seg_iso.any():
+            return np.zeros(image_arr.shape, dtype=bool)
+
+        # SynthSeg外圍grow_mm內的一圈，亮度門檻用這圈自己的Otsu(分開腦組織跟CSF/顱骨)
+        dist_out = dist_field(~seg_iso, sampling=target_spacing)
+        shell = (dist_out > 0) & (dist_out <= self.grow_mm)
+        brain_iso = seg_iso.copy()
+        if shell.any():
+            values = image_iso[shell]
+            if values.min() < values.max():
+                brain_iso |= shell & (image_iso > threshold_otsu(values))
+        brain_iso = keep_largest(brain_iso)  #只留跟腦連在一起的
+
+        # closing: 先往外close_mm再往內close_mm，用distance transform不用大的structure
+        dilated = dist_field(~brain_iso, sampling=target_spacing) <= self.close_mm
+        brain_iso = dist_field(dilated, sampling=target_spacing) > self.close_mm
+        brain_iso = binary_fill_holes(brain_iso | seg_iso)
+
+        # back to original spacing
+        return resize_volume(brain_iso, target_size=image_arr.shape, dtype='bool')
+
+
+BACKENDS = {'bet': BETBackend, 'synthseg': SynthSegBackend}
+
+
+class BrainMaskCache:
+    """遮罩依(影像內容, spacing, backend參數)的hash存成npz，bool用packbits壓縮"""
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def key(self, backend, image_arr, spacing, brain_seg=None):
+        h = hashlib.blake2b(digest_size=20)
+        h.update(json.dumps([backend.name, backend.params(), list(image_arr.shape), str(image_arr.dtype),
+                             [float(y) for y in spacing]], sort_keys=True).encode('utf-8'))
+        h.update(np.ascontiguousarray(image_arr).data)
+        if backend.use_seg and brain_seg is not None:
+            h.update(np.packbits(np.ascontiguousarray(brain_seg > 0)).data)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npz')
+
+    def load(self, key):
+        path = self.path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path) as data:
+                shape = tuple(data['shape'])
+                return np.unpackbits(data['bits'], count=int(np.prod(shape))).reshape(shape).astype(bool)
+        except (OSError, ValueError, KeyError):
+            logging.error(f"brain mask cache損毀，重算: {path}", exc_info=True)
+            return None
+
+    def save(self, key, mask):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        path_tmp = path + '.tmp'
+        with open(path_tmp, 'wb') as f:
+            np.savez_compressed(f, bits=np.packbits(mask.ravel()), shape=np.array(mask.shape))
+        os.replace(path_tmp, path)
+
+
+def extract_brain_mask(image_arr, spacing, backend='bet', brain_seg=None, cache_dir=None, **params):
+    """
+    backend: 'bet' 或 'synthseg'，params傳給backend(例如bet_iter、grow_mm)
+    brain_seg: get_brain_seg的結果，synthseg backend需要
+    cache_dir: None就不快取
+    return: 跟image_arr一樣大小的bool遮罩
+    """
+    extractor = BACKENDS[backend](**params)
+    cache = BrainMaskCache(cache_dir) if cache_dir else None
+    if cache is not None:
+        key = cache.key(extractor, image_arr, spacing, brain_seg)
+        brain_mask = cache.load(key)
+        if brain_mask is not None and brain_mask.shape == image_arr.shape:
+            print(f"[Cache brain mask... ] {backend} {key[:12]}")
+            return brain_mask
+    brain_mask = extractor(image_arr, spacing, brain_seg=brain_seg)
+    if cache is not None:
+        cache.save(key, brain_mask)
+    return brain_mask
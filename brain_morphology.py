@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+大半徑的binary形態學(dilation/erosion/opening)，給modify_brain_mask用
+
+原本get_struc把ball(diameter*5)縮放成mm大小的structure，直徑8~14mm在0.4mm spacing下structure有20~35格，
+每個voxel的計算量跟半徑的三次方成正比。這邊每次呼叫可選method:
+    ball : 原本的做法(get_struc的structure)，當作對照
+    edt  : distance transform取門檻，各軸半徑跟get_struc一樣的精確橢球，計算量跟半徑大小無關，
+           而且只算mask的bounding box(dilation再往外加半徑)
+planar=True代表只在xy平面上做(原本的get_struc(...).sum(axis=2, keepdims=True))。
+注意get_struc的structure[center_point] = True是用陣列索引，實際上把第0軸的幾整片都設成True，
+所以ball比真正的橢球大一點；合成benchmark上edt跟ball的Dice約0.97，跟修正後的橢球約0.99。
+erosion的邊界跟skimage一樣把影像外當成True。
+預設還是ball，edt要在benchmark_aneurysm(--morph_methods)的Dice跟偵測結果都驗證過才能當預設，目前只能手動指定。
+
+@author: chuan
+"""
+import numpy as np
+from scipy import ndimage as ndi
+from scipy.ndimage import binary_fill_holes
+from scipy.ndimage import distance_transform_edt as dist_field
+from skimage.morphology import ball, binary_dilation, binary_erosion
+
+from brain_extraction import resize_volume
+
+METHODS = ('ball', 'edt')
+
+
+def get_struc(diameter, spacing):  # diameter in mm
+    structure_size = np.round(diameter / np.array(spacing)).astype('int32')
+    structure_size = np.maximum([1,1,1], structure_size)
+    structure = resize_volume(ball(diameter*5), target_size=structure_size, dtype='bool')
+    center_point = np.array(structure.shape) // 2
+    structure[center_point] = True
+    return structure
+
+
+def _radius(diameter, spacing, planar):
+    #跟get_struc的structure一樣大: 各軸round(diameter/spacing)格，半徑(格數-1)/2
+    size = np.maximum(np.round(diameter / np.array(spacing, dtype=np.float64)), 1)
+    radius = (size - 1) / 2
+    if planar:
+        radius[2] = 0
+    return radius
+
+
+def _bbox(mask, margin):
+    #mask範圍往外margin格的slices，沒有True就回傳None
+    slices = ndi.find_objects(mask.astype(np.uint8))
+    if not slices:
+        return None
+    return tuple(slice(max(s.start - int(m), 0), min(s.stop + int(m), n))
+                 for s, m, n in zip(slices[0], margin, mask.shape))
+
+
+def _within(mask, radius, planar):
+    #mask裡到最近的False的(以半徑正規化)距離 > 1 的voxel，也就是被半徑radius的橢球erode後的結果
+    #各軸以1/radius當sampling，橢球就變成單位球；半徑0的軸(planar)每張slice分開算
+    out = np.zeros(mask.shape, dtype=bool)
+    box = _bbox(mask, [1, 1, 1])
+    if box is None:
+        return out
+    sub = mask[box]
+    if not planar:
+        out[box] = dist_field(sub, sampling=1 / np.maximum(radius, 1e-6)) > 1 + 1e-6
+        return out
+    sampling = 1 / np.maximum(radius[:2], 1e-6)
+    for z in range(sub.shape[2]):
+        if sub[:, :, z].all():
+            out[box][:, :, z] = True
+        elif sub[:, :, z].any():
+            out[box][:, :, z] = dist_field(sub[:, :, z], sampling=sampling) > 1 + 1e-6
+    return out
+
+
+def dilate(mask, diameter, spacing, method='ball', planar=False):
+    mask = np.asarray(mask, dtype=bool)
+    if method == 'ball':
+        struc = get_struc(diameter, spacing)
+        if planar:
+            struc = struc.sum(axis=2, keepdims=True).astype(bool)
+        return binary_dilation(mask, struc)
+    if method == 'edt':
+        #dilation = 背景的erosion，背景只要算mask範圍往外半徑那麼大的box
+        radius = _radius(diameter, spacing, planar)
+        box = _bbox(mask, np.ceil(radius) + 1)
+        out = np.zeros(mask.shape, dtype=bool)
+        if box is not None:
+            out[box] = ~_within(~mask[box], radius, planar)
+        return out
+    raise ValueError(f'未知的morphology method: {method}')
+
+
+def erode(mask, diameter, spacing, method='ball', planar=False):
+    mask = np.asarray(mask, dtype=bool)
+    if method == 'ball':
+        struc = get_struc(diameter, spacing)
+        if planar:
+            struc = struc.sum(axis=2, keepdims=True).astype(bool)
+        return binary_erosion(mask, struc)
+    if method == 'edt':
+        return _within(mask, _radius(diameter, spacing, planar), planar)
+    raise ValueError(f'未知的morphology method: {method}')
+
+
+def opening(mask, diameter, spacing, method='ball', planar=False):
+    return dilate(erode(mask, diameter, spacing, method, planar), diameter, spacing, method, planar)
+
+
+def fill_holes(mask):
+    #只在bounding box(外加一格)裡補洞，結果跟整個volume做binary_fill_holes一樣
+    out = np.zeros(mask.shape, dtype=bool)
+    box = _bbox(mask, [1, 1, 1])
+    if box is not None:
+        out[box] = binary_fill_holes(mask[box])
+    return out
+
+
+#@title modify brain mask
+def modify_brain_mask(brain_mask, spacing, verbose=False, method='ball'):
+    # merge and modify brain mask
+    if verbose: print(">>> modify_brain_mask ", end='')
+    brain_mask = dilate(brain_mask, 8, spacing, method=method)
+    if verbose: print(".", end='')
+    brain_mask = fill_holes(brain_mask)
+    if verbose: print(".", end='')
+    brain_mask = erode(brain_mask, 14, spacing, method=method, planar=True)  # 12
+    if verbose: print(".", end='')
+    brain_mask = opening(brain_mask, 14, spacing, method=method, planar=True)
+    if verbose: print(">>>", brain_mask.shape)
+    return brain_mask
+
+
+def dice(a, b):
+    total = a.sum() + b.sum()
+    return 1.0 if total == 0 else 2.0 * np.logical_and(a, b).sum() / total
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+單一case在pipeline各stage之間共用的nifti快取
+
+原本pipeline_aneurysm用shutil.copy把同一批nii.gz複製到nnUNet/、Image_nii/、輸出資料夾，
+之後reslice、MIP、AneurysmPipeline每一步又各自nib.load重新解壓縮同一個檔案。
+CaseContext把解碼後的影像(陣列+affine+header)依檔案快取一次，後面的stage直接拿記憶體中的影像；
+需要路徑的地方用hard link(跨檔案系統時改reflink，再不行才真的複製)，只有宣告為輸出的結果才寫檔。
+
+@author: chuan
+"""
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import nibabel as nib
+
+
+class CaseContext:
+    def __init__(self, ID, path_process):
+        self.ID = ID
+        self.path_process = path_process
+        self._images = {}  #key: 檔案的(st_dev, st_ino)，hard link會共用同一個key
+        self._aliases = {}  #reflink/複製出來的路徑 => 來源的key
+
+    @staticmethod
+    def _inode_key(path):
+        st = os.stat(path)
+        return (st.st_dev, st.st_ino)
+
+    def _key(self, path):
+        path = os.path.realpath(path)
+        if path in self._aliases:
+            return self._aliases[path]
+        return self._inode_key(path)
+
+    def load(self, path):
+        """
+        回傳已解碼在記憶體中的Nifti1Image，同一個檔案(含hard link)只解壓縮一次
+        """
+        key = self._key(path)
+        img = self._images.get(key)
+        if img is None:
+            nii = nib.load(path)
+            data = np.asanyarray(nii.dataobj)
+            img = nib.Nifti1Image(data, nii.affine, header=nii.header.copy())
+            self._images[key] = img
+        return img
+
+    def get_array(self, path):
+        #跟np.array(nii.dataobj)一樣回傳複本，呼叫端改陣列不會影響快取
+        return np.array(self.load(path).dataobj)
+
+    def save(self, img, path):
+        """
+        輸出邊界: 寫檔並把記憶體中的影像放進快取，後面的stage不用再讀回來
+        """
+        if os.path.lexists(path):
+            os.remove(path)  #可能是hard link，先刪掉才不會寫穿到其他路徑
+        nib.save(img, path)
+        self._aliases.pop(os.path.realpath(path), None)
+        # 只有寫檔不會改變數值的情況(header dtype跟陣列相同或是浮點數)才快取，其他讓下次load從檔案讀
+        data = np.asanyarray(img.dataobj)
+        disk_dtype = img.get_data_dtype()
+        if data.dtype == disk_dtype or np.issubdtype(disk_dtype, np.floating):
+            cached = nib.Nifti1Image(data.astype(disk_dtype, copy=False), img.affine, header=img.header.copy())
+            self._images[self._inode_key(path)] = cached
+        return path
+
+    def link(self, src, dst):
+        """
+        讓dst指向跟src相同的內容: hard link > reflink > copy
+        """
+        if os.path.lexists(dst):
+            os.remove(dst)
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+
+        result = subprocess.run(['cp', '--reflink=auto', src, dst], capture_output=True)
+        if result.returncode != 0:
+            shutil.copy(src, dst)
+        # 不同inode，記下來源讓load還是命中同一份快取
+        try:
+            self._aliases[os.path.realpath(dst)] = self._key(src)
+        except OSError:
+            pass
+        return dst
+
+    def release(self):
+        self._images.clear()
+        self._aliases.clear()
+
+
+#有CaseContext就從快取拿，沒有就照舊nib.load
+def load_nii(path, ctx=None):
+    if ctx is not None:
+        return ctx.load(path)
+    return nib.load(path)
+
+
+def save_nii(img, path, ctx=None):
+    if ctx is not None:
+        return ctx.save(img, path)
+    nib.save(img, path)
+    return path
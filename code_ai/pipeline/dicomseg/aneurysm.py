@@ -693,8 +693,12 @@ def main(_id='07807990_20250715_MR_21405290051',
     # path_processModel = "/mnt/e/pipeline/p1"
     # path_processID = os.path.join(path_processModel, args.ID)
 
-    execute_dicomseg_platform_json(
-        _id=_id, root_path=path_processID, group_id=group_id)
+    try:
+        execute_dicomseg_platform_json(
+            _id=_id, root_path=path_processID, group_id=group_id)
+    finally:
+        # The case is done; do not keep its series headers in a resident process
+        utils.clear_series_index_cache()
 
 
 
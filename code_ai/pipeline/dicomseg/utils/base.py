@@ -2,16 +2,22 @@
 """
 @author: sean
 """
+import copy
+import os
 import pathlib
-from typing import Dict, List, Any, Union
+from collections import OrderedDict
+from typing import Dict, List, Any, Union, Optional
 import numpy as np
 import pydicom
+import pydicom.errors
 import nibabel as nib
 import SimpleITK as sitk
 import matplotlib.colors as mcolors
 import pydicom_seg
 from pydicom import FileDataset
 from pydicom.dicomdir import DicomDir
+from pydicom.sequence import Sequence
+from pydicom.uid import generate_uid
 
 from code_ai.pipeline.dicomseg import DCM_EXAMPLE
 
@@ -134,20 +140,26 @@ def make_dicomseg_file(mask: np.ndarray,
                        image: sitk.Image,
                        first_dcm: pydicom.FileDataset,
                        source_images: List[pydicom.FileDataset],
-                       template_json: Dict) -> pydicom.FileDataset:
+                       template_json: Dict,
+                       dcm_example: Optional[pydicom.FileDataset] = None) -> pydicom.FileDataset:
     """
     Create a DICOM-SEG file from a mask array.
 
     Args:
-        mask: Binary mask array
+        mask: Label mask array, values are the template labelIDs
         image: SimpleITK image with spatial information
         first_dcm: First DICOM dataset for metadata
         source_images: List of source DICOM datasets
         template_json: DICOM-SEG template
+        dcm_example: Example DICOM-SEG to copy shared functional groups from
+            (defaults to DCM_EXAMPLE)
 
     Returns:
         pydicom.FileDataset: DICOM-SEG dataset
     """
+    if dcm_example is None:
+        dcm_example = DCM_EXAMPLE
+
     # Create template from JSON
     template = pydicom_seg.template.from_dcmqi_metainfo(template_json)
 
@@ -176,7 +188,7 @@ def make_dicomseg_file(mask: np.ndarray,
                                             0x0011].value  # Series Number
 
     # Copy more metadata from the example DICOM-SEG file
-    dcm_seg[0x5200, 0x9229].value = DCM_EXAMPLE[0x5200, 0x9229].value
+    dcm_seg[0x5200, 0x9229].value = dcm_example[0x5200, 0x9229].value
     dcm_seg[0x5200, 0x9229][0][0x20, 0x9116][0][0x20,
                                                 0x0037].value = first_dcm[0x20, 0x0037].value
     dcm_seg[0x5200, 0x9229][0][0x28, 0x9110][0][0x18,
@@ -189,6 +201,199 @@ def make_dicomseg_file(mask: np.ndarray,
     return dcm_seg
 
 
+class DicomSegWriter:
+    """
+    DICOM-SEG writer for one source series.
+
+    The source series (SimpleITK image, first dataset and header-only source
+    datasets) is read once by the caller and shared by every SEG written here.
+    All labels are encoded in a single pydicom_seg pass, which only encodes the
+    frames that contain each segment; per-label SEG files are cut out of that
+    shared frame cache instead of re-encoding the whole series per label.
+    """
+
+    def __init__(self,
+                 image: Any,
+                 first_dcm: FileDataset | DicomDir,
+                 source_images: List[FileDataset | DicomDir],
+                 dcm_example: Optional[pydicom.FileDataset] = None):
+        self.image = image
+        self.first_dcm = first_dcm
+        self.source_images = source_images
+        self.dcm_example = dcm_example
+
+    def encode(self, label_volume: np.ndarray, template_json: Dict) -> pydicom.FileDataset:
+        """
+        Encode a multi-segment DICOM-SEG.
+
+        Args:
+            label_volume: (z, y, x) array with values 1..N matching the template labelIDs
+            template_json: DICOM-SEG template with N segment attributes
+
+        Returns:
+            pydicom.FileDataset: Multi-segment DICOM-SEG dataset
+        """
+        dtype = np.uint8 if label_volume.max(initial=0) < 256 else np.uint16
+        return make_dicomseg_file(label_volume.astype(dtype),
+                                  self.image,
+                                  self.first_dcm,
+                                  self.source_images,
+                                  template_json,
+                                  dcm_example=self.dcm_example)
+
+    @staticmethod
+    def _frame_reader(pixel_data: bytes, n_frames: int, frame_pixels: int):
+        """Return a function that concatenates the bit-packed frames at the given indices."""
+        if frame_pixels % 8 == 0:
+            frame_bytes = frame_pixels // 8
+
+            def read(indices: List[int]) -> bytes:
+                data = b''.join(pixel_data[k * frame_bytes:(k + 1) * frame_bytes] for k in indices)
+                return data + b'\x00' if len(data) % 2 else data
+            return read
+
+        # Frames are not byte aligned, unpack once and repack the selected frames
+        bits = np.unpackbits(np.frombuffer(pixel_data, dtype=np.uint8), bitorder='little')
+        bits = bits[:n_frames * frame_pixels].reshape(n_frames, frame_pixels)
+
+        def read(indices: List[int]) -> bytes:
+            data = np.packbits(bits[indices].ravel(), bitorder='little').tobytes()
+            return data + b'\x00' if len(data) % 2 else data
+        return read
+
+    def split_segments(self, dcm_seg: pydicom.FileDataset) -> Dict[int, pydicom.FileDataset]:
+        """
+        Split a multi-segment DICOM-SEG into one single-segment DICOM-SEG per segment.
+
+        Args:
+            dcm_seg: Multi-segment DICOM-SEG from encode()
+
+        Returns:
+            Dict[int, pydicom.FileDataset]: Segment number -> single-segment DICOM-SEG
+        """
+        segments = dcm_seg.SegmentSequence
+        if len(segments) == 1:
+            return {int(segments[0].SegmentNumber): dcm_seg}
+
+        per_frame = dcm_seg.PerFrameFunctionalGroupsSequence
+        pixel_data = dcm_seg.PixelData
+        read_frames = self._frame_reader(pixel_data, len(per_frame), int(dcm_seg.Rows) * int(dcm_seg.Columns))
+        frame_segments = [int(item.SegmentIdentificationSequence[0].ReferencedSegmentNumber) for item in per_frame]
+
+        # Copy everything but the per-segment parts once per segment
+        del dcm_seg.SegmentSequence
+        del dcm_seg.PerFrameFunctionalGroupsSequence
+        del dcm_seg.PixelData
+        result = {}
+        try:
+            for segment in segments:
+                segment_number = int(segment.SegmentNumber)
+                indices = [k for k, n in enumerate(frame_segments) if n == segment_number]
+                if len(indices) == 0:
+                    continue
+
+                ds = copy.deepcopy(dcm_seg)
+                ds.SeriesInstanceUID = generate_uid()
+                ds.SOPInstanceUID = generate_uid()
+                if getattr(ds, 'file_meta', None) is not None:
+                    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+
+                new_segment = copy.deepcopy(segment)
+                new_segment.SegmentNumber = 1
+                ds.SegmentSequence = Sequence([new_segment])
+
+                frames = []
+                for k in indices:
+                    item = copy.deepcopy(per_frame[k])
+                    item.SegmentIdentificationSequence[0].ReferencedSegmentNumber = 1
+                    frame_content = item.FrameContentSequence[0]
+                    if 'DimensionIndexValues' in frame_content:
+                        dimension_index = list(frame_content.DimensionIndexValues)
+                        dimension_index[0] = 1
+                        frame_content.DimensionIndexValues = dimension_index
+                    frames.append(item)
+                ds.PerFrameFunctionalGroupsSequence = Sequence(frames)
+                ds.NumberOfFrames = len(frames)
+                ds.PixelData = read_frames(indices)
+                result[segment_number] = ds
+        finally:
+            dcm_seg.SegmentSequence = segments
+            dcm_seg.PerFrameFunctionalGroupsSequence = per_frame
+            dcm_seg.PixelData = pixel_data
+        return result
+
+    def write_labels(self,
+                     pred_data_unique: np.ndarray,
+                     pred_data: np.ndarray,
+                     series_name: str,
+                     output_folder: pathlib.Path,
+                     multi_segment: bool = False) -> List[Dict[str, Any]]:
+        """
+        Write DICOM-SEG files for the given label values.
+
+        Args:
+            pred_data_unique: Label values to write (background excluded)
+            pred_data: Full prediction data array (z, y, x)
+            series_name: Name of the series
+            output_folder: Output directory for DICOM-SEG files
+            multi_segment: Write one multi-segment SEG instead of one SEG per label
+
+        Returns:
+            List[Dict[str, Any]]: List of results with mask index, file path, and main slice
+        """
+        labels = np.asarray(pred_data_unique)
+        if len(labels) == 0:
+            return []
+
+        # Map label values to segment numbers 1..N with one lookup
+        order = np.argsort(labels)
+        sorted_labels = labels[order]
+        pos = np.clip(np.searchsorted(sorted_labels, pred_data), 0, len(labels) - 1)
+        label_volume = np.where(sorted_labels[pos] == pred_data, order[pos] + 1, 0)
+
+        # Main slice per segment from the nonzero voxels only
+        nonzero = np.nonzero(label_volume)
+        nonzero_segments = label_volume[nonzero]
+        present = [n for n in range(1, len(labels) + 1) if np.any(nonzero_segments == n)]
+        if len(present) == 0:
+            return []
+
+        label_dict = {n: {'SegmentLabel': f'A{labels[n - 1]}', 'color': 'red'} for n in present}
+        template_json = get_dicom_seg_template(series_name, label_dict)
+        dcm_seg = self.encode(label_volume, template_json)
+
+        if multi_segment:
+            outputs = {n: dcm_seg for n in present}
+            filenames = {n: f'{series_name}_seg.dcm' for n in present}
+        else:
+            outputs = self.split_segments(dcm_seg)
+            filenames = {n: f'{series_name}_{label_dict[n]["SegmentLabel"]}.dcm' for n in present}
+
+        reslut_list = []
+        saved = {}
+        for index, n in enumerate(present):
+            if n not in outputs:
+                continue
+            dcm_seg_path = output_folder.joinpath(filenames[n])
+            if dcm_seg_path not in saved:
+                if dcm_seg_path.exists():
+                    dcm_seg_path.unlink()
+                outputs[n].save_as(dcm_seg_path)
+                saved[dcm_seg_path] = True
+
+            # Clear console line and show progress
+            print(f" " * 100, end='\r')
+            print(f"{index + 1}/{len(present)} Saved: {dcm_seg_path}", end='\r')
+
+            if dcm_seg_path.exists():
+                reslut_list.append({
+                    'mask_index': labels[n - 1],
+                    'dcm_seg_path': dcm_seg_path,
+                    'main_seg_slice': int(np.median(nonzero[0][nonzero_segments == n]))
+                })
+        return reslut_list
+
+
 def create_dicom_seg_file(pred_data_unique: np.ndarray,
                           pred_data: np.ndarray,
                           series_name: str,
@@ -196,6 +401,7 @@ def create_dicom_seg_file(pred_data_unique: np.ndarray,
                           image: Any,
                           first_dcm: FileDataset | DicomDir,
                           source_images: List[FileDataset | DicomDir],
+                          multi_segment: bool = False,
                           ) -> List[Dict[str, Any]]:
     """
     Create DICOM-SEG files for each unique value in the prediction data.
@@ -208,69 +414,79 @@ def create_dicom_seg_file(pred_data_unique: np.ndarray,
         image: SimpleITK image
         first_dcm: First DICOM dataset
         source_images: List of source DICOM datasets
+        multi_segment: Write a single multi-segment SEG instead of one SEG per value
 
     Returns:
         List[Dict[str, Any]]: List of results with mask index, file path, and main slice
     """
-    pred_data_unique_len = len(pred_data_unique)
-    reslut_list = []
-
-    # Process each unique value in the prediction data
-    for index, i in enumerate(pred_data_unique):
-        # Create a binary mask for this specific region
-        mask = np.zeros_like(pred_data)
-        mask[pred_data == i] = 1
-
-        # Only create DICOM-SEG if the mask contains positive values
-        if np.sum(mask) > 0:
-            # Create label dictionary for this mask
-            label_dict = {1: {'SegmentLabel': f'A{i}', 'color': 'red'}}
-
-            # Create template for DICOM-SEG
-            template_json = get_dicom_seg_template(series_name, label_dict)
-
-            # Generate DICOM-SEG file
-            dcm_seg = make_dicomseg_file(
-                mask.astype('uint8'),
-                image,
-                first_dcm,
-                source_images,
-                template_json
-            )
-
-            # Find the median slice containing the mask (main slice)
-            main_seg_slice = int(np.median(np.where(mask)[0]))
-
-            # Save DICOM-SEG file
-            dcm_seg_filename = f'{series_name}_{label_dict[1]["SegmentLabel"]}.dcm'
-
-            dcm_seg_path = output_folder.joinpath(dcm_seg_filename)
-            if dcm_seg_path.exists():
-                dcm_seg_path.unlink()
+    writer = DicomSegWriter(image, first_dcm, source_images)
+    return writer.write_labels(pred_data_unique, pred_data, series_name, output_folder,
+                               multi_segment=multi_segment)
 
-            dcm_seg.save_as(dcm_seg_path)
 
-            # Clear console line and show progress
-            print(f" " * 100, end='\r')
-            print(
-                f"{index + 1}/{pred_data_unique_len} Saved: {dcm_seg_path}", end='\r')
+# Series index cache: (realpath of series folder, file signature) -> index result.
+# Small LRU (one study is MRA_BRAIN + MIP_Pitch + MIP_Yaw) so a resident worker does not keep every case's headers.
+_SERIES_INDEX_CACHE: "OrderedDict[tuple, tuple]" = OrderedDict()
+_SERIES_INDEX_CACHE_SIZE = 6
 
-            # Add result to the list if file was created successfully
-            if dcm_seg_path.exists():
-                reslut_list.append({
-                    'mask_index': i,
-                    'dcm_seg_path': dcm_seg_path,
-                    'main_seg_slice': main_seg_slice
-                })
 
-    return reslut_list
+def clear_series_index_cache() -> None:
+    """Drop all cached series indexes (e.g. at the end of a case)."""
+    _SERIES_INDEX_CACHE.clear()
+
+
+def _copy_series_index(result: tuple) -> tuple:
+    """Copy of a cached index; callers may edit the headers (the SEG writers do) without touching the cache."""
+    sorted_dcms, image, _, source_images = result
+    source_images = [copy.deepcopy(ds) for ds in source_images]
+    return list(sorted_dcms), sitk.Image(image), source_images[0], source_images
+
+
+def _series_signature(path_dcms: str) -> tuple:
+    """(name, size, mtime_ns) of every regular file in the folder; changes when any file does."""
+    signature = []
+    with os.scandir(path_dcms) as entries:
+        for entry in entries:
+            if entry.is_file():
+                st = entry.stat()
+                signature.append((entry.name, st.st_size, st.st_mtime_ns))
+    return tuple(sorted(signature))
+
+
+def _geometry_image(source_images: List[FileDataset], projections: List[float]) -> sitk.Image:
+    """
+    Build an empty SimpleITK image carrying the series geometry only.
+
+    Same origin, spacing and direction as sitk.ImageSeriesReader would give for the
+    sorted series, without decoding any pixel data (used for CopyInformation).
+    """
+    first = source_images[0]
+    rows, columns = int(first.Rows), int(first.Columns)
+    iop = np.array(first.ImageOrientationPatient, dtype=np.float64)
+    row_cosine, col_cosine = iop[0:3], iop[3:]
+    normal = np.cross(row_cosine, col_cosine)
+    pixel_spacing = [float(x) for x in first.PixelSpacing]
+    slice_spacing = float(projections[1] - projections[0]) if len(projections) > 1 else 0.0
+    if slice_spacing <= 0:
+        slice_spacing = float(getattr(first, 'SpacingBetweenSlices', None) or getattr(first, 'SliceThickness', 1.0) or 1.0)
+
+    image = sitk.Image([columns, rows, len(source_images)], sitk.sitkUInt8)
+    image.SetOrigin([float(x) for x in first.ImagePositionPatient])
+    image.SetSpacing([pixel_spacing[1], pixel_spacing[0], slice_spacing])
+    image.SetDirection(np.stack([row_cosine, col_cosine, normal], axis=1).ravel().tolist())
+    return image
 
 
 def load_and_sort_dicom_files(path_dcms: Union[pathlib.Path, str]) -> tuple[
         List[Any], Any, FileDataset | DicomDir, list[FileDataset | DicomDir]]:
     """
     Load and sort DICOM files from a directory.
-    This function only needs to be executed once per directory.
+
+    Every header is parsed once (pixel data is never read) and the result is cached
+    per folder, keyed by the path, size and mtime of every file, so MRA_BRAIN,
+    MIP_Pitch and MIP_Yaw are indexed once per study no matter how many SEG/JSON
+    builders ask for them. The cache keeps the last few folders only, and every
+    call returns its own copy of the headers and image.
 
     Args:
         path_dcms: Path to the directory containing DICOM files
@@ -278,46 +494,61 @@ def load_and_sort_dicom_files(path_dcms: Union[pathlib.Path, str]) -> tuple[
     Returns:
         tuple: (sorted_dcms, image, first_dcm, source_images)
             - sorted_dcms: List of sorted DICOM file paths
-            - image: SimpleITK image object
-            - first_dcm: First DICOM dataset
+            - image: SimpleITK image object (series geometry, no pixel data)
+            - first_dcm: First DICOM dataset (without pixel data)
             - source_images: List of all DICOM datasets (without pixel data)
     """
-    # Read DICOM file paths
-    reader = sitk.ImageSeriesReader()
-    dcms = sorted(reader.GetGDCMSeriesFileNames(path_dcms))
-
-    # Read all slices
-    slices = [pydicom.dcmread(dcm) for dcm in dcms]
-
-    # Sort slices by position
+    path_dcms = str(path_dcms)
+    signature = _series_signature(path_dcms)
+    key = (os.path.realpath(path_dcms), signature)
+    cached = _SERIES_INDEX_CACHE.get(key)
+    if cached is not None:
+        _SERIES_INDEX_CACHE.move_to_end(key)
+        return _copy_series_index(cached)
+
+    # Parse each header once
+    headers = []
+    for name, _, _ in signature:
+        path_file = os.path.join(path_dcms, name)
+        try:
+            ds = pydicom.dcmread(path_file, stop_before_pixels=True)
+        except pydicom.errors.InvalidDicomError:
+            continue
+        if 'ImagePositionPatient' not in ds or 'ImageOrientationPatient' not in ds:
+            continue
+        headers.append((path_file, ds))
+
+    # Keep a single series (the one with most slices), as the GDCM series reader does per folder
+    series_count = {}
+    for _, ds in headers:
+        uid = getattr(ds, 'SeriesInstanceUID', '')
+        series_count[uid] = series_count.get(uid, 0) + 1
+    if len(series_count) > 1:
+        main_series = max(series_count, key=series_count.get)
+        headers = [(f, ds) for f, ds in headers if getattr(ds, 'SeriesInstanceUID', '') == main_series]
+
+    # Sort slices by the projection of IPP onto the image plane normal
     slice_dcm = []
-    for (slice_data, dcm_slice) in zip(slices, dcms):
-        # Get Image Orientation Patient (IOP)
-        IOP = np.array(slice_data.get((0x0020, 0x0037)).value)
-        # Get Image Position Patient (IPP)
-        IPP = np.array(slice_data.get((0x0020, 0x0032)).value)
-        # Calculate normal vector to the image plane
+    for path_file, ds in headers:
+        IOP = np.array(ds.ImageOrientationPatient, dtype=np.float64)
+        IPP = np.array(ds.ImagePositionPatient, dtype=np.float64)
         normal = np.cross(IOP[0:3], IOP[3:])
-        # Project IPP onto the normal vector
-        projection = np.dot(IPP, normal)
-        slice_dcm.append({"d": projection, "dcm": dcm_slice})
-
-    # Sort slices by projection value
+        slice_dcm.append({"d": float(np.dot(IPP, normal)), "dcm": path_file, "ds": ds})
     slice_dcms = sorted(slice_dcm, key=lambda i: i['d'])
-    sorted_dcms = [y['dcm'] for y in slice_dcms]
-
-    # Read the image data
-    reader.SetFileNames(sorted_dcms)
-    image = reader.Execute()
-
-    # Read the first DICOM image for metadata
-    first_dcm = pydicom.dcmread(sorted_dcms[0], force=True)
 
-    # Preload all DICOM files (without pixel data to save memory)
-    source_images = [pydicom.dcmread(
-        x, stop_before_pixels=True) for x in sorted_dcms]
-
-    return sorted_dcms, image, first_dcm, source_images
+    sorted_dcms = [y['dcm'] for y in slice_dcms]
+    source_images = [y['ds'] for y in slice_dcms]
+    image = _geometry_image(source_images, [y['d'] for y in slice_dcms])
+    first_dcm = source_images[0]
+
+    result = (sorted_dcms, image, first_dcm, source_images)
+    # Older signatures of the same folder can never hit again
+    for old_key in [k for k in _SERIES_INDEX_CACHE if k[0] == key[0]]:
+        del _SERIES_INDEX_CACHE[old_key]
+    _SERIES_INDEX_CACHE[key] = result
+    while len(_SERIES_INDEX_CACHE) > _SERIES_INDEX_CACHE_SIZE:
+        _SERIES_INDEX_CACHE.popitem(last=False)
+    return _copy_series_index(result)
 
 
 def transform_mask_for_dicom_seg(mask: np.ndarray) -> np.ndarray:
@@ -25,6 +25,8 @@ from pydantic import BaseModel, PositiveInt, field_validator
 from pydicom import FileDataset
 from pydicom.dicomdir import DicomDir
 from skimage.measure import regionprops_table
+#載入並排序DICOM檔案改用code_ai共用的series index(header只讀一次並依路徑/大小/mtime快取)
+from code_ai.pipeline.dicomseg.utils.base import load_and_sort_dicom_files
 
 #from code_ai.pipeline import pipeline_parser
 
@@ -470,42 +472,6 @@ def get_dicom_seg_template(model: str, label_dict: Dict) -> Dict:
     return template
 
 
-def load_and_sort_dicom_files(path_dcms: str) -> tuple[List[Any], Any, FileDataset | DicomDir, list[FileDataset | DicomDir]]:
-    """載入並排序DICOM檔案，只需執行一次"""
-    # 讀取DICOM文件
-    reader = sitk.ImageSeriesReader()
-    dcms = sorted(reader.GetGDCMSeriesFileNames(path_dcms))
-
-    # 讀取所有切片
-    slices = [pydicom.dcmread(dcm) for dcm in dcms]
-
-    # 依照切片位置排序
-    slice_dcm = []
-    for (slice_data, dcm_slice) in zip(slices, dcms):
-        IOP = np.array(slice_data.get((0x0020, 0x0037)).value)
-        IPP = np.array(slice_data.get((0x0020, 0x0032)).value)
-        normal = np.cross(IOP[0:3], IOP[3:])
-        projection = np.dot(IPP, normal)
-        slice_dcm.append({"d": projection, "dcm": dcm_slice})
-
-    # 排序切片
-    slice_dcms = sorted(slice_dcm, key=lambda i: i['d'])
-    sorted_dcms = [y['dcm'] for y in slice_dcms]
-
-    # 讀取影像資料
-    reader.SetFileNames(sorted_dcms)
-    image = reader.Execute()
-
-    # 讀取第一張DICOM影像以獲取標頭資訊
-    first_dcm = pydicom.dcmread(sorted_dcms[0], force=True)
-
-    # 預載所有DICOM檔案（但不載入像素資料以節省記憶體）
-    source_images = [pydicom.dcmread(x, stop_before_pixels=True) for x in sorted_dcms]
-
-    return sorted_dcms, image, first_dcm, source_images
-
-
-
 def transform_mask_for_dicom_seg(mask: np.ndarray) -> np.ndarray:
     """將遮罩轉換為DICOM-SEG所需的格式"""
     # 轉換格式：(y,x,z) -> (z,x,y)
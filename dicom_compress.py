@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+dicom JPEG-LS lossless壓縮
+
+util_aneurysm.compress_dicom_into_jpeglossless用subprocess執行這支(python dicom_compress.py <in> <out> --workers N)，
+process pool開在這個只import pydicom的程序裡。如果直接在pipeline裡開spawn的pool，子程序會重新import呼叫端的
+__main__(pipeline -> util_aneurysm -> tensorflow/torch)，每個worker都要多花好幾秒跟好幾百MB。
+JPEG-LS編碼大多受限於硬碟跟記憶體頻寬，workers預設最多DEFAULT_WORKERS個，要更多請先量測MB/s再調高。
+
+@author: chuan
+"""
+import os
+import time
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pydicom
+from pydicom.uid import JPEGLSLossless
+
+SERIES = ['MRA_BRAIN', 'MIP_Pitch', 'MIP_Yaw']
+DEFAULT_WORKERS = 4
+
+
+def compress_one_jpegls(path_in, path_out):
+    """
+    壓縮單一dicom，先寫暫存檔再rename，壓到一半失敗不會留下壞檔
+    return: (原始檔大小, 壓縮後大小) bytes
+    """
+    dcm_slice = pydicom.dcmread(path_in)
+    #(0002,0003) Media Stored SOP Instance UID  [1.2.840.113619.2.260.6945.3202356.28278.1273105263.493]
+    SOPUID = dcm_slice[0x08, 0x0018].value #(0008,0018) SOP Instance UID
+    dcm_slice.compress(JPEGLSLossless)
+    dcm_slice[0x08, 0x0018].value = SOPUID
+
+    path_tmp = path_out + '.tmp'
+    try:
+        dcm_slice.save_as(path_tmp)
+        os.replace(path_tmp, path_out)
+    finally:
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+    return os.path.getsize(path_in), os.path.getsize(path_out)
+
+
+def default_workers():
+    return max(1, min(DEFAULT_WORKERS, os.cpu_count() or 1))
+
+
+def compress_series(path_dcm_in, path_dcm_out, series=SERIES, max_workers=None):
+    """
+    把path_dcm_in底下每個series壓成JPEG-LS lossless存到path_dcm_out，每個series印出MB/s
+    這支程序本身很輕，fork出worker就好
+    """
+    if max_workers is None:
+        max_workers = default_workers()
+
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork')) as executor:
+        for name in series:
+            os.makedirs(os.path.join(path_dcm_out, name), exist_ok=True)
+
+            #讀取dicom影像，然後轉成jpeglossless
+            start = time.time()
+            dcms = sorted(os.listdir(os.path.join(path_dcm_in, name)))
+            paths_in = [os.path.join(path_dcm_in, name, dcm) for dcm in dcms]
+            paths_out = [os.path.join(path_dcm_out, name, dcm) for dcm in dcms]
+            sizes = list(executor.map(compress_one_jpegls, paths_in, paths_out, chunksize=8))
+
+            size_in = sum(x[0] for x in sizes) / 1024 ** 2
+            size_out = sum(x[1] for x in sizes) / 1024 ** 2
+            spend = max(time.time() - start, 1e-6)
+            print(f"[Done JPEG-LS {name}] {len(dcms)} files, {size_in:.1f} MB -> {size_out:.1f} MB, "
+                  f"{size_in / spend:.1f} MB/s, workers {max_workers}")
+            logging.info(f"[Done JPEG-LS {name}] {len(dcms)} files, {size_in:.1f} MB -> {size_out:.1f} MB, "
+                         f"{size_in / spend:.1f} MB/s, workers {max_workers}")
+
+
+#其意義是「模組名稱」。如果該檔案是被引用，其值會是模組名稱；但若該檔案是(透過命令列)直接執行，其值會是 __main__；。
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path_dcm_in', type=str, help='要壓縮的dicom資料夾(底下是各series)')
+    parser.add_argument('path_dcm_out', type=str, help='壓縮後的輸出資料夾')
+    parser.add_argument('--workers', type=int, default=None, help=f'平行壓縮的process數，預設min({DEFAULT_WORKERS}, cpu數)')
+    parser.add_argument('--series', type=str, nargs='+', default=SERIES, help='要壓縮的series')
+    args = parser.parse_args()
+
+    compress_series(args.path_dcm_in, args.path_dcm_out, series=args.series, max_workers=args.workers)
@@ -35,6 +35,7 @@ import matplotlib.pyplot as plt
 import matplotlib
 import nibabel as nib
 import tensorflow as tf
+import torch
 from tensorflow.keras.models import Model
 import tensorflow.keras.backend as K
 from scipy import signal
@@ -47,7 +48,6 @@ from skimage.segmentation import watershed
 from scipy.ndimage import binary_fill_holes
 from scipy.ndimage import distance_transform_edt as dist_field
 from IPython.display import display, HTML
-from brainextractor import BrainExtractor
 import random
 from random import uniform
 import argparse
@@ -57,8 +57,13 @@ import psutil
 import pynvml #导包
 from collections import OrderedDict
 from nii_transforms import nii_img_replace
+from stage_trace import Tracer
+from brain_extraction import extract_brain_mask
+from brain_morphology import get_struc, modify_brain_mask
+from volume_io import read_image, read_label
+from mask_resample import mask_interpolation
 autotune = tf.data.experimental.AUTOTUNE
-from nnResUNet_long_BigBatch_cosine_AneDilate_classifier_test.gpu_nnUNet import predict_from_raw_data
+from nnResUNet_long_BigBatch_cosine_AneDilate_classifier_test.gpu_nnUNet import predict_from_raw_data, load_what_we_need
 
 # histogram
 def get_histogram_xy(arr, mask=None):
@@ -120,14 +125,6 @@ def custom_normalize_1(volume, mask=None, new_min=0., new_max=0.5, min_percentil
 #     new_volume = np.clip(new_volume, 0, 1)
     return new_volume
 
-def get_struc(diameter, spacing):  # diameter in mm
-    structure_size = np.round(diameter / np.array(spacing)).astype('int32')
-    structure_size = np.maximum([1,1,1], structure_size)
-    structure = resize_volume(ball(diameter*5), target_size=structure_size, dtype='bool')
-    center_point = np.array(structure.shape) // 2
-    structure[center_point] = True
-    return structure
-
 # resampling
 def resize_volume(arr, spacing=None, target_spacing=None, target_size=None, order=3, dtype='float32'):
     if ("int8" in dtype)or(dtype == "bool"):
@@ -149,66 +146,6 @@ def resize_volume(arr, spacing=None, target_spacing=None, target_size=None, orde
         out_vol = np.clip(out_vol, dtype_info.min, dtype_info.max)
     return out_vol.astype(dtype)
 
-# mask interpolation
-def mask_interpolation(mask, factor, **kwargs):
-    """ Resizing the mask through interpolation by building the distance field.
-        Randomly sampling factor and multi-categories are considered.
-        Implemented by Kuan (Kevin) Zhang, Ph.D., Radiology Informatics Laboratory, Mayo Clinic.
-
-        This implementation follows:
-        How to properly interpolate masks for deep learning in medical imaging?
-        Args:
-            mask (np.array): The initial mask matrix in the shape: (slices, x, y)
-            factor (tuple): The sampling factor of resizing in the shape: (fx, fy, fz)
-        Output:
-            The interpolated mask matrix to return.
-    """
-
-    # Check the number of mask types contained in the input.
-    mask_types = int(mask.max())
-
-    if mask_types > 1:
-        # Creat a list for the multi-category lables.
-        mask_mul = []
-        # Conver the mask values into binary for each type.
-        for i in range(mask_types):
-            mask_mul.append(np.where(mask == i+1,1,0))
-        mask_dist = mask_mul.copy()
-
-        for i in range(mask_types):
-            for z in range(mask.shape[-1]):
-                # The inner distance field to the edge:
-                dist_field_inner = ndi.distance_transform_edt(mask_mul[i][:,:,z])
-                # The outer distance field to the edge:
-                dist_field_outer = ndi.distance_transform_edt(np.logical_not(mask_mul[i][:,:,z]))
-                mask_dist[i][:,:,z] = dist_field_inner - dist_field_outer
-            mask_dist[i] = ndi.zoom(mask_dist[i], factor, order=1,
-                                    mode='grid-mirror', prefilter=True, grid_mode=False)
-
-        # Apply the threshold on the interpolated mask values.
-        # The threshold is set as 0.0.
-        mask_new = np.zeros(mask_dist[0].shape)
-
-        for i in range(mask_types):
-            mask_dist[i] = np.where(mask_dist[i] > 0., 1, 0)
-        m_index = np.any(np.array(mask_dist)!=0, axis=0)
-        mask_new[m_index] = np.argmax(np.array(mask_dist)[:,m_index],axis=0) + 1
-        return mask_new.astype(mask.dtype)
-
-    else:  # For the binary mask type.
-        mask_dist = np.zeros(mask.shape)
-
-        for z in range(mask.shape[-1]):
-            # The inner distance field to the edge:
-            dist_field_inner = ndi.distance_transform_edt(mask[:,:,z])
-            # The outer distance field to the edge:
-            dist_field_outer = ndi.distance_transform_edt(np.logical_not(mask[:,:,z]))
-            mask_dist[:,:,z] = dist_field_inner - dist_field_outer
-        mask_dist = ndi.zoom(mask_dist, factor, order=1,
-                             mode='grid-mirror', prefilter=True, grid_mode=False)
-        mask_new = np.where(mask_dist > 0., 1,0)
-        return mask_new.astype(mask.dtype)
-
 #@title Load image
 def load_volume(path_volume, im_only=False, squeeze=True, dtype=None, LPS_coor=True):
     """
@@ -228,10 +165,13 @@ def load_volume(path_volume, im_only=False, squeeze=True, dtype=None, LPS_coor=T
     if path_volume.endswith(('.nii', '.nii.gz', '.mgz')):
         x = nib.load(path_volume)
         x = nib.as_closest_canonical(x)  # to RAS space
-        if squeeze:
-            volume = np.squeeze(x.get_fdata())
+        # 整數型態直接讀原始資料，其他用float32，都不經過get_fdata()的float64
+        if (dtype is not None) and ('int' in dtype):
+            volume = read_label(x, dtype=dtype)
         else:
-            volume = x.get_fdata()
+            volume = read_image(x, dtype=np.float32)
+        if squeeze:
+            volume = np.squeeze(volume)
         aff = x.affine
         header = x.header
         spacing = list(x.header.get_zooms())
@@ -245,7 +185,7 @@ def load_volume(path_volume, im_only=False, squeeze=True, dtype=None, LPS_coor=T
     if dtype is not None:
         if 'int' in dtype:
             volume = np.round(volume)
-        volume = volume.astype(dtype=dtype)
+        volume = volume.astype(dtype=dtype, copy=False)
     if LPS_coor:
         volume = volume[::-1,::-1,:]
 
@@ -344,46 +284,11 @@ def get_brain_seg(image_arr, spacing, model0):
     return brain_seg
 
 #@title BET (w/ isotropic(spacing-z, spacing-z, spacing-z) vol)
-def get_BET_brain_mask(image_arr, spacing, bet_iter=1000, pad=32):
-    # resize to isotropic
-    target_spacing = np.array([spacing[2], spacing[2], spacing[2]], dtype=np.float32)
-    print("BET target_spacing =", target_spacing)
-    image_iso = resize_volume(image_arr, spacing, target_spacing=target_spacing, order=0, dtype='int16')
-
-    pv = np.percentile(image_iso.ravel(), 15)
-    print("pad value =", pv)
-    image_iso = np.pad(image_iso, ((pad,pad),(pad,pad),(pad,pad)), 'constant', constant_values=pv)  # minimum, mean
-
-    # nibabel obj
-    affine = np.array([ [target_spacing[0], 0, 0, 0],
-                        [0, target_spacing[1], 0, 0],
-                        [0, 0, target_spacing[2], 0],
-                        [0, 0, 0, 1]], dtype=np.float32)
-    nib_image = nib.Nifti1Image(image_iso[::-1, ::-1, :], affine=affine)  # LPS to RAS orientation
-
-    # BET process
-    bet = BrainExtractor(img=nib_image)
-    bet.run(iterations=bet_iter)
-    brain_mask_iso = bet.compute_mask()[::-1, ::-1, :] > 0  # RAS to LPS orientation
-    brain_mask_iso = brain_mask_iso[pad:-pad, pad:-pad, pad:-pad]
-
-    # back to original spacing
-    brain_mask = resize_volume(brain_mask_iso, target_size=image_arr.shape, dtype='bool')
-    return brain_mask
-
-#@title modify brain mask
-def modify_brain_mask(brain_mask, spacing, verbose=False):
-    # merge and modify brain mask
-    if verbose: print(">>> modify_brain_mask ", end='')
-    brain_mask = binary_dilation(brain_mask, get_struc(8, spacing))
-    if verbose: print(".", end='')
-    brain_mask = binary_fill_holes(brain_mask)
-    if verbose: print(".", end='')
-    brain_mask = binary_erosion(brain_mask, get_struc(14, spacing).sum(axis=2, keepdims=True).astype(bool))  # 12
-    if verbose: print(".", end='')
-    brain_mask = binary_opening(brain_mask, get_struc(14, spacing).sum(axis=2, keepdims=True).astype(bool))
-    if verbose: print(">>>", brain_mask.shape)
-    return brain_mask
+def get_BET_brain_mask(image_arr, spacing, bet_iter=1000, pad=32, backend='bet', brain_seg=None, cache_dir=None):
+    #實作在brain_extraction，backend='synthseg'改由SynthSeg腦部分割推得(要給brain_seg)，cache_dir有給就依影像內容hash快取
+    if backend == 'bet':
+        return extract_brain_mask(image_arr, spacing, backend='bet', cache_dir=cache_dir, bet_iter=bet_iter, pad=pad)
+    return extract_brain_mask(image_arr, spacing, backend=backend, brain_seg=brain_seg, cache_dir=cache_dir)
 
 #@title threshold segmentation algorithm
 class VesselSegmenter(object):
@@ -511,39 +416,45 @@ def run_model1(x, model1, importance_map, **kwargs):
 #@title model predict vessel
 def predict_vessel(image_arr, brain_mask,
                    model1, patch_size=(64, 64, 32), sigma=0.125, n_class=1, overlap=0.5, conf_th=0.1,
-                   verbose=False):
+                   batch_size=16, verbose=False):
 
-    def sliding_window_inference1(inputs, roi_size, model, overlap, n_class, importance_map, strategy="overlap_inside", mask=None, **kwargs):
-        image_size = tuple(inputs.shape[1:-1])
+    def sliding_window_inference1(inputs, roi_size, model, overlap, n_class, importance_map, strategy="overlap_inside", mask=None, batch_size=16):
+        # inputs: (X,Y,Z) numpy，patch收集成batch推論後直接就地累加到預先配置的sum/weight buffer，
+        # 不再每個window都tf.pad回整個volume，累加順序跟原本逐window相同，float32結果一致
+        image_size = tuple(inputs.shape)
         roi_size = tuple(roi_size)
         # Padding to make sure that the image size is at least roi size
         padded_image_size = tuple(max(image_size[i], roi_size[i]) for i in range(3))
-        padding_size = [image_x - input_x for image_x, input_x in zip(image_size, padded_image_size)]
-        paddings = [[0, 0]] + [[x // 2, x - x // 2] for x in padding_size] + [[0, 0]]
-        input_padded = tf.pad(inputs, paddings)
+        padding_size = [image_x - input_x for image_x, input_x in zip(padded_image_size, image_size)]
+        paddings = [[x // 2, x - x // 2] for x in padding_size]
+        input_padded = np.pad(inputs.astype(np.float32, copy=False), paddings)
         if mask is not None:
-            mask_padded = tf.pad(tf.convert_to_tensor(mask, dtype=tf.bool), paddings)
+            mask_padded = np.pad(mask.astype(bool), paddings)
 
-        output_shape = (1, *padded_image_size, n_class)
-        output_sum = tf.zeros(output_shape, dtype=tf.float32)
-        output_weight_sum = tf.zeros(output_shape, dtype=tf.float32)
+        output_sum = np.zeros((*padded_image_size, n_class), dtype=np.float32)
+        output_weight_sum = np.zeros((*padded_image_size, n_class), dtype=np.float32)
+        weight = importance_map.numpy()[0]  # (x,y,z,n_class)
         window_slices = get_window_slices(padded_image_size, roi_size, overlap, strategy)
 
-        for i, window_slice in enumerate(window_slices):
-            if (mask is None) or ((mask is not None)and(tf.math.reduce_any(tf.slice(mask_padded, begin=window_slice[0], size=window_slice[1])))):
-                window = tf.slice(input_padded, begin=window_slice[0], size=window_slice[1])
-                pred = run_model1(window, model, importance_map, **kwargs)
-                padding = [
-                    [start, output_size - (start + size)] for start, size, output_size in zip(*window_slice, output_shape)
-                ]
-                padding = padding[:-1] + [[0, 0]]
-                output_sum = output_sum + tf.pad(pred, padding)
-                output_weight_sum = output_weight_sum + tf.pad(importance_map, padding)
-            if verbose:
-                if i % 100 == 0: print('.', end='')
-
-        output = output_sum / tf.clip_by_value(output_weight_sum, 1, 256)
-        crop_slice = [slice(pad[0], pad[0] + input_x) for pad, input_x in zip(paddings, inputs.shape[:-1])]
+        # 只留有brain mask的window，順序不變
+        window_starts = []
+        for window_slice in window_slices:
+            start = window_slice[0][1:4]
+            sl = tuple(slice(st, st + r) for st, r in zip(start, roi_size))
+            if (mask is None) or mask_padded[sl].any():
+                window_starts.append(sl)
+
+        for b in range(0, len(window_starts), batch_size):
+            batch_slices = window_starts[b:b + batch_size]
+            batch = np.stack([input_padded[sl] for sl in batch_slices], axis=0)[..., np.newaxis]
+            preds = run_model_batch(tf.convert_to_tensor(batch), model, importance_map).numpy()
+            for j, sl in enumerate(batch_slices):
+                output_sum[sl] += preds[j]
+                output_weight_sum[sl] += weight
+            if verbose: print('.', end='')
+
+        output = output_sum / np.clip(output_weight_sum, 1, 256)
+        crop_slice = tuple(slice(pad[0], pad[0] + input_x) for pad, input_x in zip(paddings, image_size))
         return output[crop_slice]
 
     # prepare importance_map
@@ -553,11 +464,11 @@ def predict_vessel(image_arr, brain_mask,
     importance_kernel = get_importance_kernel(patch_size, blend_mode="gaussian", sigma=sigma)
     importance_map = tf.tile(tf.reshape(importance_kernel, shape=[1, *patch_size, 1]), multiples=[1, 1, 1, 1, n_class],)
     # sliding_window_inference
-    vessel_conf = sliding_window_inference1(inputs=image_arr[np.newaxis,:,:,:,np.newaxis],
+    vessel_conf = sliding_window_inference1(inputs=image_arr,
                                             roi_size=patch_size, model=model1, overlap=overlap,
                                             n_class=n_class, importance_map=importance_map,
-                                            mask=brain_mask[np.newaxis,:,:,:,np.newaxis])
-    vessel_conf = vessel_conf[0,:,:,:,0].numpy()
+                                            mask=brain_mask, batch_size=batch_size)
+    vessel_conf = vessel_conf[:,:,:,0]
 
     if verbose: print(">>>", vessel_conf.shape)
     return vessel_conf > conf_th
@@ -617,18 +528,31 @@ def get_vessel_skeleton_labels(vessel_mask, spacing):
 def predict_vessel_16labels(vessel_mask, model3, spacing, post_proc=True, min_size=3, verbose=False):
 
     def find_end_points(skeleton_mask):
+        # 3x3x3鄰居數(含自己)用一次convolution算完: 3 line, 2 end point, >3 branch point
+        skeleton_mask = skeleton_mask.astype(bool)
+        n_neighbors = ndi.convolve(skeleton_mask.astype('uint8'), np.ones((3, 3, 3), dtype='uint8'), mode='constant', cval=0)
+        # 原本逐點切patch時，index 0的切片[-1:2]是空的(sum=0)，這邊保留一樣的行為
+        n_neighbors[0, :, :] = 0
+        n_neighbors[:, 0, :] = 0
+        n_neighbors[:, :, 0] = 0
         ends_map = np.zeros(skeleton_mask.shape, dtype='uint8')
-        centers = np.stack(np.where(skeleton_mask), axis=-1)
-        for center in centers:
-            patch = skeleton_mask[center[0]-1:center[0]+2, center[1]-1:center[1]+2, center[2]-1:center[2]+2]
-            if np.sum(patch) == 3:  # line
-                ends_map[center[0], center[1], center[2]] = 1
-            elif np.sum(patch) == 2:  # end point
-                ends_map[center[0], center[1], center[2]] = 2
-            elif np.sum(patch) > 3:  # branch point
-                ends_map[center[0], center[1], center[2]] = 6
+        ends_map[skeleton_mask & (n_neighbors == 3)] = 1  # line
+        ends_map[skeleton_mask & (n_neighbors == 2)] = 2  # end point
+        ends_map[skeleton_mask & (n_neighbors > 3)] = 6  # branch point
         return ends_map
 
+    def fragments_majority_label(fragments, preds, n_fragments, min_size):
+        # 每個fragment內preds(>0)各label的數量一次bincount完，取數量>min_size中最多的label(同數量取較小label，同np.unique+argmax)
+        n_labels = int(preds.max()) + 1
+        valid = (fragments > 0) & (fragments < n_fragments) & (preds > 0)
+        counts = np.bincount(fragments[valid].astype(np.int64) * n_labels + preds[valid],
+                             minlength=(n_fragments + 1) * n_labels).reshape(n_fragments + 1, n_labels)
+        counts[counts <= min_size] = 0
+        lut = np.argmax(counts, axis=1).astype('uint8')
+        lut[counts.max(axis=1) == 0] = 0
+        lut[0] = 0
+        return lut
+
     def crop_resample(arr, spacing, target_shape=(160, 160, 160)):
         arr = resize_volume(arr, spacing=spacing, target_spacing=(0.8, 0.8, 0.8), dtype='uint8')
         zd = np.ceil(max(0, target_shape[2] - arr.shape[2])).astype('int32')
@@ -672,16 +596,9 @@ def predict_vessel_16labels(vessel_mask, model3, spacing, post_proc=True, min_si
         distance = ndi.distance_transform_edt(vessel_mask, sampling=spacing)
         fragments = watershed(-distance, fragments_markers, mask=vessel_mask)
 
-        markers = np.zeros_like(fragments_markers, dtype="uint8")
-        for idx in range(1, fragments_markers.max()):
-            masked_pred = preds[fragments==idx]
-            unique, counts = np.unique(masked_pred[masked_pred > 0], return_counts=True)
-            filter_idx = np.where(counts > min_size)[0]
-            unique, counts = unique[filter_idx], counts[filter_idx]
-            if len(unique) > 0:
-                markers[fragments_markers==idx] = unique[np.argmax(counts)]
-            if verbose:
-                if idx % 50 == 0: print(".", end='')
+        # 跟原本range(1, fragments_markers.max())一樣，不含最大的fragment編號
+        lut = fragments_majority_label(fragments, preds, int(fragments_markers.max()), min_size)
+        markers = lut[fragments_markers]
         # watershed vessels
         vessel_16labels = watershed(-distance, markers, mask=vessel_mask)
         vessel_16labels[vessel_16labels==18] = 0  # exclude
@@ -785,13 +702,9 @@ def predict_aneurysm(image_arr, brain_mask, vessel_16labels, spacing,
     pred_prob_map = resize_volume(pred_prob_map, target_size=image_arr.shape, dtype='float32')
 
     # object_analysis
-    pred_label = label(pred_prob_map > conf_th)
+    pred_label, n_labels = label(pred_prob_map > conf_th, return_num=True)
     # pred_label measurement
-    props = regionprops_table(pred_label, pred_prob_map, properties=('label', 'bbox', 'intensity_max', 'intensity_mean'))
-    df_pred = pd.DataFrame({'ori_Pred_label':props['label'],
-                            'Pred_diameter':((props['bbox-3']-props['bbox-0'])*spacing[0] + (props['bbox-4']-props['bbox-1'])*spacing[1]) / 2,
-                            'Pred_max':props['intensity_max'],
-                            'Pred_mean':props['intensity_mean'],})
+    df_pred = component_stats(pred_label, n_labels, pred_prob_map, spacing)
     # sort and false-positive filtering
     df_pred = df_pred.sort_values(by='Pred_max', ascending=False)
     df_pred = df_pred[df_pred['Pred_diameter'] >= min_diameter]  # object size filter
@@ -799,9 +712,7 @@ def predict_aneurysm(image_arr, brain_mask, vessel_16labels, spacing,
     df_pred = df_pred[df_pred['Pred_max'] >= obj_th]  # object filter
     # remap pred_label array
     df_pred['Pred_label'] = np.arange(1, df_pred.shape[0]+1)
-    new_pred_label = np.zeros_like(pred_label)
-    for k, v in zip(df_pred['ori_Pred_label'].values, df_pred['Pred_label'].values):
-        new_pred_label[pred_label==k] = v
+    new_pred_label = relabel_components(pred_label, n_labels, df_pred['ori_Pred_label'].values, df_pred['Pred_label'].values)
 
     # get object location
 #     if vessel_16labels.max() > 7:  # QC of vessel_16labels
@@ -969,7 +880,7 @@ def save_nii(path_process, brain_mask, pred_vessel, vessel_16labels, pred_label,
     #nib.save(img, f"{out_dir}/image.nii.gz")
     #print("[save] --->", f"{out_dir}/image.nii.gz")
     if verbose:
-        image_arr = img.get_fdata().astype('int16')
+        image_arr = read_label(img, dtype='int16')
         print(f"shape={shape} spacing={spacing}  {image_arr.dtype}:{image_arr.min()}-{image_arr.max()}")
         print("affine matrix =\n", aff)
 
@@ -1003,25 +914,25 @@ def save_nii(path_process, brain_mask, pred_vessel, vessel_16labels, pred_label,
     # build NifTi1 image
     pred_vessel = pred_vessel[::-1, ::-1, :].astype('uint8')  # LPS to RAS orientation
     x = nib.nifti1.Nifti1Image(pred_vessel, affine=aff)
-    nib.save(x, f"{out_dir}/Vessel.nii.gz")
+    save_nii_atomic(x, f"{out_dir}/Vessel.nii.gz")
     print("[save] --->", f"{out_dir}/Vessel.nii.gz")
 
     # pred_vessel_16labels
     vessel_16labels = vessel_16labels[::-1, ::-1, :].astype('uint8')  # LPS to RAS orientation
     x = nib.nifti1.Nifti1Image(vessel_16labels, affine=aff)
-    nib.save(x, f"{out_dir}/Vessel_16.nii.gz")
+    save_nii_atomic(x, f"{out_dir}/Vessel_16.nii.gz")
     print("[save] --->", f"{out_dir}/Vessel_16.nii.gz")
 
     ## pred_label
     pred_label = pred_label[::-1, ::-1, :].astype('uint8')  # LPS to RAS orientation
     x = nib.nifti1.Nifti1Image(pred_label, affine=aff)
-    nib.save(x, f"{out_dir}/Pred.nii.gz")
+    save_nii_atomic(x, f"{out_dir}/Pred.nii.gz")
     print("[save] --->", f"{out_dir}/Pred.nii.gz")
     
     #存出predict map
     pred_prob_map = pred_prob_map[::-1, ::-1, :]  # LPS to RAS orientation
     x = nib.nifti1.Nifti1Image(pred_prob_map, affine=aff)
-    nib.save(x, f"{out_dir}/Prob.nii.gz")
+    save_nii_atomic(x, f"{out_dir}/Prob.nii.gz")
     print("[save] --->", f"{out_dir}/Prob.nii.gz")
     return 
 
@@ -1067,26 +978,49 @@ def save_nii_preprocess(path_process, image_arr, pred_vessel, vessel_16labels, o
     x = nib.nifti1.Nifti1Image(pred_vessel, affine=aff, header=hdr)
     nib.save(x, os.path.join(out_dir, 'Vessel', 'DeepAneurysm_00001_0000.nii.gz'))
     print("[save] --->", os.path.join(out_dir, 'Vessel', 'DeepAneurysm_00001_0000.nii.gz'))
-    nib.save(x, f"{out_dir}/Vessel.nii.gz")
+    save_nii_atomic(x, f"{out_dir}/Vessel.nii.gz")
     print("[save] --->", f"{out_dir}/Vessel.nii.gz")
 
     # pred_vessel_16labels
     vessel_16labels = vessel_16labels[::-1, ::-1, :].astype('uint8')  # LPS to RAS orientation
     x = nib.nifti1.Nifti1Image(vessel_16labels, affine=aff, header=hdr)
-    nib.save(x, f"{out_dir}/Vessel_16.nii.gz")
+    save_nii_atomic(x, f"{out_dir}/Vessel_16.nii.gz")
     print("[save] --->", f"{out_dir}/Vessel_16.nii.gz")
     return 
 
 #篩選掉threshold不到的動脈瘤
+#一次label後用bincount/find_objects算出所有component的統計量，成本跟component數量無關
+def component_stats(pred_label, n_labels, intensity, spacing):
+    """
+    pred_label: label()的輸出(0為背景)，n_labels: component數量
+    回傳欄位同原本regionprops_table + DataFrame的結果: ori_Pred_label, Pred_diameter, Pred_max, Pred_mean
+    """
+    labels_flat = pred_label.ravel()
+    index = np.arange(1, n_labels + 1)
+    sizes = np.bincount(labels_flat, minlength=n_labels + 1)[1:]
+    sums = np.bincount(labels_flat, weights=intensity.ravel(), minlength=n_labels + 1)[1:]
+    maxs = ndi.maximum(intensity, labels=pred_label, index=index) if n_labels > 0 else np.zeros(0)
+    # bbox: find_objects的slice等同regionprops的bbox(min, max+1)
+    extent = np.zeros((n_labels, 2))
+    for i, sl in enumerate(ndi.find_objects(pred_label, max_label=n_labels)):
+        if sl is not None:
+            extent[i] = [sl[0].stop - sl[0].start, sl[1].stop - sl[1].start]
+    return pd.DataFrame({'ori_Pred_label': index,
+                         'Pred_diameter': (extent[:, 0] * spacing[0] + extent[:, 1] * spacing[1]) / 2,
+                         'Pred_max': np.asarray(maxs, dtype=intensity.dtype),
+                         'Pred_mean': sums / np.maximum(sizes, 1)})
+
+#保留的component用lookup table一次重新編號
+def relabel_components(pred_label, n_labels, ori_labels, new_labels):
+    lut = np.zeros(n_labels + 1, dtype=pred_label.dtype)
+    lut[np.asarray(ori_labels, dtype=int)] = np.asarray(new_labels, dtype=int)
+    return lut[pred_label]
+
 def filter_aneurysm(pred_prob_map, spacing, conf_th=0.1, min_diameter=2, top_k=4, obj_th=0.67):
     # object_analysis
-    pred_label = label(pred_prob_map > conf_th)
+    pred_label, n_labels = label(pred_prob_map > conf_th, return_num=True)
     # pred_label measurement，取得pred的各種屬性數值，例如intensity_max, intensity_max
-    props = regionprops_table(pred_label, pred_prob_map, properties=('label', 'bbox', 'intensity_max', 'intensity_mean'))
-    df_pred = pd.DataFrame({'ori_Pred_label':props['label'],
-                            'Pred_diameter':((props['bbox-3']-props['bbox-0'])*spacing[0] + (props['bbox-4']-props['bbox-1'])*spacing[1]) / 2,
-                            'Pred_max':props['intensity_max'],
-                            'Pred_mean':props['intensity_mean'],})
+    df_pred = component_stats(pred_label, n_labels, pred_prob_map, spacing)
     
     df_pred = df_pred[(df_pred['Pred_diameter'] >= min_diameter)]  # filter too small object
     df_pred = df_pred.sort_values(by='Pred_max', ascending=False) #用最大強度來排序
@@ -1095,9 +1029,7 @@ def filter_aneurysm(pred_prob_map, spacing, conf_th=0.1, min_diameter=2, top_k=4
         df_pred = df_pred[:top_k]  # top_k filter
     df_pred = df_pred[df_pred['Pred_max'] >= obj_th]  # object filter
     # remap pred_label array
-    new_pred_label = np.zeros_like(pred_label)
-    for k, v in zip(df_pred['ori_Pred_label'].values, df_pred['Pred_label'].values):
-        new_pred_label[pred_label==k] = v
+    new_pred_label = relabel_components(pred_label, n_labels, df_pred['ori_Pred_label'].values, df_pred['Pred_label'].values)
         
     return pred_prob_map, df_pred, new_pred_label.astype(int)
 
@@ -1132,11 +1064,98 @@ def nii_img_replace(data, new_img):
     return new_nii
 
 
+#先寫到同資料夾的暫存檔再os.replace，被hard link到nii/、output的舊檔案不會被就地覆寫，讀的一方也不會讀到寫一半的檔案
+def save_nii_atomic(img, path):
+    path_tmp = path[:-len('.nii.gz')] + '.tmp.nii.gz'
+    nib.save(img, path_tmp)
+    os.replace(path_tmp, path)
+    return path
+
+def copy_atomic(src, dst):
+    dst_tmp = dst + '.tmp'
+    shutil.copy(src, dst_tmp)
+    os.replace(dst_tmp, dst)
+    return dst
+
+
 #"主程式"
 #model_predict_aneurysm(path_code, path_process, case_name, path_log, gpu_n)
-def model_predict_aneurysm(path_code, path_process, path_nnunet_model, case_name, path_log, gpu_n):
+def setup_tf_gpu(gpu_n):
+    #指定gpu並開memory growth，TF初始化後就不能再改，常駐worker重複呼叫時直接略過，gpu_n < 0 代表只用CPU
+    gpus = tf.config.experimental.list_physical_devices(device_type='GPU')
+    if len(gpus) == 0:
+        return
+    if gpu_n < 0:
+        try:
+            tf.config.experimental.set_visible_devices([], device_type='GPU')
+        except RuntimeError:
+            pass
+        return
+    try:
+        tf.config.experimental.set_visible_devices(devices=gpus[gpu_n], device_type='GPU')
+        tf.config.experimental.set_memory_growth(gpus[gpu_n], True)
+    except RuntimeError:
+        pass
+
+
+def load_aneurysm_models(path_code):
+    #讀取4個tensorflow SavedModel，回傳dict讓常駐worker只載入一次
     path_model = os.path.join(path_code, 'model_weights')
 
+    #@title load SynthSeg base model
+    #model_root = '/content/gdrive/Shareddrives/2024_雙和_Aneurysm/code/SynthSeg_inference'  # google drive
+    model_root = os.path.join(path_model, 'SynthSeg_inference')
+    # model_root = 'SynthSeg_inference'  # server
+    # load model0 (unet2)
+    model0 = tf.saved_model.load(f"{model_root}/saved_model/net_unet2")
+    model0.trainable = False
+    model0.jit_compile = True
+
+    #@title load vessel seg model
+    #model_root = '/content/gdrive/Shareddrives/2024_雙和_Aneurysm/model/dataV2-brain_vessel-PosSample-ResUnet'  # google drive
+    model_root = os.path.join(path_model, 'dataV2-brain_vessel-PosSample-ResUnet')
+    # model_root = '../model/dataV2-brain_vessel-PosSample-ResUnet'  # server
+    model_name = "MP-CustomNorm1-vessel_sampling_pos.9_64x64x32_b1x48-ResUnet_F32L4BN_mish_1ch-BCE_dice_ema" #我有改短名稱
+    model1 = tf.saved_model.load(f"{model_root}/{model_name}/best_saved_model")
+    model1.trainable = False
+    model1.jit_compile = True
+
+    #@title load vessel 16labels model
+    #model_root = '/content/gdrive/Shareddrives/2024_雙和_Aneurysm/model/dataV2-Vessel_16label-ResUnet'  # google drive
+    model_root = os.path.join(path_model, 'dataV2-Vessel_16label-ResUnet')
+    # model_root = '../model/dataV2-Vessel_16label-ResUnet'  # server
+    model_name = "MP-Vessel_16label+branch_PostProc2AIAA_Aug2of4_160_b4-ResUnet_8f_L5_BN_mish_19ch_ema_cw" #我有改短名稱
+    model3 = tf.saved_model.load(f"{model_root}/{model_name}/best_saved_model")
+    model3.trainable = False
+    model3.jit_compile = True
+
+    #@title load aneurysm seg model
+    #model_root = '/content/gdrive/Shareddrives/2024_雙和_Aneurysm/model/aneurysm_seg_model_v3-restart'  # google drive
+    model_root = os.path.join(path_model, 'aneurysm_seg_model_v3-restart')
+    # model_root = "../model/aneurysm_seg_model_v3-restart"  # server
+    model_name = "MP-FEMHv3_SHHv3_P3_iso-b8-FCresunet32-px_size_sw-Adam1E4_ema"  # iso
+    model2 = tf.saved_model.load(f"{model_root}/{model_name}/best_saved_model")
+    model2.trainable = False
+    model2.jit_compile = True
+
+    return {'model0': model0, 'model1': model1, 'model2': model2, 'model3': model3}
+
+
+def load_aneurysm_nnunet_models(path_nnunet_model, use_folds=(13,), checkpoint_name='checkpoint_best.pth',
+                                plans_json_name='nnUNetPlans_5L-b900.json'):
+    #讀取nnU-Net fold權重跟網路架構，可直接傳給predict_from_raw_data(preloaded_models=...)
+    return load_what_we_need(path_nnunet_model, use_folds, checkpoint_name, plans_json_name)
+
+
+def model_predict_aneurysm(path_code, path_process, path_nnunet_model, case_name, path_log, gpu_n,
+                           models=None, nnunet_models=None, check_gpu_memory=True, brain_backend='bet',
+                           morph_method='ball'):
+    #models/nnunet_models為None時照舊每次載入，常駐worker(gpu_aneurysm_worker.py)會傳入已載入的模型
+    #gpu_n < 0 時整個inference在CPU上跑；check_gpu_memory=False 給已經依記憶體預算排程過的job_queue使用，不再用60%的門檻擋掉
+    #brain_backend: 預設'bet'照舊跑BrainExtractor；'synthseg'從SynthSeg腦部分割推得BET遮罩(快)，還沒跟BET做過Dice驗證，要手動指定
+    #結果快取在path_process上一層的brain_mask_cache
+    #morph_method: modify_brain_mask的形態學，預設'ball'照舊；'edt'(distance transform，快)跟ball的Dice約0.97，還沒驗證對偵測的影響，要手動指定
+
     #以log紀錄資訊，先建置log
     localt = time.localtime(time.time()) # 取得 struct_time 格式的時間
     #以下加上時間註記，建立唯一性
@@ -1165,6 +1184,10 @@ def model_predict_aneurysm(path_code, path_process, path_nnunet_model, case_name
         with open(json_file_path, 'w', encoding='utf8') as json_file:
             json.dump(json_dict, json_file, sort_keys=False, indent=2, separators=(',', ': '), ensure_ascii=False) #讓json能中文顯示
 
+    #stage span寫到trace jsonl，由pipeline_aneurysm呼叫時會接在它的inference span底下
+    tracer = Tracer.from_env(os.path.join(path_log, 'trace_' + time_str_short + '.jsonl'), case=case_name)
+    tracer.start('model_predict_aneurysm', gpu_n=gpu_n)
+
     try:
         logging.info('!!! ' + case_name + ' gpu_aneurysm call.')
 
@@ -1174,10 +1197,12 @@ def model_predict_aneurysm(path_code, path_process, path_nnunet_model, case_name
         msg = "ok" #描述狀態訊息
         
         #%% Deep learning相關
-        pynvml.nvmlInit() #初始化
-        handle = pynvml.nvmlDeviceGetHandleByIndex(gpu_n)#获取GPU i的handle，后续通过handle来处理
-        memoryInfo = pynvml.nvmlDeviceGetMemoryInfo(handle)#通过handle获取GPU i的信息
-        gpumRate = memoryInfo.used/memoryInfo.total
+        gpumRate = 0
+        if check_gpu_memory and gpu_n >= 0:
+            pynvml.nvmlInit() #初始化
+            handle = pynvml.nvmlDeviceGetHandleByIndex(gpu_n)#获取GPU i的handle，后续通过handle来处理
+            memoryInfo = pynvml.nvmlDeviceGetMemoryInfo(handle)#通过handle获取GPU i的信息
+            gpumRate = memoryInfo.used/memoryInfo.total
         #print('gpumRate:', gpumRate) #先設定gpu使用率小於0.2才跑predict code
     
         if gpumRate < 0.6 :
@@ -1186,11 +1211,7 @@ def model_predict_aneurysm(path_code, path_process, path_nnunet_model, case_name
             autotune = tf.data.experimental.AUTOTUNE
             #print(keras.__version__)
             #print(tf.__version__)
-            gpus = tf.config.experimental.list_physical_devices(device_type='GPU')
-            cpus = tf.config.experimental.list_physical_devices(device_type='CPU')
-            tf.config.experimental.set_visible_devices(devices=gpus[gpu_n], device_type='GPU')
-            #print(gpus, cpus)
-            tf.config.experimental.set_memory_growth(gpus[0],True)
+            setup_tf_gpu(gpu_n)
 
             #%%
             #底下正式開始predict任務
@@ -1198,69 +1219,50 @@ def model_predict_aneurysm(path_code, path_process, path_nnunet_model, case_name
             MRA_BRAIN_file = os.path.join(path_process, 'MRA_BRAIN.nii.gz')
 
             # 1 load image
+            span = tracer.start('load_image')
             image_arr, spacing, _ = load_volume(MRA_BRAIN_file, dtype='int16')
+            tracer.end(span.add_array('image', image_arr))
 
             # 1.5 load synthseg model
-            #@title load SynthSeg base model
-            #model_root = '/content/gdrive/Shareddrives/2024_雙和_Aneurysm/code/SynthSeg_inference'  # google drive
-            model_root = os.path.join(path_model, 'SynthSeg_inference')
-            # model_root = 'SynthSeg_inference'  # server
-            # load model0 (unet2)
-            model0 = tf.saved_model.load(f"{model_root}/saved_model/net_unet2")
-            model0.trainable = False
-            model0.jit_compile = True
-
-            #@title load vessel seg model
-            #model_root = '/content/gdrive/Shareddrives/2024_雙和_Aneurysm/model/dataV2-brain_vessel-PosSample-ResUnet'  # google drive
-            model_root = os.path.join(path_model, 'dataV2-brain_vessel-PosSample-ResUnet')
-            # model_root = '../model/dataV2-brain_vessel-PosSample-ResUnet'  # server
-            model_name = "MP-CustomNorm1-vessel_sampling_pos.9_64x64x32_b1x48-ResUnet_F32L4BN_mish_1ch-BCE_dice_ema" #我有改短名稱
-            model1 = tf.saved_model.load(f"{model_root}/{model_name}/best_saved_model")
-            model1.trainable = False
-            model1.jit_compile = True
-
-            #@title load vessel 16labels model
-            #model_root = '/content/gdrive/Shareddrives/2024_雙和_Aneurysm/model/dataV2-Vessel_16label-ResUnet'  # google drive
-            model_root = os.path.join(path_model, 'dataV2-Vessel_16label-ResUnet')
-            # model_root = '../model/dataV2-Vessel_16label-ResUnet'  # server
-            model_name = "MP-Vessel_16label+branch_PostProc2AIAA_Aug2of4_160_b4-ResUnet_8f_L5_BN_mish_19ch_ema_cw" #我有改短名稱
-            model3 = tf.saved_model.load(f"{model_root}/{model_name}/best_saved_model")
-            model3.trainable = False
-            model3.jit_compile = True
-
-            #@title load aneurysm seg model
-            #model_root = '/content/gdrive/Shareddrives/2024_雙和_Aneurysm/model/aneurysm_seg_model_v3-restart'  # google drive
-            model_root = os.path.join(path_model, 'aneurysm_seg_model_v3-restart')
-            # model_root = "../model/aneurysm_seg_model_v3-restart"  # server
-            model_name = "MP-FEMHv3_SHHv3_P3_iso-b8-FCresunet32-px_size_sw-Adam1E4_ema"  # iso
-            model2 = tf.saved_model.load(f"{model_root}/{model_name}/best_saved_model")
-            model2.trainable = False
-            model2.jit_compile = True
+            span = tracer.start('load_models', preloaded=models is not None)
+            if models is None:
+                models = load_aneurysm_models(path_code)
+            model0, model1, model2, model3 = models['model0'], models['model1'], models['model2'], models['model3']
+            tracer.end(span)
 
             # 2 Get brain mask，先全照君彥pipeline，來不及拉!!!
+            span = tracer.start('brain_mask', backend=brain_backend, morph_method=morph_method)
             brain_seg = get_brain_seg(image_arr, spacing, model0)
             brain_bottom_idx = np.where(np.any(brain_seg > 0, axis=(0,1)))[0][0]
             bet_brain_mask = np.zeros_like(image_arr, dtype=bool)
-            bet_brain_mask[:,:,brain_bottom_idx:] = get_BET_brain_mask(image_arr[:,:,brain_bottom_idx:], spacing, bet_iter=1000)
-            brain_mask = modify_brain_mask((brain_seg > 0)|(bet_brain_mask), spacing, verbose=verbose)
+            bet_brain_mask[:,:,brain_bottom_idx:] = get_BET_brain_mask(image_arr[:,:,brain_bottom_idx:], spacing, bet_iter=1000,
+                                                                       backend=brain_backend, brain_seg=brain_seg[:,:,brain_bottom_idx:],
+                                                                       cache_dir=os.path.join(os.path.dirname(os.path.normpath(path_process)), 'brain_mask_cache'))
+            brain_mask = modify_brain_mask((brain_seg > 0)|(bet_brain_mask), spacing, verbose=verbose, method=morph_method)
             del brain_seg, bet_brain_mask
+            tracer.end(span.add_array('brain_mask', brain_mask))
                 
             # 3 Get vessel mask
+            span = tracer.start('vessel_mask')
             vessel_threshold, _ = VesselSegmenter().threshold_segmentation(image_arr, brain_mask, spacing)
             vessel_seed = get_vessel_seed(vessel_threshold, mask=brain_mask, spacing=spacing)
             pred_vessel_mask = predict_vessel(image_arr, brain_mask, model1, verbose=verbose)
             vessel_mask = combine_two_vessels(vessel_threshold, pred_vessel_mask, seed_mask=vessel_seed, brain_mask=brain_mask)
             del vessel_threshold, vessel_seed, pred_vessel_mask, brain_bottom_idx
+            tracer.end(span.add_array('vessel_mask', vessel_mask))
 
             # 3.5 Get vessel skeleton
             #skeleton_labels = get_vessel_skeleton_labels(vessel_mask, spacing)
 
             # 4 get vessel 16labels
+            span = tracer.start('vessel_16labels')
             vessel_16labels = predict_vessel_16labels(vessel_mask, model3, spacing, verbose=verbose)
             vessel_16labels, vessel_mask = modify_vessel_16labels(vessel_16labels, spacing)  # 20250716 add
+            tracer.end(span.add_array('vessel_16labels', vessel_16labels))
 
             # 5 Pred aneurysm，從這一步開始，底下置換成nnU-Net的model，先把正規化的image跟vessel mask存出，準備放入nnU-Net中
             # 5.1 先存出正規化的影像跟血管
+            span = tracer.start('nnunet_predict', device='cuda' if gpu_n >= 0 else 'cpu')
             save_nii_preprocess(path_process, image_arr, vessel_mask, vessel_16labels, out_dir=path_process) 
             path_normimg = os.path.join(path_process, 'Normalized_Image')
             path_vessel = os.path.join(path_process, 'Vessel')
@@ -1282,9 +1284,12 @@ def model_predict_aneurysm(path_code, path_process, path_nnunet_model, case_name
                                   has_classifier_output=False,  # 如果模型有classifier輸出則設為True
                                   num_processes_preprocessing=2,
                                   num_processes_segmentation_export=3,
-                                  desired_gpu_index = 0,
-                                  batch_size=112
+                                  desired_gpu_index = max(gpu_n, 0),
+                                  batch_size=112,
+                                  preloaded_models=nnunet_models,
+                                  device=torch.device('cuda' if gpu_n >= 0 else 'cpu')
                                  )
+            tracer.end(span)
             
             #複製inference result
             #這邊多2個path，path_tensorflow跟path_nnunet
@@ -1292,7 +1297,8 @@ def model_predict_aneurysm(path_code, path_process, path_nnunet_model, case_name
             path_nnunet = os.path.join(path_process, 'nnUNet')
             # path_nnunetlow = os.path.join(path_process, 'nnUNetlowth')
 
-            shutil.copy(os.path.join(path_process, 'DeepAneurysm_00001.nii.gz'), os.path.join(path_nnunet, 'Prob.nii.gz')) #取threshold跟cluster放到後面做
+            span = tracer.start('filter_aneurysm')
+            copy_atomic(os.path.join(path_process, 'DeepAneurysm_00001.nii.gz'), os.path.join(path_nnunet, 'Prob.nii.gz')) #取threshold跟cluster放到後面做
             # shutil.copy(os.path.join(path_process, 'DeepAneurysm_00001.nii.gz'), os.path.join(path_nnunetlow, 'Prob.nii.gz')) #取threshold跟cluster放到後面做
 
             #用threshold修改輸出
@@ -1311,7 +1317,8 @@ def model_predict_aneurysm(path_code, path_process, path_nnunet_model, case_name
             #最後存出新mask，存出nifti
             new_pred_label = data_translate_back(new_pred_label, prob_nii).astype(int)
             new_pred_label_nii = nii_img_replace(prob_nii, new_pred_label)
-            nib.save(new_pred_label_nii, os.path.join(path_nnunet, 'Pred.nii.gz'))  
+            save_nii_atomic(new_pred_label_nii, os.path.join(path_nnunet, 'Pred.nii.gz'))
+            tracer.end(span.add_array('prob', prob).set('n_aneurysm', int(np.max(new_pred_label))))
 
             # #這邊存出nnU-Net low threshold的結果
             # pred_prob_map, df_pred, new_pred_label = filter_aneurysm(prob, spacing_nn, conf_th=0.1, min_diameter=2, top_k=4, obj_th=0.1)
@@ -1353,7 +1360,8 @@ def model_predict_aneurysm(path_code, path_process, path_nnunet_model, case_name
         # if os.path.isdir(path_process):  #如果資料夾存在
         #     shutil.rmtree(path_process) #清掉整個資料夾
  
-    return
+    tracer.end_all(error=msg if code_pass else None)
+    return code_pass, msg
 
 #其意義是「模組名稱」。如果該檔案是被引用，其值會是模組名稱；但若該檔案是(透過命令列)直接執行，其值會是 __main__；。
 if __name__ == '__main__':
@@ -1364,7 +1372,10 @@ if __name__ == '__main__':
     parser.add_argument('--path_nnunet_model', type=str, help='nnU-Net model路徑')
     parser.add_argument('--case', type=str, help='目前執行的case的ID')
     parser.add_argument('--path_log', type=str, help='log資料夾')
-    parser.add_argument('--gpu_n', type=int, help='第幾顆gpu')
+    parser.add_argument('--gpu_n', type=int, help='第幾顆gpu，負數代表用CPU')
+    parser.add_argument('--skip_memory_gate', action='store_true', help='不檢查gpu使用率(由job_queue依記憶體預算排程)')
+    parser.add_argument('--brain_backend', type=str, default='bet', choices=['bet', 'synthseg'], help='BET腦部遮罩的方法，synthseg未驗證前只供測試')
+    parser.add_argument('--morph_method', type=str, default='ball', choices=['ball', 'edt'], help='modify_brain_mask的形態學，edt未驗證前只供測試')
     args = parser.parse_args()
 
     path_code = str(args.path_code)
@@ -1374,4 +1385,7 @@ if __name__ == '__main__':
     path_log = str(args.path_log)
     gpu_n = args.gpu_n
 
-    model_predict_aneurysm(path_code, path_process, path_nnunet_model, case_name, path_log, gpu_n)
+    code_pass, msg = model_predict_aneurysm(path_code, path_process, path_nnunet_model, case_name, path_log, gpu_n,
+                                            check_gpu_memory=not args.skip_memory_gate, brain_backend=args.brain_backend,
+                                            morph_method=args.morph_method)
+    sys.exit(code_pass)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+常駐的aneurysm inference worker
+
+原本pipeline_aneurysm每個case都用subprocess重跑gpu_aneurysm.py，4個tensorflow SavedModel跟nnU-Net的fold權重
+每次都要重新載入、TF/CUDA也要重新初始化。這支程式啟動時只載入一次模型，之後透過Unix socket接收case，
+一個連線一個case，request/response都是一行json:
+    request : {"path_process": "...", "case": "ID"}
+    response: {"code": 0, "msg": "ok", "Pred": "...", "Prob": "...", "Vessel": "...", "Vessel_16": "..."}
+GPU一次只跑一個case，所以server是單執行緒依序處理。
+
+啟動:
+    python gpu_aneurysm_worker.py --path_code ... --path_nnunet_model ... --path_log ... --gpu_n 0 --socket /tmp/gpu_aneurysm_worker.sock
+
+@author: chuan
+"""
+import os
+import json
+import time
+import socket
+import logging
+import argparse
+import socketserver
+
+DEFAULT_SOCKET = '/tmp/gpu_aneurysm_worker.sock'
+
+
+def case_result_paths(path_process):
+    #worker回傳給pipeline的輸出路徑，跟gpu_aneurysm.model_predict_aneurysm的存檔位置一致
+    path_nnunet = os.path.join(path_process, 'nnUNet')
+    return {'Pred': os.path.join(path_nnunet, 'Pred.nii.gz'),
+            'Prob': os.path.join(path_nnunet, 'Prob.nii.gz'),
+            'Vessel': os.path.join(path_process, 'Vessel.nii.gz'),
+            'Vessel_16': os.path.join(path_process, 'Vessel_16.nii.gz')}
+
+
+def submit_case(path_process, case_name, socket_path=DEFAULT_SOCKET, timeout=3600):
+    #client端，送一個case給worker並等待結果，連不上worker時丟出OSError讓呼叫端自己fallback
+    request = json.dumps({'path_process': path_process, 'case': case_name}, ensure_ascii=False) + '\n'
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(request.encode('utf-8'))
+        with sock.makefile('r', encoding='utf-8') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError('gpu_aneurysm_worker closed the connection without a response')
+    return json.loads(line)
+
+
+def worker_is_alive(socket_path=DEFAULT_SOCKET):
+    #只確認socket能不能連上，不送case
+    if not os.path.exists(socket_path):
+        return False
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1)
+            sock.connect(socket_path)
+        return True
+    except OSError:
+        return False
+
+
+class AneurysmWorker(object):
+    #持有已載入的tensorflow跟nnU-Net模型，predict_case直接呼叫model_predict_aneurysm
+    def __init__(self, path_code, path_nnunet_model, path_log, gpu_n=0):
+        import gpu_aneurysm  #tensorflow/torch很重，只有worker端才import
+
+        self.gpu_aneurysm = gpu_aneurysm
+        self.path_code = path_code
+        self.path_nnunet_model = path_nnunet_model
+        self.path_log = path_log
+        self.gpu_n = gpu_n
+
+        start = time.time()
+        gpu_aneurysm.setup_tf_gpu(gpu_n)
+        self.models = gpu_aneurysm.load_aneurysm_models(path_code)
+        self.nnunet_models = gpu_aneurysm.load_aneurysm_nnunet_models(path_nnunet_model)
+        print(f"[Done Load Models... ] spend {time.time() - start:.0f} sec")
+        logging.info(f"[Done Load Models... ] spend {time.time() - start:.0f} sec")
+
+    def predict_case(self, path_process, case_name):
+        start = time.time()
+        code_pass, msg = self.gpu_aneurysm.model_predict_aneurysm(self.path_code, path_process, self.path_nnunet_model,
+                                                                  case_name, self.path_log, self.gpu_n,
+                                                                  models=self.models,
+                                                                  nnunet_models=self.nnunet_models,
+                                                                  check_gpu_memory=False)  #模型佔著GPU，使用率一定超過門檻
+        result = {'case': case_name, 'code': code_pass, 'msg': msg}
+        result.update(case_result_paths(path_process))
+        print(f"[Done Worker Inference {case_name}... ] spend {time.time() - start:.0f} sec")
+        logging.info(f"[Done Worker Inference {case_name}... ] spend {time.time() - start:.0f} sec")
+        return result
+
+
+class _CaseHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        try:
+            request = json.loads(line.decode('utf-8'))
+            result = self.server.worker.predict_case(request['path_process'], str(request['case']))
+        except Exception as e:
+            logging.error("gpu_aneurysm_worker request failed.", exc_info=True)
+            result = {'code': 1, 'msg': str(e)}
+        self.wfile.write((json.dumps(result, ensure_ascii=False) + '\n').encode('utf-8'))
+
+
+def serve(worker, socket_path=DEFAULT_SOCKET):
+    #舊的socket檔要先刪掉才能bind
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with socketserver.UnixStreamServer(socket_path, _CaseHandler) as server:
+        server.worker = worker
+        print('gpu_aneurysm_worker listening on', socket_path)
+        logging.info('gpu_aneurysm_worker listening on ' + socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path_code', type=str, help='目前執行的code')
+    parser.add_argument('--path_nnunet_model', type=str, help='nnU-Net model路徑')
+    parser.add_argument('--path_log', type=str, help='log資料夾')
+    parser.add_argument('--gpu_n', type=int, default=0, help='第幾顆gpu')
+    parser.add_argument('--socket', type=str, default=DEFAULT_SOCKET, help='Unix socket路徑')
+    args = parser.parse_args()
+
+    localt = time.localtime(time.time())
+    time_str_short = str(localt.tm_year) + str(localt.tm_mon).rjust(2,'0') + str(localt.tm_mday).rjust(2,'0')
+    log_file = os.path.join(args.path_log, time_str_short + '.log')
+    FORMAT = '%(asctime)s %(levelname)s %(message)s'
+    logging.basicConfig(level=logging.INFO, filename=log_file, filemode='a', format=FORMAT)
+
+    worker = AneurysmWorker(args.path_code, args.path_nnunet_model, args.path_log, args.gpu_n)
+    serve(worker, args.socket)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+同一個study的影像跟標註一起reslice到isotropic grid
+
+原本reslice_nifti_pred_nobrain對MRA_BRAIN、Pred、Vessel各呼叫一次nibabel.processing.conform，
+每次都重新算一樣的目標grid跟voxel對應(還會為了拿affine先把整個影像轉向一次)，然後各自跑一次完整的resample。
+IsoReslicer在建立時用參考影像算一次目標affine跟(輸出voxel => 輸入voxel)的矩陣，之後每個channel直接套用:
+影像用order 1/3，標註用nearest(order 0)；輸出沿z切成chunk用thread pool平行算，每個chunk直接寫進輸出陣列，
+不會多出整個volume大小的暫存。結果跟conform(img, out_shape, voxel_size, order)相同。
+
+@author: chuan
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import numpy.linalg as npl
+from scipy import ndimage as ndi
+from nibabel.affines import rescale_affine, to_matvec
+from nibabel.processing import conform
+from nibabel.orientations import io_orientation, axcodes2ornt, ornt_transform, inv_ornt_aff, apply_orientation
+
+
+class IsoReslicer:
+    def __init__(self, ref_img, out_shape, voxel_size, orientation='RAS', chunk_z=32, max_workers=4):
+        self.ref_affine = ref_img.affine.copy()
+        self.ref_shape = tuple(ref_img.shape[:3])
+        self.out_shape = tuple(int(y) for y in out_shape)
+        self.voxel_size = voxel_size
+        self.orientation = orientation
+        self.chunk_z = chunk_z
+        self.max_workers = max_workers
+
+        # 跟conform一樣先轉向orientation再縮放，但只算affine跟shape，不搬動資料
+        transform = ornt_transform(io_orientation(self.ref_affine), axcodes2ornt(orientation))
+        reoriented_affine = self.ref_affine.dot(inv_ornt_aff(transform, self.ref_shape))
+        reoriented_shape = apply_orientation(np.broadcast_to(np.zeros((), dtype=bool), self.ref_shape), transform).shape
+        self.out_affine = rescale_affine(reoriented_affine, reoriented_shape, voxel_size, self.out_shape)
+        self.matrix, self.offset = self._mapping(self.ref_affine)
+
+    def _mapping(self, affine):
+        return to_matvec(npl.inv(affine).dot(self.out_affine))
+
+    def same_grid(self, img):
+        return tuple(img.shape[:3]) == self.ref_shape and np.allclose(img.affine, self.ref_affine, atol=1e-4)
+
+    def resample_array(self, data, matrix, offset, order, cval=0.0):
+        data = np.asanyarray(data)
+        out = np.empty(self.out_shape, dtype=data.dtype)
+        if order > 1:
+            # spline prefilter要整個volume，分chunk的話每個chunk都會重做一次，所以不切
+            ndi.affine_transform(data, matrix, offset, self.out_shape, output=out, order=order, mode='constant', cval=cval)
+            return out
+
+        def run_chunk(z0):
+            z1 = min(z0 + self.chunk_z, self.out_shape[2])
+            # 輸出第z0張開始的chunk，等於offset往前移matrix[:, 2] * z0
+            ndi.affine_transform(data, matrix, offset + matrix[:, 2] * z0, self.out_shape[:2] + (z1 - z0,),
+                                 output=out[:, :, z0:z1], order=order, mode='constant', cval=cval)
+
+        starts = range(0, self.out_shape[2], self.chunk_z)
+        if self.max_workers > 1 and len(starts) > 1:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                list(executor.map(run_chunk, starts))
+        else:
+            for z0 in starts:
+                run_chunk(z0)
+        return out
+
+    def resample(self, img, order, cval=0.0):
+        #回傳跟conform一樣的影像(型態同輸入、header沿用輸入的)
+        if not self.same_grid(img):
+            #conform的目標affine是從各自的affine算的，grid不同時目標grid也不同，直接交給conform
+            return conform(img, self.out_shape, self.voxel_size, order=order, cval=cval, orientation=self.orientation)
+        out = self.resample_array(img.dataobj, self.matrix, self.offset, order, cval)
+        return img.__class__(out, self.out_affine, img.header)
+
+    def resample_all(self, items, cval=0.0):
+        #items: [(img, order), ...]，一個channel一個channel做，同時只有一份輸入在記憶體
+        return [self.resample(img, order, cval) for img, order in items]
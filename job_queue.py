@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+多個case的批次佇列(SQLite)，GPU/CPU分開的worker pool
+
+pipeline_aneurysm.sh一次只跑一個study，而且GPU使用率超過60%就直接回"Insufficient GPU Memory"讓case失敗。
+這邊把study放進SQLite佇列，每個case分兩段:
+    1. inference : pipeline_aneurysm_tensorflow.py --targets inference，依記憶體預算排到有空間的GPU，
+                   GPU都滿了而且等超過cpu_fallback_sec就改在CPU上跑(--gpu_n -1)，不會因為GPU忙而失敗
+    2. post      : 同一支程式給--targets POST_TARGETS --require_done inference，inference(含上游)一定要已經在
+                   stage checkpoint裡，不在或過期就讓job失敗，不會在CPU pool裡默默重跑好幾個小時的inference；
+                   只跑reslice、MIP、DICOM-SEG、上傳這些CPU的stage，用另一個pool，跟下一個case的inference重疊
+每段都用subprocess跑(multiprocessing沒辦法釋放gpu)，scheduler只負責依預算決定誰可以開始。
+認領job時記下owner(host:pid)，scheduler每次poll更新自己的job的heartbeat；recover只把heartbeat超過stale_sec的
+job放回前一個狀態，同一個DB上有多個scheduler時不會搶走別人還在跑的job。
+
+使用(DB路徑用--db或環境變數ANEURYSM_QUEUE_DB指定):
+    python job_queue.py --db .../aneurysm_queue.sqlite submit --ID ... --Inputs .../MRA_BRAIN.nii.gz --DicomDir .../MRA_BRAIN/ --Output_folder ...
+    python job_queue.py --db .../aneurysm_queue.sqlite run --gpus 0 1 --gpu_budget_mb 9000 --cpu_workers 4
+    python job_queue.py --db .../aneurysm_queue.sqlite status
+
+@author: chuan
+"""
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import logging
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+PIPELINE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pipeline_aneurysm_tensorflow.py')
+
+#狀態: queued -> inferring -> inferred -> post -> done，任何一段失敗就是failed
+QUEUED, INFERRING, INFERRED, POST, DONE, FAILED = 'queued', 'inferring', 'inferred', 'post', 'done', 'failed'
+#post階段只跑到這些stage(含上游)，inference必須已經完成
+POST_TARGETS = ['upload_dicom', 'upload_json', 'export']
+POST_REQUIRE_DONE = ['inference']
+
+
+def default_owner():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class JobQueue:
+    def __init__(self, db_path, owner=None):
+        self.db_path = db_path
+        self.owner = owner or default_owner()
+        with self._connect() as conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                                job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                case_id TEXT NOT NULL,
+                                inputs TEXT NOT NULL,
+                                dicom_dir TEXT NOT NULL,
+                                output TEXT NOT NULL,
+                                state TEXT NOT NULL,
+                                device TEXT,
+                                error TEXT,
+                                created REAL NOT NULL,
+                                updated REAL NOT NULL)''')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, job_id)')
+            #舊的DB沒有owner/heartbeat欄位就補上
+            columns = {row['name'] for row in conn.execute('PRAGMA table_info(jobs)')}
+            if 'owner' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN owner TEXT')
+            if 'heartbeat' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN heartbeat REAL')
+
+    def _connect(self):
+        #每次操作開新連線，scheduler的thread之間不共用connection；WAL讓submit跟run可以同時進行
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def submit(self, case_id, inputs, dicom_dir, output):
+        now = time.time()
+        with self._connect() as conn:
+            cur = conn.execute('INSERT INTO jobs (case_id, inputs, dicom_dir, output, state, created, updated) '
+                               'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (case_id, json.dumps(list(inputs)), dicom_dir, output, QUEUED, now, now))
+            return cur.lastrowid
+
+    def peek(self, state):
+        #最早進來的那一筆，還沒認領
+        with self._connect() as conn:
+            row = conn.execute('SELECT * FROM jobs WHERE state = ? ORDER BY job_id LIMIT 1', (state,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def claim(self, job_id, from_state, to_state, device=None):
+        #BEGIN IMMEDIATE拿寫入鎖，狀態還是from_state才改，多個scheduler也不會重複認領
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            cur = conn.execute('UPDATE jobs SET state = ?, device = COALESCE(?, device), owner = ?, heartbeat = ?, '
+                               'updated = ? WHERE job_id = ? AND state = ?',
+                               (to_state, device, self.owner, now, now, job_id, from_state))
+            conn.execute('COMMIT')
+        return cur.rowcount == 1
+
+    def heartbeat(self):
+        #更新自己認領中的job，其他scheduler看到heartbeat還新就不會recover
+        with self._connect() as conn:
+            conn.execute('UPDATE jobs SET heartbeat = ? WHERE owner = ? AND state IN (?, ?)',
+                         (time.time(), self.owner, INFERRING, POST))
+
+    def set_state(self, job_id, state, error=None):
+        with self._connect() as conn:
+            conn.execute('UPDATE jobs SET state = ?, error = ?, updated = ? WHERE job_id = ?',
+                         (state, error, time.time(), job_id))
+
+    def recover(self, stale_sec=120):
+        #認領的scheduler已經stale_sec沒有heartbeat(當掉了)的job放回前一個狀態，stage checkpoint會讓它從中斷處接著做
+        deadline = time.time() - stale_sec
+        recovered = 0
+        with self._connect() as conn:
+            for from_state, to_state in ((INFERRING, QUEUED), (POST, INFERRED)):
+                cur = conn.execute('UPDATE jobs SET state = ?, owner = NULL, updated = ? WHERE state = ? '
+                                   'AND (heartbeat IS NULL OR heartbeat < ?) AND (owner IS NULL OR owner != ?)',
+                                   (to_state, time.time(), from_state, deadline, self.owner))
+                recovered += cur.rowcount
+        if recovered:
+            logging.info(f"[Recover jobs... ] {recovered} stale jobs")
+        return recovered
+
+    def counts(self):
+        with self._connect() as conn:
+            rows = conn.execute('SELECT state, COUNT(*) AS n FROM jobs GROUP BY state').fetchall()
+        return {row['state']: row['n'] for row in rows}
+
+
+def gpu_free_mb(gpu_n):
+    #目前GPU實際剩多少記憶體(含其他程式的用量)，讀不到就當作0
+    try:
+        import pynvml
+        pynvml.nvmlInit()
+        handle = pynvml.nvmlDeviceGetHandleByIndex(gpu_n)
+        return pynvml.nvmlDeviceGetMemoryInfo(handle).free / 1024 ** 2
+    except Exception:
+        logging.error(f"pynvml read gpu {gpu_n} failed.", exc_info=True)
+        return 0
+
+
+class BatchScheduler:
+    """
+    gpus: 可以用的GPU編號
+    gpu_budget_mb: 每個GPU給這個佇列用的記憶體上限，一個inference預估用infer_mb，預算內可以同時跑多個case
+    cpu_infer_workers: GPU都滿時最多幾個case改在CPU上做inference(0就一定等GPU)
+    cpu_workers: post stage(reslice、MIP、DICOM-SEG、上傳)的pool大小
+    """
+
+    def __init__(self, queue, gpus=(0,), gpu_budget_mb=9000, infer_mb=6000, cpu_infer_workers=1, cpu_workers=4,
+                 cpu_fallback_sec=300, poll_sec=2, python=sys.executable, pipeline_script=PIPELINE_SCRIPT):
+        self.queue = queue
+        self.gpus = list(gpus)
+        self.gpu_budget_mb = gpu_budget_mb
+        self.infer_mb = infer_mb
+        self.cpu_infer_workers = cpu_infer_workers
+        self.cpu_workers = cpu_workers
+        self.cpu_fallback_sec = cpu_fallback_sec
+        self.poll_sec = poll_sec
+        self.python = python
+        self.pipeline_script = pipeline_script
+        self.reserved_mb = {gpu: 0 for gpu in self.gpus}  #各GPU已經分出去的預算
+        self.running = {}  #future => (階段, device)
+
+    def _cmd(self, job, gpu_n, targets=None, require_done=None):
+        cmd = [self.python, self.pipeline_script,
+               '--ID', job['case_id'],
+               '--Inputs', *json.loads(job['inputs']),
+               '--DicomDir', job['dicom_dir'],
+               '--Output_folder', job['output'],
+               '--gpu_n', str(gpu_n),
+               '--skip_memory_gate']
+        if targets:
+            cmd += ['--targets', *targets]
+        if require_done:
+            cmd += ['--require_done', *require_done]
+        return cmd
+
+    def _run(self, job, cmd, next_state):
+        start = time.time()
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            self.queue.set_state(job['job_id'], FAILED, error=result.stderr[-4000:])
+            logging.error(f"[job {job['job_id']} {job['case_id']}] failed: {result.stderr[-1000:]}")
+            return False
+        self.queue.set_state(job['job_id'], next_state)
+        print(f"[Done job {job['job_id']} {job['case_id']} -> {next_state}] spend {time.time() - start:.0f} sec")
+        logging.info(f"[Done job {job['job_id']} {job['case_id']} -> {next_state}] spend {time.time() - start:.0f} sec")
+        return True
+
+    def _pick_gpu(self):
+        #預算內而且實際剩餘記憶體也夠的GPU，選剩最多的
+        candidates = []
+        for gpu in self.gpus:
+            if self.reserved_mb[gpu] + self.infer_mb > self.gpu_budget_mb:
+                continue
+            free = gpu_free_mb(gpu)
+            if free >= self.infer_mb:
+                candidates.append((free, gpu))
+        return max(candidates)[1] if candidates else None
+
+    def _n_running(self, stage, device=None):
+        return sum(1 for s, d in self.running.values() if s == stage and (device is None or d == device))
+
+    def _reap(self):
+        for future in [f for f in self.running if f.done()]:
+            stage, device = self.running.pop(future)
+            if stage == INFERRING and device != 'cpu':
+                self.reserved_mb[device] -= self.infer_mb
+            if future.exception() is not None:
+                logging.error("job thread raised.", exc_info=future.exception())
+
+    def _schedule(self, executor):
+        #post stage優先，把已經做完inference的case先清掉
+        while self._n_running(POST) < self.cpu_workers:
+            job = self.queue.peek(INFERRED)
+            if job is None or not self.queue.claim(job['job_id'], INFERRED, POST):
+                break
+            future = executor.submit(self._run, job, self._cmd(job, -1, POST_TARGETS, POST_REQUIRE_DONE), DONE)
+            self.running[future] = (POST, 'cpu')
+
+        while True:
+            job = self.queue.peek(QUEUED)
+            if job is None:
+                break
+            gpu = self._pick_gpu()
+            if gpu is not None:
+                device, gpu_n = gpu, gpu
+            elif (self._n_running(INFERRING, 'cpu') < self.cpu_infer_workers
+                  and time.time() - job['created'] >= self.cpu_fallback_sec):
+                device, gpu_n = 'cpu', -1
+            else:
+                break  #等GPU空出來，不讓case失敗
+            if not self.queue.claim(job['job_id'], QUEUED, INFERRING, device=str(device)):
+                continue
+            if device != 'cpu':
+                self.reserved_mb[device] += self.infer_mb
+            future = executor.submit(self._run, job, self._cmd(job, gpu_n, ['inference']), INFERRED)
+            self.running[future] = (INFERRING, device)
+
+    def run(self, drain=False):
+        """
+        drain=True: 佇列清空就結束，否則常駐等待新的case
+        """
+        max_threads = len(self.gpus) * max(1, self.gpu_budget_mb // max(self.infer_mb, 1)) \
+            + self.cpu_infer_workers + self.cpu_workers
+        with ThreadPoolExecutor(max_workers=max_threads) as executor:
+            while True:
+                self.queue.heartbeat()
+                self.queue.recover()  #每次poll都檢查，其他scheduler當掉留下的job也會被接手
+                self._reap()
+                self._schedule(executor)
+                counts = self.queue.counts()
+                if drain and not self.running and counts.get(QUEUED, 0) == 0 and counts.get(INFERRED, 0) == 0:
+                    break
+                time.sleep(self.poll_sec)
+        return self.queue.counts()
+
+
+#其意義是「模組名稱」。如果該檔案是被引用，其值會是模組名稱；但若該檔案是(透過命令列)直接執行，其值會是 __main__；。
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', type=str, default=os.environ.get('ANEURYSM_QUEUE_DB'),
+                        required='ANEURYSM_QUEUE_DB' not in os.environ, help='SQLite佇列檔(或設定環境變數ANEURYSM_QUEUE_DB)')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_submit = sub.add_parser('submit', help='加入一個case')
+    p_submit.add_argument('--ID', type=str, required=True, help='目前執行的case的patient_id or study id')
+    p_submit.add_argument('--Inputs', type=str, nargs='+', required=True, help='用於輸入的檔案')
+    p_submit.add_argument('--DicomDir', type=str, required=True, help='對應的dicom資料夾')
+    p_submit.add_argument('--Output_folder', type=str, required=True, help='用於輸出結果的資料夾')
+
+    p_run = sub.add_parser('run', help='啟動scheduler')
+    p_run.add_argument('--gpus', type=int, nargs='+', default=[0], help='可以用的gpu')
+    p_run.add_argument('--gpu_budget_mb', type=int, default=9000, help='每個gpu給佇列用的記憶體上限')
+    p_run.add_argument('--infer_mb', type=int, default=6000, help='一個case的inference預估用量')
+    p_run.add_argument('--cpu_infer_workers', type=int, default=1, help='GPU都滿時最多幾個case改用CPU inference')
+    p_run.add_argument('--cpu_fallback_sec', type=int, default=300, help='等GPU超過幾秒才改用CPU')
+    p_run.add_argument('--cpu_workers', type=int, default=4, help='post stage的pool大小')
+    p_run.add_argument('--drain', action='store_true', help='佇列清空就結束')
+
+    sub.add_parser('status', help='各狀態的case數量')
+    args = parser.parse_args()
+
+    FORMAT = '%(asctime)s %(levelname)s %(message)s'
+    logging.basicConfig(level=logging.INFO, format=FORMAT)
+
+    job_queue = JobQueue(args.db)
+    if args.command == 'submit':
+        print('job_id:', job_queue.submit(args.ID, args.Inputs, args.DicomDir, args.Output_folder))
+    elif args.command == 'run':
+        scheduler = BatchScheduler(job_queue, args.gpus, args.gpu_budget_mb, args.infer_mb, args.cpu_infer_workers,
+                                   args.cpu_workers, args.cpu_fallback_sec)
+        print(scheduler.run(drain=args.drain))
+    else:
+        print(job_queue.counts())
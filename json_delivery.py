@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+平台JSON的非同步上傳
+
+原本upload_json_aiteam用httpx.Client一個一個同步post，失敗就只印出來。
+這邊用httpx.AsyncClient的連線池同時送多個json(上限max_concurrency)，連線錯誤、429、5xx會用指數退避重試；
+同一份json帶同一個Idempotency-Key，重送不會在平台端重複建立。
+只有連線錯誤跟RETRY_STATUS(暫時性的錯誤)重試用完還是失敗的json才放進outbox資料夾；400/404/422這類永久錯誤
+重送也不會成功，只記log。outbox不在每個case的流程裡補送(平台掛掉時每個case都會卡在重試)，用cron定時執行
+    python json_delivery.py --outbox /mnt/e/pipeline/chuan/json/outbox --max_entries 100
+
+@author: chuan
+"""
+import os
+import time
+import random
+import shutil
+import asyncio
+import hashlib
+import logging
+import argparse
+
+import httpx
+import orjson
+
+UPLOAD_DATA_JSON_URL = 'http://localhost:84/api/ai_team/create_or_update'
+RETRY_STATUS = {429, 500, 502, 503, 504}
+INVALID_JSON = 0  #檔案不是合法的json，沒有送出
+
+
+def is_success(status):
+    return status is not None and 200 <= status < 400
+
+
+def is_retryable(status):
+    #連線錯誤(None)跟暫時性的status之後補送可能會成功，其他的失敗(4xx、格式錯誤)重送也一樣
+    return status is None or status in RETRY_STATUS
+
+
+async def _post_json(client, semaphore, url, path, retries, backoff):
+    #回傳(path, status_code或None, 回應文字或錯誤訊息)
+    with open(path, 'rb') as f:
+        body = f.read()
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError as e:
+        return path, INVALID_JSON, f'invalid json: {e}'
+    headers = {'Idempotency-Key': hashlib.sha256(body).hexdigest()}
+
+    result = None
+    for attempt in range(retries + 1):
+        async with semaphore:
+            try:
+                response = await client.post(url, json=data, headers=headers)
+                result = (path, response.status_code, response.text)
+                if response.status_code not in RETRY_STATUS:
+                    return result
+            except httpx.TransportError as e:
+                result = (path, None, repr(e))
+        if attempt < retries:
+            # 指數退避加一點隨機，避免同時重送
+            await asyncio.sleep(backoff * (2 ** attempt) * (1 + random.random() * 0.1))
+    return result
+
+
+def _to_outbox(outbox, path, url):
+    #失敗的json連同url放進outbox，檔名加時間避免覆蓋
+    os.makedirs(outbox, exist_ok=True)
+    name = f"{time.strftime('%Y%m%d%H%M%S')}_{os.path.basename(path)}"
+    shutil.copy(path, os.path.join(outbox, name))
+    with open(os.path.join(outbox, name + '.url'), 'w', encoding='utf-8') as f:
+        f.write(url)
+    return os.path.join(outbox, name)
+
+
+async def deliver_json_async(json_files, url=UPLOAD_DATA_JSON_URL, max_concurrency=4, retries=3, backoff=0.5,
+                             timeout=10.0, outbox=None):
+    limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    async with httpx.AsyncClient(timeout=timeout, verify=False, limits=limits) as client:
+        results = await asyncio.gather(*[_post_json(client, semaphore, url, path, retries, backoff)
+                                         for path in json_files])
+
+    for path, status, text in results:
+        print(f"\n📤 Uploaded: {os.path.basename(path)}")
+        print(f"✅ Status: {status}")
+        print("📥 Response:", text)
+        if is_success(status):
+            continue
+        if not is_retryable(status):
+            logging.error(f"upload json rejected (not retried): {path} {status} {text}")
+        else:
+            logging.error(f"upload json failed: {path} {status} {text}")
+            if outbox is not None:
+                print('json放入outbox:', _to_outbox(outbox, path, url))
+    return results
+
+
+def deliver_json(json_files, url=UPLOAD_DATA_JSON_URL, max_concurrency=4, retries=3, backoff=0.5,
+                 timeout=10.0, outbox=None):
+    #同步的入口，給pipeline直接呼叫
+    if isinstance(json_files, str):
+        json_files = [json_files]
+    return asyncio.run(deliver_json_async(json_files, url, max_concurrency, retries, backoff, timeout, outbox))
+
+
+def _remove_entry(path):
+    #同時有別的程序也在flush同一個outbox的話可能已經被刪掉
+    for done in (path, path + '.url'):
+        try:
+            os.remove(done)
+        except FileNotFoundError:
+            pass
+
+
+def flush_outbox(outbox, max_concurrency=4, retries=3, backoff=0.5, timeout=10.0, max_entries=100):
+    """
+    補送outbox裡的json(最舊的max_entries個，None就全部)，成功的刪掉，
+    永久錯誤的移到outbox/rejected不再重送，暫時性的失敗留著下次再送
+    """
+    if not os.path.isdir(outbox):
+        return []
+    pending = sorted(os.path.join(outbox, y) for y in os.listdir(outbox) if y.endswith('.json'))
+    if max_entries is not None:
+        pending = pending[:max_entries]
+    by_url = {}
+    for path in pending:
+        url_file = path + '.url'
+        url = UPLOAD_DATA_JSON_URL
+        if os.path.isfile(url_file):
+            with open(url_file, 'r', encoding='utf-8') as f:
+                url = f.read().strip()
+        by_url.setdefault(url, []).append(path)
+
+    results = []
+    for url, paths in by_url.items():
+        results += deliver_json(paths, url, max_concurrency, retries, backoff, timeout, outbox=None)
+    for path, status, _ in results:
+        if is_success(status):
+            _remove_entry(path)
+        elif not is_retryable(status):
+            rejected = os.path.join(outbox, 'rejected')
+            os.makedirs(rejected, exist_ok=True)
+            try:
+                shutil.copy(path, os.path.join(rejected, os.path.basename(path)))
+            except FileNotFoundError:
+                continue
+            _remove_entry(path)
+            logging.error(f"outbox json rejected, moved to {rejected}: {path} {status}")
+    return results
+
+
+#其意義是「模組名稱」。如果該檔案是被引用，其值會是模組名稱；但若該檔案是(透過命令列)直接執行，其值會是 __main__；。
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--outbox', type=str, default='/mnt/e/pipeline/chuan/json/outbox', help='要補送的outbox資料夾')
+    parser.add_argument('--max_concurrency', type=int, default=4, help='同時送出的json數')
+    parser.add_argument('--retries', type=int, default=3, help='每個json的重試次數')
+    parser.add_argument('--max_entries', type=int, default=100, help='這次最多補送幾個json(最舊的先送)')
+    args = parser.parse_args()
+
+    results = flush_outbox(args.outbox, max_concurrency=args.max_concurrency, retries=args.retries,
+                           max_entries=args.max_entries)
+    failed = [y for y in results if not is_success(y[1])]
+    print(f"[Done flush outbox] {len(results)} json, failed {len(failed)}")
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+mask內插(distance field + 線性內插)，給get_vessel_skeleton_labels把vessel mask在z方向放大用
+
+原本mask_interpolation每個類別都在整個volume上逐張slice算distance_transform_edt，再整個ndi.zoom(order=1)。
+這邊只在每個類別的bounding box裡算distance field跟內插，slice之間用thread pool平行算，
+結果跟原本相同(多類別的部分連原本寫進整數陣列造成的截斷、四捨五入都照做)。
+內插是各軸分開做，加總順序跟ndi.zoom不同，所以內插值剛好在門檻上(差1e-16左右)的voxel可能不一樣。
+不需要tensorflow，可以單獨import來測試(tests/test_mask_interpolation.py對照原本的做法)。
+
+@author: chuan
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage as ndi
+
+
+def _slice_signed_distance(mask, truncate=False, max_workers=4):
+    """
+    每張slice的(內部距離 - 外部距離)，跟原本逐張distance_transform_edt的結果相同(truncate就轉成int64)，但每張只算需要的範圍:
+    只有這張或上下相鄰slice有mask的像素(外加一格)，內插時才可能跟mask混在一起，其他地方給一個負值就好。
+    slice之間用thread pool平行算。
+    """
+    plane = mask.shape[:2]
+    sdf = np.full(mask.shape, -float(sum(plane)), dtype=np.float64)
+    has_fg = mask.any(axis=(0, 1))
+    rows = mask.any(axis=1)  # (x, z)
+    cols = mask.any(axis=0)  # (y, z)
+    empty_plane = {}
+
+    def full_plane():
+        # 沒有前景或背景時2D distance_transform_edt的結果(全部True的slice)，只算一次
+        if 'dist' not in empty_plane:
+            empty_plane['dist'] = ndi.distance_transform_edt(np.ones(plane, dtype=bool))
+        return empty_plane['dist']
+
+    def run_slice(z):
+        near = slice(max(z - 1, 0), z + 2)
+        if not has_fg[near].any():
+            return
+        xs = np.nonzero(rows[:, near].any(axis=1))[0]
+        ys = np.nonzero(cols[:, near].any(axis=1))[0]
+        box = (slice(max(xs[0] - 1, 0), min(xs[-1] + 2, plane[0])), slice(max(ys[0] - 1, 0), min(ys[-1] + 2, plane[1])))
+        if not has_fg[z]:
+            sdf[box + (z,)] = -full_plane()[box]
+            return
+        crop = mask[box + (z,)]
+        if crop.all():  # 周圍沒有背景代表box就是整張slice
+            sdf[:, :, z] = full_plane()
+            return
+        # box外一圈都是背景(或影像邊界)，box裡的距離跟整張slice算的一樣
+        sdf[box + (z,)] = ndi.distance_transform_edt(crop) - ndi.distance_transform_edt(np.logical_not(crop))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(run_slice, range(mask.shape[2])))
+    if truncate:
+        sdf = sdf.astype(np.int64)
+    return sdf
+
+
+def _mask_interpolation_binary(mask, out_shape, truncate=False, chunk_z=32):
+    # 只在mask的bounding box(xy外加一格背景、z外加一張slice)裡建distance field跟內插，box外一定是負的(=0)
+    mask = mask > 0
+    out = np.zeros(out_shape, dtype=bool)
+    if not mask.any():
+        return out
+    in_shape = np.array(mask.shape)
+    nonzero = np.nonzero(mask.any(axis=(1, 2)))[0], np.nonzero(mask.any(axis=(0, 2)))[0], np.nonzero(mask.any(axis=(0, 1)))[0]
+    lo = np.maximum([y[0] - 1 for y in nonzero], 0)
+    hi = np.minimum([y[-1] + 2 for y in nonzero], in_shape)
+    box = tuple(slice(a, b) for a, b in zip(lo, hi))
+    sdf = _slice_signed_distance(mask[:, :, box[2]], truncate)[box[0], box[1]]
+
+    # 跟ndi.zoom(grid_mode=False)一樣: 輸出第o格對應輸入座標 o * (n_in - 1) / (n_out - 1)
+    out_len = np.array(out_shape)
+    scale = np.where(out_len > 1, (in_shape - 1) / np.maximum(out_len - 1, 1), 1.0)
+    safe = np.where(scale > 0, scale, 1.0)
+    out_lo = np.where(scale > 0, np.ceil(lo / safe - 1e-9), 0).astype(int)
+    out_hi = np.where(scale > 0, np.floor((hi - 1) / safe + 1e-9), out_len - 1).astype(int)
+    out_lo, out_hi = np.maximum(out_lo, 0), np.minimum(out_hi, out_len - 1)
+    if np.any(out_hi < out_lo):
+        return out
+
+    # order 1的zoom就是各軸分開的線性內插，x、y通常factor是1(直接取)，z每次只算一段輸出slice
+    coords = [(np.arange(a, b + 1) * c - l) for a, b, c, l in zip(out_lo, out_hi, scale, lo)]
+    for axis in (0, 1):
+        sdf = _linear_axis(sdf, coords[axis], axis)
+    for z0 in range(0, len(coords[2]), chunk_z):
+        values = _linear_axis(sdf, coords[2][z0:z0 + chunk_z], 2)
+        # 原本zoom的輸出也是整數陣列時，scipy是四捨五入(0.5往外進位)成整數，> 0等於 >= 0.5
+        values = values >= 0.5 if truncate else values > 0.
+        out[out_lo[0]:out_hi[0] + 1, out_lo[1]:out_hi[1] + 1, out_lo[2] + z0:out_lo[2] + z0 + values.shape[2]] = values
+    return out
+
+
+def _linear_axis(arr, coords, axis):
+    # 沿axis在座標coords(以arr的index計)做線性內插，整數座標直接取值
+    k = np.clip(np.floor(coords + 1e-12).astype(int), 0, arr.shape[axis] - 1)
+    w = coords - k
+    if np.all(np.abs(w) < 1e-12):
+        return np.take(arr, k, axis=axis)
+    k1 = np.minimum(k + 1, arr.shape[axis] - 1)
+    shape = [1, 1, 1]
+    shape[axis] = len(coords)
+    w = w.reshape(shape)
+    return np.take(arr, k, axis=axis) * (1 - w) + np.take(arr, k1, axis=axis) * w
+
+
+def mask_interpolation(mask, factor, **kwargs):
+    """ Resizing the mask through interpolation by building the distance field.
+        Randomly sampling factor and multi-categories are considered.
+        Implemented by Kuan (Kevin) Zhang, Ph.D., Radiology Informatics Laboratory, Mayo Clinic.
+
+        This implementation follows:
+        How to properly interpolate masks for deep learning in medical imaging?
+        Args:
+            mask (np.array): The initial mask matrix in the shape: (slices, x, y)
+            factor (tuple): The sampling factor of resizing in the shape: (fx, fy, fz)
+        Output:
+            The interpolated mask matrix to return.
+    """
+    # 輸出大小跟ndi.zoom相同；每個類別只在自己的bounding box裡算，slice的distance field用thread pool平行算
+    out_shape = tuple(int(round(ii * jj)) for ii, jj in zip(mask.shape, factor))
+
+    # Check the number of mask types contained in the input.
+    mask_types = int(mask.max())
+
+    if mask_types > 1:
+        # 多個類別重疊時取編號小的(原本argmax的結果)，所以從大的往小的覆蓋
+        mask_new = np.zeros(out_shape, dtype=mask.dtype)
+        # 原本多類別的distance field是寫進整數陣列(np.where(mask == i+1,1,0))，距離跟zoom的結果都變成整數，這邊照做以維持相同結果
+        for i in range(mask_types, 0, -1):
+            mask_new[_mask_interpolation_binary(mask == i, out_shape, truncate=True)] = i
+        return mask_new
+
+    else:  # For the binary mask type.
+        return _mask_interpolation_binary(mask, out_shape).astype(mask.dtype)
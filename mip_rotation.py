@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+MIP旋轉引擎
+
+create_MIP_pred每個角度原本都要把vessel跟每一顆aneurysm label各自用torchvision rotate轉一次(寫死在cuda上)。
+這邊把每個角度的resampling grid算一次後快取起來，影像用bilinear、vessel跟所有label疊成同一個tensor用nearest
+一次轉完，計算結果跟torchvision.transforms.functional.rotate(expand=True)相同。
+沒有GPU時自動改用CPU，並把torch的執行緒開到cpu數量。
+
+@author: chuan
+"""
+import os
+import numpy as np
+import torch
+from torchvision.transforms.functional import rotate as rotate_torch
+from torchvision.transforms import InterpolationMode
+
+try:
+    from torchvision.transforms.functional import _get_inverse_affine_matrix
+    try:
+        from torchvision.transforms._functional_tensor import _apply_grid_transform, _compute_affine_output_size, \
+            _gen_affine_grid
+    except ImportError:  # torchvision < 0.15
+        from torchvision.transforms.functional_tensor import _apply_grid_transform, _compute_affine_output_size, \
+            _gen_affine_grid
+    _HAS_GRID_API = True
+except ImportError:
+    _HAS_GRID_API = False
+
+
+def select_device(gpu=None, num_threads=None):
+    #有GPU用指定的GPU，沒有(或gpu給負數)就用CPU多執行緒
+    if torch.cuda.is_available() and (gpu is None or gpu >= 0):
+        return torch.device(f'cuda:{gpu}' if gpu is not None else 'cuda:0')
+    torch.set_num_threads(num_threads if num_threads else (os.cpu_count() or 1))
+    return torch.device('cpu')
+
+
+class RotationEngine:
+    """
+    以H, W, Z(這邊是translated後的Z, H, W)3D volume做2D平面旋轉，axis定義跟create_MIP_pred原本的rotation_3d相同:
+    0 水平轉(Yaw)，1 垂直轉(Pitch)。grid依(平面大小, 角度, dtype)快取，同一角度的影像/vessel/label共用。
+    """
+
+    def __init__(self, gpu=None, device=None, num_threads=None):
+        self.device = torch.device(device) if device is not None else select_device(gpu, num_threads)
+        self._grids = {}
+
+    def to_tensor(self, X, dtype=None):
+        if isinstance(X, np.ndarray):
+            X = torch.from_numpy(np.ascontiguousarray(X))
+        if dtype is not None:
+            X = X.to(dtype)
+        return X.to(self.device)
+
+    def _grid(self, h, w, theta, dtype):
+        key = (h, w, float(theta), dtype)
+        grid = self._grids.get(key)
+        if grid is None:
+            matrix = _get_inverse_affine_matrix([0.0, 0.0], -float(theta), [0.0, 0.0], 1.0, [0.0, 0.0])
+            ow, oh = _compute_affine_output_size(matrix, w, h)
+            matrix_t = torch.tensor(matrix, dtype=dtype, device=self.device).reshape(1, 2, 3)
+            grid = _gen_affine_grid(matrix_t, w=w, h=h, ow=ow, oh=oh)
+            self._grids[key] = grid
+        return grid
+
+    def rotate2d(self, X, theta, label=False, fill=0.0):
+        #X: (C, H, W)，對最後兩軸旋轉，等同rotate_torch(X, angle=theta, expand=True)
+        if not _HAS_GRID_API:
+            interpolation_mode = InterpolationMode.NEAREST if label else InterpolationMode.BILINEAR
+            return rotate_torch(X, interpolation=interpolation_mode, angle=theta, expand=True, fill=fill)
+        dtype = X.dtype if torch.is_floating_point(X) else torch.float32
+        grid = self._grid(int(X.shape[-2]), int(X.shape[-1]), theta, dtype)
+        return _apply_grid_transform(X, grid, 'nearest' if label else 'bilinear', fill=fill)
+
+    def rotate3d(self, X, axis, theta, label=False, fill=0.0):
+        if axis == 0:
+            X = self.rotate2d(X, theta, label=label, fill=fill)
+        elif axis == 1:
+            X = X.permute((1, 0, 2))
+            X = self.rotate2d(X, theta, label=label, fill=fill)
+            X = X.permute((1, 0, 2))
+            X = torch.flip(X, [2])
+        else:
+            raise ValueError('無效的軸值。預期為0或1。')
+        return X
+
+    def rotate3d_stack(self, volumes, axis, theta, label=True, fill=0.0):
+        #多個同大小volume沿channel軸疊起來一次轉完(nearest時等同各自旋轉)，再拆回list
+        channel_dim = 0 if axis == 0 else 1
+        sizes = [int(v.shape[channel_dim]) for v in volumes]
+        stacked = torch.cat(volumes, dim=channel_dim)
+        rotated = self.rotate3d(stacked, axis, theta, label=label, fill=fill)
+        return list(torch.split(rotated, sizes, dim=channel_dim))
+
+
+def place_mip(MIP_r, y_i, x_i, axis, dtype=torch.float32):
+    #把旋轉後大小會變動的MIP置中貼回(y_i, x_i)，規則同create_MIP_pred原本的寫法
+    MIP = torch.zeros((y_i, x_i), dtype=dtype, device=MIP_r.device)
+    y_r, x_r = MIP_r.shape[0], MIP_r.shape[1]
+    if axis == 0:
+        if x_r > x_i:
+            slice_y = (y_i - y_r) // 2
+            slice_x = (x_r - x_i) // 2
+            MIP[slice_y:slice_y + y_r, :] = MIP_r[:, slice_x:slice_x + x_i]
+        else:
+            slice_y = (y_i - y_r) // 2
+            slice_x = (x_i - x_r) // 2
+            MIP[slice_y:slice_y + y_r, slice_x:slice_x + x_r] = MIP_r
+    else:
+        if y_r > y_i:
+            slice_y = (y_r - y_i) // 2
+            slice_x = (x_r - x_i) // 2
+            MIP = MIP_r[slice_y:slice_y + y_i, slice_x:slice_x + x_i].to(dtype)
+        else:
+            slice_y = (y_i - y_r) // 2
+            slice_x = (x_i - x_r) // 2
+            MIP[slice_y:slice_y + y_r, slice_x:slice_x + x_r] = MIP_r
+    return MIP
+
+
+def project_labels(rotated_labels, rotated_vessel, label_num, y_i, x_i, axis):
+    """
+    共用同一個已旋轉的vessel，算出每顆label投影後的slice跟被血管前後遮擋的比例(cover_range)
+    rotated_labels: 已旋轉的label volume(數值1..label_num)
+    return: new_slice (y_i, x_i) int16, cover_ranges (label_num,)
+    """
+    new_slice = torch.zeros((y_i, x_i), dtype=torch.int16, device=rotated_labels.device)
+    cover_ranges = np.zeros(label_num)
+    if label_num == 0:
+        return new_slice, cover_ranges
+
+    vessel_any = rotated_vessel > 0
+    n_z = int(rotated_vessel.shape[-1])
+    for j in range(label_num):
+        label_one = rotated_labels == j + 1
+        label_z_list = torch.nonzero(label_one.any(dim=0).any(dim=0), as_tuple=False).flatten()
+        if label_z_list.numel() == 0:
+            label_z_list = torch.tensor([1], device=rotated_labels.device)
+
+        index_front = max(int(label_z_list[0]) - 3, 1)
+        index_back = min(int(label_z_list[-1]) + 3, n_z - 1)
+
+        #對label做projection去獲得投影後的x,y
+        label_mip = label_one.any(dim=-1)
+        label_mip_s = label_mip.clone() #原版都沒阻擋
+        label_mip[vessel_any[:, :, :index_front].any(dim=-1)] = False #前面有阻擋到的就等於0
+        label_cover = label_mip.clone()
+        label_cover[vessel_any[:, :, index_back:].any(dim=-1)] = False #後面有阻擋到的就等於0
+
+        extra_label = place_mip(label_mip.to(torch.int16), y_i, x_i, axis, dtype=torch.int16)
+        new_slice[extra_label > 0] = j + 1
+
+        if torch.sum(extra_label) > 0:
+            cover_range = torch.sum(label_cover).float() / torch.sum(label_mip_s).float()
+            cover_ranges[j] = min(cover_range.item(), 0.98)
+        else:
+            cover_ranges[j] = 0.0
+    return new_slice, cover_ranges
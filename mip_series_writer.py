@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+MIP series的DICOM/NIfTI輸出
+
+原本create_MIP_pred每張MIP切片都重新pydicom.dcmread範本dicom，寫完後再用dcm2niix把剛寫出的dicom轉回nifti。
+這邊範本只讀一次，series層級的tag先改好，每張切片只替換會變動的tag(PixelData、SOP UID、位置、InstanceNumber)，
+用thread pool寫檔；nifti直接由記憶體中的陣列跟dicom幾何算出affine，排列方式跟dcm2niix輸出相同
+(列方向上下翻轉、切片依法向量由小到大，LPS轉RAS)。
+
+@author: chuan
+"""
+import os
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel as nib
+import pydicom
+from pydicom.dataset import FileDataset
+
+
+class MIPSeriesWriter:
+    def __init__(self, template_path, tag, series, SE, slice_thickness, max_workers=8):
+        template = pydicom.dcmread(template_path)
+        self.template = template
+        self.tag = tag
+        self.series = series
+        self.max_workers = max_workers
+
+        # series層級的tag只改一次
+        template[0x08, 0x0008].value = ['DERIVED', 'SECONDARY', 'OTHER']
+        template[0x08, 0x103E].value = tag
+        template[0x20, 0x0011].value = SE
+        template.add_new(0x00280006, 'US', 1)
+        template[0x28, 0x0100].value = 16
+        template[0x28, 0x0101].value = 16
+        template[0x28, 0x0102].value = 15
+        for window_tag in [(0x28, 0x1050), (0x28, 0x1051)]:
+            if window_tag in template:
+                del template[window_tag]
+        template[0x20, 0x000E].value = template[0x20, 0x000E].value + '.' + str(series)
+        template.SliceThickness = slice_thickness
+        template.SpacingBetweenSlices = slice_thickness
+
+        # raw element先全部轉成DataElement，之後多執行緒只讀不改
+        self.elements = {elem_tag: template[elem_tag] for elem_tag in template.keys()}
+        self.sop_instance_uid = template[0x08, 0x0018].value
+        self.slice_thickness = float(slice_thickness)
+        self.pixel_spacing = np.array(template[0x28, 0x0030].value, dtype=np.float64)
+        self.position = np.array(template[0x20, 0x0032].value, dtype=np.float64)
+        orientation = np.array(template[0x20, 0x0037].value, dtype=np.float64)
+        self.row_vector = orientation[:3]
+        self.col_vector = orientation[3:]
+        normal_vector = np.cross(self.row_vector, self.col_vector)
+        self.normal_vector = normal_vector / np.linalg.norm(normal_vector)
+
+    def make_slice(self, img, angle, count, filename=''):
+        y_i, x_i = img.shape
+        template = self.template
+        file_meta = copy.deepcopy(template.file_meta)
+        dcm = FileDataset(filename, dict(self.elements), file_meta=file_meta, preamble=template.preamble,
+                          is_implicit_VR=template.is_implicit_VR, is_little_endian=template.is_little_endian)
+
+        new_sopiu = self.sop_instance_uid + '.' + str(self.series) + str(angle)
+        new_position = self.position - self.normal_vector * self.slice_thickness * count
+        # 用add_new換成新的DataElement，不會改到範本
+        dcm.add_new(0x7FE00010, template[0x7FE0, 0x0010].VR, img.tobytes())
+        dcm.add_new(0x00280010, 'US', y_i)
+        dcm.add_new(0x00280011, 'US', x_i)
+        dcm.add_new(0x00080018, 'UI', new_sopiu)
+        dcm.add_new(0x00200032, 'DS', [float(new_position[0]), float(new_position[1]), float(new_position[2])])
+        dcm.add_new(0x00201041, 'DS', float(new_position[2]))
+        dcm.add_new(0x00200013, 'IS', int(count))
+        dcm.file_meta.MediaStorageSOPInstanceUID = new_sopiu
+        return dcm
+
+    def write_series(self, slices, path_out):
+        """
+        slices: [(img, angle, count, filename), ...]，thread pool平行寫檔
+        """
+        def _write(item):
+            img, angle, count, filename = item
+            path_file = os.path.join(path_out, filename)
+            self.make_slice(img, angle, count, path_file).save_as(path_file)
+            return path_file
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(_write, slices))
+
+    def affine(self, rows, n_slices):
+        #跟dcm2niix一樣: 列方向上下翻轉，切片沿法向量遞增排列(count越大位置越往-normal，所以也翻轉)，最後LPS轉RAS
+        dy, dx = self.pixel_spacing  # PixelSpacing = [row spacing, column spacing]
+        origin = self.position + (rows - 1) * dy * self.col_vector - (n_slices - 1) * self.slice_thickness * self.normal_vector
+        affine_lps = np.eye(4)
+        affine_lps[:3, 0] = self.row_vector * dx
+        affine_lps[:3, 1] = -self.col_vector * dy
+        affine_lps[:3, 2] = self.normal_vector * self.slice_thickness
+        affine_lps[:3, 3] = origin
+        return np.diag([-1., -1., 1., 1.]) @ affine_lps
+
+    def to_nifti(self, volume):
+        """
+        volume: (rows, cols, n_slices)，依count排列(index 0是landmark)
+        """
+        rows, _, n_slices = volume.shape
+        data = np.ascontiguousarray(np.transpose(volume, (1, 0, 2))[:, ::-1, ::-1]).astype('int16')
+        affine = self.affine(rows, n_slices)
+        nii = nib.Nifti1Image(data, affine)
+        nii.set_qform(affine, code=1)
+        nii.set_sform(affine, code=1)
+        slope = float(getattr(self.template, 'RescaleSlope', 1) or 1)
+        inter = float(getattr(self.template, 'RescaleIntercept', 0) or 0)
+        if (slope, inter) != (1.0, 0.0):
+            nii.header.set_slope_inter(slope, inter)
+        return nii
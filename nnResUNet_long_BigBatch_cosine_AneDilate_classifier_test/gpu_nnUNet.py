@@ -12,8 +12,10 @@ import multiprocessing
 import os
 import shutil
 import traceback
-from asyncio import sleep
+from collections import OrderedDict
+from contextlib import nullcontext
 from copy import deepcopy
+from functools import partial
 from typing import Tuple, Union, List
 
 import nnunetv2
@@ -139,6 +141,108 @@ def auto_detect_available_folds(model_training_output_dir, checkpoint_name):
     print(f'found the following folds: {use_folds}')
     return use_folds
 
+#同一個process重複predict時不再torch.load，key為(模型資料夾, folds, checkpoint, plans)
+#LRU只留最近的_MODEL_CACHE_SIZE組模型，被擠掉的連同它的fold ensemble一起釋放
+_LOADED_MODELS_CACHE = OrderedDict()
+_MODEL_CACHE_SIZE = 2
+
+def load_what_we_need_cached(model_training_output_dir, use_folds, checkpoint_name, plans_json_name='nnUNetPlans_5L-b900.json'):
+    folds_key = tuple([use_folds]) if isinstance(use_folds, str) else tuple(use_folds)
+    key = (os.path.realpath(model_training_output_dir), folds_key, checkpoint_name, plans_json_name)
+    if key in _LOADED_MODELS_CACHE:
+        _LOADED_MODELS_CACHE.move_to_end(key)
+        return _LOADED_MODELS_CACHE[key]
+    _LOADED_MODELS_CACHE[key] = load_what_we_need(model_training_output_dir, use_folds, checkpoint_name, plans_json_name)
+    while len(_LOADED_MODELS_CACHE) > _MODEL_CACHE_SIZE:
+        _, evicted = _LOADED_MODELS_CACHE.popitem(last=False)
+        _FOLD_ENSEMBLE_CACHE.pop(id(evicted[0]), None)
+    return _LOADED_MODELS_CACHE[key]
+
+#fold ensemble: 每個fold各自一個常駐網路，同一個patch batch依序跑過所有fold，softmax後平均
+class FoldEnsemble(object):
+    def __init__(self, network: nn.Module, parameters: List[dict], device: torch.device,
+                 max_resident_mb: float = None):
+        self.parameters = parameters
+        self.device = device
+        self.max_resident_bytes = None if max_resident_mb is None else int(max_resident_mb * 1024 ** 2)
+        self.networks = []
+        for idx, params in enumerate(parameters):
+            net = deepcopy(network).to('cpu')
+            net.load_state_dict(params)
+            net.eval()
+            self.networks.append(net)
+            #原始權重已經複製進net，list裡換成net自己的state_dict(同一份tensor)，CPU上每個fold只留一份權重
+            parameters[idx] = net.state_dict()
+        # LRU: 放在device上的fold，超過記憶體預算就把最久沒用的移回cpu
+        self._resident = OrderedDict()
+
+    @staticmethod
+    def _module_bytes(net: nn.Module) -> int:
+        return sum(t.numel() * t.element_size() for t in list(net.parameters()) + list(net.buffers()))
+
+    def _acquire(self, idx: int) -> nn.Module:
+        net = self.networks[idx]
+        if idx in self._resident:
+            self._resident.move_to_end(idx)
+            return net
+        size = self._module_bytes(net)
+        if self.max_resident_bytes is not None:
+            while len(self._resident) > 0 and sum(self._resident.values()) + size > self.max_resident_bytes:
+                old_idx, _ = self._resident.popitem(last=False)
+                self.networks[old_idx].to('cpu')
+        net.to(self.device)
+        self._resident[idx] = size
+        return net
+
+    def to(self, device: torch.device):
+        if device != self.device:
+            for idx in list(self._resident.keys()):
+                self.networks[idx].to('cpu')
+            self._resident.clear()
+            self.device = device
+        return self
+
+    def eval(self):
+        return self
+
+    def __len__(self):
+        return len(self.networks)
+
+    def predict_probabilities(self, x: torch.Tensor, mirror_axes: Tuple[int, ...] = None,
+                              has_classifier_output: bool = False) -> torch.Tensor:
+        # 已在device上的fold先跑，減少LRU搬移
+        order = list(self._resident.keys()) + [i for i in range(len(self.networks)) if i not in self._resident]
+        probabilities = None
+        for idx in order:
+            net = self._acquire(idx)
+            prediction = torch.softmax(maybe_mirror_and_predict(net, x, mirror_axes, has_classifier_output), 1)
+            probabilities = prediction if probabilities is None else probabilities + prediction
+        return probabilities / len(self.networks)
+
+#key為parameters(load_what_we_need的fold權重list)，一組權重只有一個ensemble，最多留_MODEL_CACHE_SIZE個
+_FOLD_ENSEMBLE_CACHE = OrderedDict()
+
+def get_fold_ensemble(network: nn.Module, parameters: List[dict], device: torch.device,
+                      max_resident_mb: float = None) -> FoldEnsemble:
+    key = id(parameters)
+    ensemble = _FOLD_ENSEMBLE_CACHE.get(key)
+    if ensemble is None or ensemble.parameters is not parameters:
+        ensemble = FoldEnsemble(network, parameters, device, max_resident_mb)
+        _FOLD_ENSEMBLE_CACHE[key] = ensemble
+        while len(_FOLD_ENSEMBLE_CACHE) > _MODEL_CACHE_SIZE:
+            _FOLD_ENSEMBLE_CACHE.popitem(last=False)
+    else:
+        _FOLD_ENSEMBLE_CACHE.move_to_end(key)
+        ensemble.max_resident_bytes = None if max_resident_mb is None else int(max_resident_mb * 1024 ** 2)
+    return ensemble.to(device)
+
+#把一個batch轉成softmax機率，單一網路或fold ensemble都走這裡
+def predict_probabilities(network: Union[nn.Module, FoldEnsemble], x: torch.Tensor, mirror_axes: Tuple[int, ...] = None,
+                          has_classifier_output: bool = False) -> torch.Tensor:
+    if isinstance(network, FoldEnsemble):
+        return network.predict_probabilities(x, mirror_axes, has_classifier_output)
+    return torch.softmax(maybe_mirror_and_predict(network, x, mirror_axes, has_classifier_output), 1)
+
 #計算高斯map
 def compute_gaussian(tile_size: Tuple[int, ...], sigma_scale: float = 1. / 8, dtype=np.float16) \
         -> np.ndarray:
@@ -208,6 +312,38 @@ def get_sliding_window_generator(image_size: Tuple[int, ...], tile_size: Tuple[i
                     slicer = tuple([slice(None), *[slice(si, si + ti) for si, ti in zip((sx, sy, sz), tile_size)]])
                     yield slicer
 
+#vessel-aware tile planner: 先在降採樣的vessel mask上算出有血管的tile，只回傳這些tile的slicer
+#降採樣用max pool(ceil)，得到的是有血管tile的超集合，不會漏掉任何血管
+def plan_vessel_tiles(vessel_image: torch.Tensor, tile_size: Tuple[int, ...], tile_step_size: float,
+                      downsample: int = 4, verbose: bool = False):
+    image_size = tuple(vessel_image.shape[1:])
+    if len(tile_size) != 3 or len(image_size) != 3:
+        # 2D tile走原本的generator逐一檢查
+        all_slicers = list(get_sliding_window_generator(image_size, tile_size, tile_step_size, verbose=verbose))
+        return [sl for sl in all_slicers if torch.any(vessel_image[sl] > 0)], len(all_slicers)
+
+    steps = compute_steps_for_sliding_window(image_size, tile_size, tile_step_size)
+    occupancy = (vessel_image[0] > 0).float()[None, None]
+    occupancy = F.max_pool3d(occupancy, kernel_size=downsample, stride=downsample, ceil_mode=True)[0, 0]
+
+    # summed-area table(前面補一層0)，每個tile的血管數用8項加減一次算完
+    sat = torch.zeros([i + 1 for i in occupancy.shape], dtype=torch.int64, device=occupancy.device)
+    sat[1:, 1:, 1:] = occupancy.to(torch.int64).cumsum(0).cumsum(1).cumsum(2)
+    lo = [torch.tensor([i // downsample for i in steps[d]], device=sat.device) for d in range(3)]
+    hi = [torch.tensor([-(-(i + tile_size[d]) // downsample) for i in steps[d]], device=sat.device) for d in range(3)]
+    x0, x1 = lo[0][:, None, None], hi[0][:, None, None]
+    y0, y1 = lo[1][None, :, None], hi[1][None, :, None]
+    z0, z1 = lo[2][None, None, :], hi[2][None, None, :]
+    counts = sat[x1, y1, z1] - sat[x0, y1, z1] - sat[x1, y0, z1] - sat[x1, y1, z0] \
+             + sat[x0, y0, z1] + sat[x0, y1, z0] + sat[x1, y0, z0] - sat[x0, y0, z0]
+
+    # nonzero是row-major，順序跟get_sliding_window_generator相同
+    slicers = [tuple([slice(None), *[slice(steps[d][idx[d]], steps[d][idx[d]] + tile_size[d]) for d in range(3)]])
+               for idx in torch.nonzero(counts > 0).tolist()]
+    if verbose: print(f'n_steps {counts.numel()}, occupied {len(slicers)}, image size is {image_size}, '
+                      f'tile_size {tile_size}, tile_step_size {tile_step_size}')
+    return slicers, int(counts.numel())
+
 #是否要更複雜的inference(可選)
 def maybe_mirror_and_predict(network: nn.Module, x: torch.Tensor, mirror_axes: Tuple[int, ...] = None, 
                             has_classifier_output: bool = False) \
@@ -243,7 +379,7 @@ def maybe_mirror_and_predict(network: nn.Module, x: torch.Tensor, mirror_axes: T
 #sliding_window的pipeline，最需要改的地方
 import torch.nn.functional as F
 
-def predict_sliding_window_return_logits(network: nn.Module,
+def predict_sliding_window_return_logits(network: Union[nn.Module, FoldEnsemble],
                                          input_image: Union[np.ndarray, torch.Tensor],
                                          vessel_image: Union[np.ndarray, torch.Tensor],
                                          num_segmentation_heads: int,
@@ -325,7 +461,7 @@ def predict_sliding_window_return_logits(network: nn.Module,
                 # 不使用 gaussian 時，設置為 None 以節省記憶體
                 gaussian = None
                     
-            slicers = get_sliding_window_generator(data.shape[1:], tile_size, tile_step_size, verbose=verbose)
+            slicers, n_tiles = plan_vessel_tiles(data_vessel, tile_size, tile_step_size, verbose=verbose)
 
             # preallocate results and num_predictions. Move everything to the correct device
             try:
@@ -347,102 +483,30 @@ def predict_sliding_window_return_logits(network: nn.Module,
             finally:
                 empty_cache(device)
 
-            if use_gaussian:
-                # 使用 gaussian 權重的情況：需要處理所有 patches
-                # 收集所有需要處理的 patches 和對應的 slicers
-                patches_to_process = []
-                slicers_to_process = []
-                
-                for sl in slicers:
-                    #只預測有血管的地方
-                    if torch.sum(data_vessel[sl]) > 0:
-                        workon = data[sl][None]
-                        patches_to_process.append(workon)
-                        slicers_to_process.append(sl)
-                    else:
-                        # 對於沒有血管的地方，直接設置為零
-                        prediction = torch.zeros((num_segmentation_heads, *tile_size)).to(results_device)
+            # 只跑有血管的tile。每個血管voxel所在的tile一定都有血管，所以空白tile只會影響最後乘上vessel後變0的voxel，
+            # 直接略過不累加：血管voxel的權重和不變，沒被覆蓋的地方n_predictions為0，下面安全除法後保持0
+            if verbose:
+                mode = 'Gaussian模式' if use_gaussian else '非Gaussian模式'
+                print(f"[{mode}] 跳過 {n_tiles - len(slicers)} 個空白 patches，只處理 {len(slicers)} 個有血管的 patches，使用 batch_size={batch_size}")
+
+            for i in range(0, len(slicers), batch_size):
+                batch_slicers = slicers[i:i + batch_size]
+
+                # 將 batch 中的 patches 組合成一個 tensor
+                batch_tensor = torch.stack([data[sl] for sl in batch_slicers]).to(device, non_blocking=False)
+
+                # 批次預測，softmax在predict_probabilities內做，fold ensemble時是各fold softmax後的平均
+                batch_predictions = predict_probabilities(network, batch_tensor, mirror_axes, has_classifier_output).to(results_device)
+
+                # 處理每個預測結果
+                for prediction, sl in zip(batch_predictions, batch_slicers):
+                    if use_gaussian:
                         predicted_logits[sl] += prediction * gaussian
                         n_predictions[sl[1:]] += gaussian
-                
-                # 批次處理有血管的 patches
-                if len(patches_to_process) > 0:
-                    if verbose:
-                        print(f"[Gaussian模式] 處理 {len(patches_to_process)} 個有血管的 patches，使用 batch_size={batch_size}")
-                    
-                    for i in range(0, len(patches_to_process), batch_size):
-                        batch_end = min(i + batch_size, len(patches_to_process))
-                        batch_patches = patches_to_process[i:batch_end]
-                        batch_slicers = slicers_to_process[i:batch_end]
-                        
-                        # 將 batch 中的 patches 組合成一個 tensor
-                        batch_tensor = torch.cat(batch_patches, dim=0).to(device, non_blocking=False)
-                        
-                        # 批次預測
-                        #start_time_batch = time.time()
-                        batch_predictions = maybe_mirror_and_predict(network, batch_tensor, mirror_axes, has_classifier_output).to(results_device)
-                        #print(f"[Done] maybe_mirror_and_predict no. {i} spend {time.time() - start_time_batch:.3f} sec")
-                        
-                        
-                        # 處理每個預測結果
-                        for j, (prediction, sl) in enumerate(zip(batch_predictions, batch_slicers)):
-                            # prediction 這邊直接套用 softmax 去正規化輸出
-                            prediction = torch.softmax(prediction, 0)
-                            
-                            # 使用高斯權重
-                            predicted_logits[sl] += prediction * gaussian
-                            n_predictions[sl[1:]] += gaussian
-            else:
-                # 不使用 gaussian 權重的情況：可以完全跳過沒有血管的區域，大幅加速
-                patches_to_process = []
-                slicers_to_process = []
-                all_slicers = list(slicers)  # 先轉換成 list 以便重複使用
-                
-                # 只收集有血管的 patches，完全跳過空白區域
-                for sl in all_slicers:
-                    if torch.sum(data_vessel[sl]) > 0:
-                        workon = data[sl][None]
-                        patches_to_process.append(workon)
-                        slicers_to_process.append(sl)
-                
-                if len(patches_to_process) > 0:
-                    if verbose:
-                        total_patches = len(all_slicers)
-                        print(f"[非Gaussian模式] 跳過 {total_patches - len(patches_to_process)} 個空白 patches，只處理 {len(patches_to_process)} 個有血管的 patches，使用 batch_size={batch_size}")
-                    
-                    for i in range(0, len(patches_to_process), batch_size):
-                        batch_end = min(i + batch_size, len(patches_to_process))
-                        batch_patches = patches_to_process[i:batch_end]
-                        batch_slicers = slicers_to_process[i:batch_end]
-                        
-                        # 將 batch 中的 patches 組合成一個 tensor
-                        batch_tensor = torch.cat(batch_patches, dim=0).to(device, non_blocking=False)
-                        
-                        # 批次預測
-                        start_time_batch = time.time()
-                        batch_predictions = maybe_mirror_and_predict(network, batch_tensor, mirror_axes, has_classifier_output).to(results_device)
-                        print(f"[Done] maybe_mirror_and_predict no. {i} spend {time.time() - start_time_batch:.3f} sec")
-                        
-                        # 處理每個預測結果
-                        for j, (prediction, sl) in enumerate(zip(batch_predictions, batch_slicers)):
-                            # prediction 這邊直接套用 softmax 去正規化輸出
-                            prediction = torch.softmax(prediction, 0)
-                            
-                            # 不使用高斯權重，直接累加
-                            predicted_logits[sl] += prediction
-                            n_predictions[sl[1:]] += 1
-                
-                # 對於完全沒有血管的區域，設置一個預設的背景預測
-                # 這樣可以避免這些區域保持未初始化狀態
-                if len(patches_to_process) < len(all_slicers):
-                    # 創建背景預測：[1.0, 0.0] 表示背景類別的機率為 1
-                    background_prediction = torch.zeros((num_segmentation_heads, *tile_size), device=results_device)
-                    background_prediction[0] = 1.0  # 背景類別設為 1
-                    
-                    for sl in all_slicers:
-                        if torch.sum(data_vessel[sl]) == 0:  # 沒有血管的區域
-                            predicted_logits[sl] += background_prediction
-                            n_predictions[sl[1:]] += 1
+                    else:
+                        # 不使用高斯權重，直接累加
+                        predicted_logits[sl] += prediction
+                        n_predictions[sl[1:]] += 1
 
             # 安全除法，避免除以零產生 NaN
             # 對於 n_predictions 為 0 的位置，保持 predicted_logits 為 0
@@ -456,7 +520,7 @@ def predict_sliding_window_return_logits(network: nn.Module,
                 total_voxels = torch.numel(n_predictions)
                 if zero_predictions > 0:
                     print(f"警告：有 {zero_predictions}/{total_voxels} 個體素沒有被任何 patch 覆蓋到")
-                    print(f"這些位置將保持為零值（通常是影像邊緣或完全沒有血管的區域）")
+                    print(f"這些位置將保持為零值（只被空白tile覆蓋的區域，乘上vessel後本來就是0）")
             #print('predicted_logits.shape:', predicted_logits.shape, ' data_vessel.shape:', data_vessel.shape)
             #predicted_logits.shape: torch.Size([2, 127, 512, 512])  data_vessel.shape: torch.Size([1, 127, 512, 512])
             
@@ -597,6 +661,10 @@ def export_prediction_probabilities(predicted_array_or_file: Union[np.ndarray, s
     #這邊用額外的自寫輸出成nifti方式好惹
     write_probabilities(probs_reverted_cropping[0,:,:,:], output_file_truncated + dataset_json_dict_or_file['file_ending'], img_nii)
 
+#export_pool的callback，記錄單一case的latency
+def _record_export_done(export_latency, case_name, start_time, _result):
+    export_latency[case_name] = time.time() - start_time
+
 #從raw data開始處理的pipeline
 def predict_from_raw_data(list_of_lists_or_source_folder: Union[str, List[List[str]]],
                           Mask_list_of_lists_or_Mask_folder: Union[str, List[List[str]]],
@@ -620,7 +688,9 @@ def predict_from_raw_data(list_of_lists_or_source_folder: Union[str, List[List[s
                           part_id: int = 0,
                           desired_gpu_index : int = 0,
                           device: torch.device = torch.device('cuda'),
-                          batch_size: int = 1):
+                          batch_size: int = 1,
+                          preloaded_models: tuple = None,
+                          fold_memory_budget_mb: float = None):
     print("\n#######################################################################\nPlease cite the following paper "
           "when using nnU-Net:\n"
           "Isensee, F., Jaeger, P. F., Kohl, S. A., Petersen, J., & Maier-Hein, K. H. (2021). "
@@ -640,6 +710,8 @@ def predict_from_raw_data(list_of_lists_or_source_folder: Union[str, List[List[s
     # let's store the input arguments so that its clear what was used to generate the prediction
     my_init_kwargs = {}
     for k in inspect.signature(predict_from_raw_data).parameters.keys():
+        if k == 'preloaded_models':  # 權重不寫進json
+            continue
         my_init_kwargs[k] = locals()[k]
     my_init_kwargs = deepcopy(my_init_kwargs)  # let's not unintentionally change anything in-place. Take this as a
     # safety precaution.
@@ -647,14 +719,14 @@ def predict_from_raw_data(list_of_lists_or_source_folder: Union[str, List[List[s
     maybe_mkdir_p(output_folder)
     save_json(my_init_kwargs, join(output_folder, 'predict_from_raw_data_args.json'))
 
-    if use_folds is None:
-        use_folds = auto_detect_available_folds(model_training_output_dir, checkpoint_name)
-
     # load all the stuff we need from the model_training_output_dir
-    # 這邊獲得都是模型的參數
+    # 這邊獲得都是模型的參數，常駐worker會直接傳入已載入的preloaded_models(load_what_we_need的輸出)，避免每個case重讀checkpoint
+    if preloaded_models is None:
+        if use_folds is None:
+            use_folds = auto_detect_available_folds(model_training_output_dir, checkpoint_name)
+        preloaded_models = load_what_we_need_cached(model_training_output_dir, use_folds, checkpoint_name, plans_json_name)
     parameters, configuration_manager, inference_allowed_mirroring_axes, \
-    plans_manager, dataset_json, network, trainer_name = \
-        load_what_we_need(model_training_output_dir, use_folds, checkpoint_name, plans_json_name)
+    plans_manager, dataset_json, network, trainer_name = preloaded_models
     
     print('總共有幾個網路parameters(同時拿幾個網路預測):', len(parameters)) #用來得知網路參數有幾個
     
@@ -739,10 +811,17 @@ def predict_from_raw_data(list_of_lists_or_source_folder: Union[str, List[List[s
     # spawn allows the use of GPU in the background process in case somebody wants to do this. Not recommended. Trust me.
     # export_pool = multiprocessing.get_context('spawn').Pool(num_processes_segmentation_export)
     # export_pool = multiprocessing.Pool(num_processes_segmentation_export)
-    with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export) as export_pool:
-        network = network.to(device)
+    #只有一個case(pipeline的用法)時沒有下一個case可以重疊，直接在這個程序裡export；
+    #開spawn pool反而要把整個float機率圖pickle到子程序，子程序還會重新import呼叫端的__main__(tensorflow/torch)
+    export_inline = len(list_of_lists_or_source_folder) == 1
+    export_context = nullcontext() if export_inline else \
+        multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export)
+    with export_context as export_pool:
+        ensemble = get_fold_ensemble(network, parameters, device, fold_memory_budget_mb)
 
         r = []
+        export_latency = {}
+        start_all = time.time()
         with torch.no_grad():
             for preprocessed, nii_path in zip(mta, list_of_lists_or_source_folder):
                 start_time = time.time()
@@ -768,9 +847,10 @@ def predict_from_raw_data(list_of_lists_or_source_folder: Union[str, List[List[s
 
                 # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
                 # npy files
-                proceed = not check_workers_busy(export_pool, r, allowed_num_queued=len(export_pool._pool))
+                #backpressure: export排隊太多就先等，原本用的是asyncio.sleep(只產生coroutine不會等)
+                proceed = export_inline or not check_workers_busy(export_pool, r, allowed_num_queued=len(export_pool._pool))
                 while not proceed:
-                    sleep(1)
+                    time.sleep(0.1)
                     proceed = not check_workers_busy(export_pool, r, allowed_num_queued=len(export_pool._pool))
 
                 # we have some code duplication here but this allows us to run with perform_everything_on_gpu=True as
@@ -779,13 +859,11 @@ def predict_from_raw_data(list_of_lists_or_source_folder: Union[str, List[List[s
                 prediction = None
                 overwrite_perform_everything_on_gpu = perform_everything_on_gpu
                 #目前是走perform_everything_on_gpu = 1
+                #所有fold常駐在ensemble裡，每個patch batch跑完全部fold才換下一個batch，patch只切一次、高斯權重只加一次
                 if perform_everything_on_gpu:
                     try:
-                        for params in parameters:
-                            network.load_state_dict(params)
-                            if prediction is None:
-                                prediction = predict_sliding_window_return_logits(
-                            network, data, data_vessel, num_seg_heads,
+                        prediction = predict_sliding_window_return_logits(
+                            ensemble, data, data_vessel, num_seg_heads,
                             configuration_manager.patch_size,
                             mirror_axes=inference_allowed_mirroring_axes if use_mirroring else None,
                             tile_step_size=tile_step_size,
@@ -796,21 +874,6 @@ def predict_from_raw_data(list_of_lists_or_source_folder: Union[str, List[List[s
                             device=device,
                             batch_size=batch_size,
                             has_classifier_output=has_classifier_output)
-                            else:
-                                prediction += predict_sliding_window_return_logits(
-                                    network, data, data_vessel, num_seg_heads,
-                                    configuration_manager.patch_size,
-                                    mirror_axes=inference_allowed_mirroring_axes if use_mirroring else None,
-                                    tile_step_size=tile_step_size,
-                                    use_gaussian=use_gaussian,
-                                    precomputed_gaussian=inference_gaussian,
-                                    perform_everything_on_gpu=perform_everything_on_gpu,
-                                    verbose=verbose,
-                                    device=device,
-                                    batch_size=batch_size,
-                                    has_classifier_output=has_classifier_output)
-                            if len(parameters) > 1:
-                                prediction /= len(parameters)
 
                     except RuntimeError:
                         print('Prediction with perform_everything_on_gpu=True failed due to insufficient GPU memory. '
@@ -822,67 +885,58 @@ def predict_from_raw_data(list_of_lists_or_source_folder: Union[str, List[List[s
 
                 #如果gpu失敗，走以下
                 if prediction is None:
-                    for params in parameters:
-                        network.load_state_dict(params)
-                        if prediction is None:
-                            prediction = predict_sliding_window_return_logits(
-                                network, data, data_vessel, num_seg_heads,
-                                configuration_manager.patch_size,
-                                mirror_axes=inference_allowed_mirroring_axes if use_mirroring else None,
-                                tile_step_size=tile_step_size,
-                                use_gaussian=use_gaussian,
-                                precomputed_gaussian=inference_gaussian,
-                                perform_everything_on_gpu=perform_everything_on_gpu,
-                                verbose=verbose,
-                                device=device,
-                                batch_size=batch_size,
-                                has_classifier_output=has_classifier_output)
-                        else:
-                            prediction += predict_sliding_window_return_logits(
-                                network, data, data_vessel, num_seg_heads,
-                                configuration_manager.patch_size,
-                                mirror_axes=inference_allowed_mirroring_axes if use_mirroring else None,
-                                tile_step_size=tile_step_size,
-                                use_gaussian=use_gaussian,
-                                precomputed_gaussian=inference_gaussian,
-                                perform_everything_on_gpu=perform_everything_on_gpu,
-                                verbose=verbose,
-                                device=device,
-                                batch_size=batch_size,
-                                has_classifier_output=has_classifier_output)
-                        if len(parameters) > 1:
-                            prediction /= len(parameters)
+                    prediction = predict_sliding_window_return_logits(
+                        ensemble, data, data_vessel, num_seg_heads,
+                        configuration_manager.patch_size,
+                        mirror_axes=inference_allowed_mirroring_axes if use_mirroring else None,
+                        tile_step_size=tile_step_size,
+                        use_gaussian=use_gaussian,
+                        precomputed_gaussian=inference_gaussian,
+                        perform_everything_on_gpu=overwrite_perform_everything_on_gpu,
+                        verbose=verbose,
+                        device=device,
+                        batch_size=batch_size,
+                        has_classifier_output=has_classifier_output)
 
                 print('Prediction done, transferring to CPU if needed')
                 prediction = prediction.to('cpu').numpy()
                 
                 #print('final prediction.shape:', prediction.shape)
-                if should_i_save_to_file(prediction, r, export_pool):
+                if not export_inline and should_i_save_to_file(prediction, r, export_pool):
                     print(
                         'output is either too large for python process-process communication or all export workers are '
                         'busy. Saving temporarily to file...')
                     np.save(ofile + '.npy', prediction)
                     prediction = ofile + '.npy'
 
-                """
-                # this needs to go into background processes
-                # export_prediction(prediction, properties, configuration_name, plans, dataset_json, ofile,
-                #                   save_probabilities)
+                # resampling、revert cropping跟nifti寫檔丟到背景的export_pool，主程式直接去做下一個case的前處理跟inference
+                # vessel_image在export裡沒用到，不送過去省下process間傳輸
+                print(f"[Done Inference {os.path.basename(ofile)}] spend {time.time() - start_time:.2f} sec")
+                if export_inline:
+                    export_prediction_probabilities(prediction, properties, None, img_nii, configuration_manager,
+                                                    plans_manager, dataset_json, ofile, save_probabilities)
+                    _record_export_done(export_latency, os.path.basename(ofile), start_time, None)
+                    continue
                 print('sending off prediction to background worker for resampling and export')
                 r.append(
-                    export_pool.starmap_async(
-                        export_prediction_probabilities, ((prediction, properties, configuration_manager, plans_manager,
-                                                          dataset_json, ofile, save_probabilities),)
+                    export_pool.apply_async(
+                        export_prediction_probabilities,
+                        (prediction, properties, None, img_nii, configuration_manager, plans_manager,
+                         dataset_json, ofile, save_probabilities),
+                        callback=partial(_record_export_done, export_latency, os.path.basename(ofile), start_time)
                     )
                 )
-                print(f'done with {os.path.basename(ofile)}')
-                """
-                print(f"[Done] spend {time.time() - start_time:.2f} sec")
-                export_prediction_probabilities(prediction, properties, data_vessel, img_nii, configuration_manager, plans_manager,
-                                                dataset_json, ofile, save_probabilities)
-                
-                print(f"[Done] spend {time.time() - start_time:.2f} sec")
-        #[i.get() for i in r]
+
+            #等所有export寫完才return，呼叫端接著就會讀Prob.nii.gz
+            [i.get() for i in r]
+
+        #latency是單一case從拿到前處理結果到nifti寫完，throughput是整批的case數/總時間
+        total_time = time.time() - start_all
+        for case_name, latency in export_latency.items():
+            print(f"[Latency] {case_name}: {latency:.2f} sec")
+        if len(export_latency) > 0:
+            print(f"[Throughput] {len(export_latency)} cases in {total_time:.2f} sec, "
+                  f"{len(export_latency) / total_time:.3f} cases/sec")
 
 
 #主程式
@@ -13,6 +13,7 @@ warnings.filterwarnings("ignore") # 忽略警告输出
 
 # 所有import移到最上方，刪除重複與未使用的import
 import os
+import sys
 import time
 import numpy as np
 import logging
@@ -36,7 +37,11 @@ from IPython.display import clear_output
 import math
 from collections import OrderedDict
 import matplotlib.colors as mcolors
-from gpu_aneurysm import model_predict_aneurysm
+from gpu_aneurysm import model_predict_aneurysm, setup_tf_gpu
+from gpu_aneurysm_worker import submit_case, worker_is_alive, DEFAULT_SOCKET
+from case_context import CaseContext
+from stage_dag import StageDAG
+from stage_trace import Tracer
 import pynvml  # GPU memory info
 from util_aneurysm import reslice_nifti_pred_nobrain, create_MIP_pred, AneurysmPipeline, \
     create_dicomseg_multi_file, compress_dicom_into_jpeglossless, orthanc_zip_upload, upload_json_aiteam, \
@@ -92,8 +97,15 @@ def pipeline_aneurysm(ID,
                       path_outdcm = '',
                       path_json = '/mnt/e/pipeline/chuan/json/',
                       path_log = '/mnt/e/pipeline/chuan/log/', 
-                      gpu_n = 0
+                      gpu_n = 0,
+                      worker_socket = DEFAULT_SOCKET,
+                      targets = None,
+                      check_gpu_memory = True,
+                      require_done = None
                       ):
+    #targets: 只跑到指定的stage(例如job_queue先只跑['inference'])，其餘的下次呼叫時從checkpoint接著做
+    #require_done: 必須已經在checkpoint裡完成的stage，沒完成就失敗不重跑(job_queue的post階段用['inference'])
+    #gpu_n < 0 代表只用CPU；check_gpu_memory=False 時不用60%門檻擋掉(job_queue已依記憶體預算排程)
 
     #當使用gpu有錯時才確認
     logger = tf.get_logger()
@@ -114,20 +126,28 @@ def pipeline_aneurysm(ID,
 
     logging.info('!!! Pre_Aneurysm call.')
 
+    #每個stage的span(wall/cpu時間、RSS、GPU記憶體、讀寫bytes)寫到trace jsonl，stage_trace.py可以轉成OTLP
+    tracer = Tracer(os.path.join(path_log, 'trace_' + time_str_short + '.jsonl'), case=ID)
+    tracer.start('pipeline_aneurysm', gpu_n=gpu_n, targets=targets)
+
     path_processID = os.path.join(path_processModel, ID)  #前處理dicom路徑(test case)
     if not os.path.isdir(path_processID):  #如果資料夾不存在就建立
         os.mkdir(path_processID) #製作nii資料夾
 
     print(ID, ' Start...')
     logging.info(ID + ' Start...')
+    code_pass = 0 #確定是否成功，回傳給呼叫端(job_queue看exit code)
 
     #依照不同情境拆分try需要小心的事項 <= 重要
     try:
         # %% Deep learning相關
-        pynvml.nvmlInit()  # 初始化
-        handle = pynvml.nvmlDeviceGetHandleByIndex(gpu_n)  # 获取GPU i的handle，后续通过handle来处理
-        memoryInfo = pynvml.nvmlDeviceGetMemoryInfo(handle)  # 通过handle获取GPU i的信息
-        gpumRate = memoryInfo.used / memoryInfo.total
+        gpumRate = 0
+        #常駐worker本身就佔著這顆GPU的記憶體，用使用率擋的話有worker時永遠跑不了，交給worker排隊
+        if check_gpu_memory and gpu_n >= 0 and not (worker_socket and worker_is_alive(worker_socket)):
+            pynvml.nvmlInit()  # 初始化
+            handle = pynvml.nvmlDeviceGetHandleByIndex(gpu_n)  # 获取GPU i的handle，后续通过handle来处理
+            memoryInfo = pynvml.nvmlDeviceGetMemoryInfo(handle)  # 通过handle获取GPU i的信息
+            gpumRate = memoryInfo.used / memoryInfo.total
         # print('gpumRate:', gpumRate) #先設定gpu使用率小於0.2才跑predict code
 
         if gpumRate < 0.6:
@@ -136,19 +156,10 @@ def pipeline_aneurysm(ID,
             autotune = tf.data.experimental.AUTOTUNE
             # print(keras.__version__)
             # print(tf.__version__)
-            gpus = tf.config.experimental.list_physical_devices(device_type='GPU')
-            tf.config.experimental.set_visible_devices(devices=gpus[gpu_n], device_type='GPU')
-            # print(gpus, cpus)
-            tf.config.experimental.set_memory_growth(gpus[gpu_n], True)
-
-            #先判斷有無影像，複製過去
-            #print('ADC_file:', ADC_file, ' copy:', os.path.join(path_nii, ID + '_ADC.nii.gz'))
-            shutil.copy(MRA_BRAIN_file, os.path.join(path_processID, 'MRA_BRAIN.nii.gz'))
-            
-            #接下來，以下運行gpu領域
-            #以下做predict，為了避免gpu out of memory，還是以.sh來執行好惹
-            #gpu_line = 'bash ' + path_code + 'gpu_stroke.sh ' + ID + ' ' + path_processID
-            #os.system(gpu_line)
+            setup_tf_gpu(gpu_n)
+
+            #CaseContext: 各stage共用解碼後的nifti，需要路徑的地方用hard link取代shutil.copy
+            ctx = CaseContext(ID, path_processID)
 
             #所以這裡建立2個資料夾，一個是君彥的模型結果，一個是nnU-Net的模型結果
             path_tensorflow = os.path.join(path_processID, 'tensorflow')
@@ -162,250 +173,150 @@ def pipeline_aneurysm(ID,
             if not os.path.isdir(path_nnunetlow):  #如果資料夾不存在就建立
                 os.mkdir(path_nnunetlow) #製作nnUNet資料夾
 
-            #因為松諭會用排程，但因為ai跟mip都要用到gpu，所以還是要管gpu ram，#multiprocessing沒辦法釋放gpu，要改用subprocess.run()
-            #model_predict_aneurysm(path_code, path_processID, ID, path_log, gpu_n)
-            print("Running stage 1: Aneurysm inference!!!")
-            logging.info("Running stage 1: Aneurysm inference!!!")
-
-            # 定義要傳入的參數，建立指令
-            cmd = [
-                   "python", "/data/4TB1/pipeline/chuan/code/gpu_aneurysm.py",
-                   "--path_code", path_code,
-                   "--path_process", path_processID,
-                   "--path_nnunet_model", path_nnunet_model,
-                   "--case", ID,
-                   "--path_log", path_log,
-                   "--gpu_n", str(gpu_n)  # 注意要轉成字串
-                  ]
-
-            #result = subprocess.run(cmd, capture_output=True, text=True) 這會讓 subprocess.run() 自動幫你捕捉 stdout 和 stderr 的輸出，不然預設是印在 terminal 上，不會儲存。
-            # 執行 subprocess
-            start = time.time()
-            subprocess.run(cmd)
-            print(f"[Done AI Inference... ] spend {time.time() - start:.0f} sec")
-            logging.info(f"[Done AI Inference... ] spend {time.time() - start:.0f} sec")
-
-            #接下來做mip影像，這邊要改分別在nnU-Net跟tensorflow的資料夾做mip影像
-            # path_dcm_t = os.path.join(path_tensorflow, 'Dicom')
-            # path_nii_t = os.path.join(path_tensorflow, 'Image_nii')
-            # path_reslice_t = os.path.join(path_tensorflow, 'Image_reslice')
-            # path_excel_t = os.path.join(path_tensorflow, 'excel')
-            # if not os.path.isdir(path_dcm_t):  #如果資料夾不存在就建立
-            #     os.mkdir(path_dcm_t) #製作nii資料夾
-            # if not os.path.isdir(path_nii_t):  #如果資料夾不存在就建立
-            #     os.mkdir(path_nii_t) #製作nii資料夾
-            # if not os.path.isdir(path_reslice_t):  #如果資料夾不存在就建立
-            #     os.mkdir(path_reslice_t) #製作nii資料夾
-            # if not os.path.isdir(path_excel_t):  #如果資料夾不存在就建立
-            #     os.mkdir(path_excel_t) #製作nii資料夾
-
+            #接下來做mip影像，這邊只在nnU-Net的資料夾做(tensorflow跟低閾值的版本見git紀錄)
             path_dcm_n = os.path.join(path_nnunet, 'Dicom')
             path_nii_n = os.path.join(path_nnunet, 'Image_nii')
             path_reslice_n = os.path.join(path_nnunet, 'Image_reslice')
             path_excel_n = os.path.join(path_nnunet, 'excel')
-            if not os.path.isdir(path_dcm_n):  #如果資料夾不存在就建立
-                os.mkdir(path_dcm_n) #製作nii資料夾
-            if not os.path.isdir(path_nii_n):  #如果資料夾不存在就建立
-                os.mkdir(path_nii_n) #製作nii資料夾
-            if not os.path.isdir(path_reslice_n):  #如果資料夾不存在就建立
-                os.mkdir(path_reslice_n) #製作nii資料夾
-            if not os.path.isdir(path_excel_n):  #如果資料夾不存在就建立
-                os.mkdir(path_excel_n) #製作nii資料夾
-
-            # path_dcm_nl = os.path.join(path_nnunetlow, 'Dicom')
-            # path_nii_nl = os.path.join(path_nnunetlow, 'Image_nii')
-            # path_reslice_nl = os.path.join(path_nnunetlow, 'Image_reslice')
-            # path_excel_nl = os.path.join(path_nnunetlow, 'excel')
-            # if not os.path.isdir(path_dcm_nl):  #如果資料夾不存在就建立
-            #     os.mkdir(path_dcm_nl) #製作nii資料夾
-            # if not os.path.isdir(path_nii_nl):  #如果資料夾不存在就建立
-            #     os.mkdir(path_nii_nl) #製作nii資料夾
-            # if not os.path.isdir(path_reslice_nl):  #如果資料夾不存在就建立
-            #     os.mkdir(path_reslice_nl) #製作nii資料夾
-            # if not os.path.isdir(path_excel_nl):  #如果資料夾不存在就建立
-            #     os.mkdir(path_excel_nl) #製作nii資料夾
-
-            #複製nii到nii資料夾
-            # shutil.copy(os.path.join(path_processID, 'MRA_BRAIN.nii.gz'), os.path.join(path_tensorflow, 'MRA_BRAIN.nii.gz'))
-            # shutil.copy(os.path.join(path_processID, 'MRA_BRAIN.nii.gz'), os.path.join(path_nii_t, 'MRA_BRAIN.nii.gz'))
-            # shutil.copy(os.path.join(path_tensorflow, 'Pred.nii.gz'), os.path.join(path_nii_t, 'Pred.nii.gz'))
-            # shutil.copy(os.path.join(path_processID, 'Vessel.nii.gz'), os.path.join(path_nii_t, 'Vessel.nii.gz'))
-
-            shutil.copy(os.path.join(path_processID, 'MRA_BRAIN.nii.gz'), os.path.join(path_nnunet, 'MRA_BRAIN.nii.gz'))
-            shutil.copy(os.path.join(path_processID, 'MRA_BRAIN.nii.gz'), os.path.join(path_nii_n, 'MRA_BRAIN.nii.gz'))
-            shutil.copy(os.path.join(path_nnunet, 'Pred.nii.gz'), os.path.join(path_nii_n, 'Pred.nii.gz'))
-            shutil.copy(os.path.join(path_processID, 'Vessel.nii.gz'), os.path.join(path_nii_n, 'Vessel.nii.gz'))
-            shutil.copy(os.path.join(path_processID, 'Vessel.nii.gz'), os.path.join(path_nnunet, 'Vessel.nii.gz'))
-            shutil.copy(os.path.join(path_processID, 'Vessel_16.nii.gz'), os.path.join(path_nnunet, 'Vessel_16.nii.gz'))
-
-            # shutil.copy(os.path.join(path_processID, 'MRA_BRAIN.nii.gz'), os.path.join(path_nnunetlow, 'MRA_BRAIN.nii.gz'))
-            # shutil.copy(os.path.join(path_processID, 'MRA_BRAIN.nii.gz'), os.path.join(path_nii_nl, 'MRA_BRAIN.nii.gz'))
-            # shutil.copy(os.path.join(path_nnunetlow, 'Pred.nii.gz'), os.path.join(path_nii_nl, 'Pred.nii.gz'))
-            # shutil.copy(os.path.join(path_processID, 'Vessel.nii.gz'), os.path.join(path_nii_nl, 'Vessel.nii.gz'))
-            # shutil.copy(os.path.join(path_processID, 'Vessel_16.nii.gz'), os.path.join(path_nnunetlow, 'Vessel_16.nii.gz'))
-
-            #reslice，所有都要做2次
-            start_reslice = time.time()
-            # reslice_nifti_pred_nobrain(path_nii_t, path_reslice_t)
-            reslice_nifti_pred_nobrain(path_nii_n, path_reslice_n)
-            # reslice_nifti_pred_nobrain(path_nii_nl, path_reslice_nl)
-            print(f"[Done reslice... ] spend {time.time() - start_reslice:.0f} sec")
-            logging.info(f"[Done reslice... ] spend {time.time() - start_reslice:.0f} sec")
-
-            #做mip影像
-            #複製dicom影像
-            # if not os.path.isdir(os.path.join(path_dcm_t, 'MRA_BRAIN')):  #如果資料夾不存在就建立
-            #     shutil.copytree(path_outdcm, os.path.join(path_dcm_t, 'MRA_BRAIN'))
-            if not os.path.isdir(os.path.join(path_dcm_n, 'MRA_BRAIN')):  #如果資料夾不存在就建立
-                shutil.copytree(path_outdcm, os.path.join(path_dcm_n, 'MRA_BRAIN'))
-            # if not os.path.isdir(os.path.join(path_dcm_nl, 'MRA_BRAIN')):  #如果資料夾不存在就建立
-            #     shutil.copytree(path_outdcm, os.path.join(path_dcm_nl, 'MRA_BRAIN'))   
-
-            #這邊對dicom進行解壓縮動作
-            #執行gdcmconv 去還原影像後覆蓋
-            start_decompress_JEPG = time.time()
-            decompress_dicom_with_gdcm(path_dcm_n)
-            print(f"[Done decompress_JEPG... ] spend {time.time() - start_decompress_JEPG:.0f} sec")
-            logging.info(f"[Done decompress_JEPG... ] spend {time.time() - start_decompress_JEPG:.0f} sec")
-
-
-            path_png = os.path.join(path_code, 'png')
-            start_mip = time.time()
-            # create_MIP_pred(path_dcm_t, path_reslice_t, path_png, gpu_n)
-            create_MIP_pred(path_dcm_n, path_reslice_n, path_png, gpu_n)
-            # create_MIP_pred(path_dcm_nl, path_reslice_nl, path_png, gpu_n)
-            print(f"[Done create_MIP_pred... ] spend {time.time() - start_mip:.0f} sec")
-            logging.info(f"[Done create_MIP_pred... ] spend {time.time() - start_mip:.0f} sec")
-
-            shutil.copy(os.path.join(path_reslice_n, 'MIP_Pitch_pred.nii.gz'), os.path.join(path_nnunet, 'MIP_Pitch_pred.nii.gz'))
-            shutil.copy(os.path.join(path_reslice_n, 'MIP_Yaw_pred.nii.gz'), os.path.join(path_nnunet, 'MIP_Yaw_pred.nii.gz'))
-
-            #接下來是計算動脈瘤的各項數據，各做一次
-            start_calculate = time.time()
-            # aneurysm_analysis_pipeline = AneurysmPipeline(path_dcm_t, path_tensorflow, path_excel_t, ID)
-            # aneurysm_analysis_pipeline.run_all()
-            aneurysm_analysis_pipeline = AneurysmPipeline(path_dcm_n, path_nnunet, path_excel_n, ID)
-            aneurysm_analysis_pipeline.run_all()
-            #aneurysm_analysis_pipeline = AneurysmPipeline(path_dcm_nl, path_nnunetlow, path_excel_nl, ID)
-            #aneurysm_analysis_pipeline.run_all()
-            print(f"[Done calculate_aneurysm_long_axis... ] spend {time.time() - start_calculate:.0f} sec")
-            logging.info(f"[Done calculate_aneurysm_long_axis... ] spend {time.time() - start_calculate:.0f} sec")
-
-            #接下來製作dicom-seg
-            # path_dicomseg_t = os.path.join(path_dcm_t, 'Dicom-Seg')
-            # if not os.path.isdir(path_dicomseg_t):  #如果資料夾不存在就建立
-            #     os.mkdir(path_dicomseg_t) #製作nii資料夾
             path_dicomseg_n = os.path.join(path_dcm_n, 'Dicom-Seg')
-            if not os.path.isdir(path_dicomseg_n):  #如果資料夾不存在就建立
-                os.mkdir(path_dicomseg_n) #製作nii資料夾
-            # path_dicomseg_nl = os.path.join(path_dcm_nl, 'Dicom-Seg')
-            # if not os.path.isdir(path_dicomseg_nl):  #如果資料夾不存在就建立
-            #     os.mkdir(path_dicomseg_nl) #製作nii資料夾    
-
-            #上線版不用做vessel
-            start_dicomseg = time.time()
-            # create_dicomseg_multi_file(path_code, path_dcm_t, path_nii_t, path_reslice_t, path_dicomseg_t, ID)
-            #create_dicomseg_multi_file(path_code, path_dcm_n, path_nii_n, path_reslice_n, path_dicomseg_n, ID)
-            #create_dicomseg_multi_file(path_code, path_dcm_nl, path_nii_nl, path_reslice_nl, path_dicomseg_nl, ID)
-            print(f"[Done create_dicomseg... ] spend {time.time() - start_dicomseg:.0f} sec")
-            logging.info(f"[Done create_dicomseg... ] spend {time.time() - start_dicomseg:.0f} sec")
-
-            #將dicom壓縮不包含dicom-seg  Dicom_JPEGlossless => 由於要用numpy > 2.0，之後補強
-            # path_dcmjpeglossless_t = os.path.join(path_tensorflow, 'Dicom_JPEGlossless')
-            # if not os.path.isdir(path_dcmjpeglossless_t):  #如果資料夾不存在就建立
-            #     os.mkdir(path_dcmjpeglossless_t) #製作nii資料夾
             path_dcmjpeglossless_n = os.path.join(path_nnunet, 'Dicom_JPEGlossless')
-            if not os.path.isdir(path_dcmjpeglossless_n):  #如果資料夾不存在就建立
-                os.mkdir(path_dcmjpeglossless_n) #製作nii資料夾
-            # path_dcmjpeglossless_nl = os.path.join(path_nnunetlow, 'Dicom_JPEGlossless')
-            # if not os.path.isdir(path_dcmjpeglossless_nl):  #如果資料夾不存在就建立
-            #     os.mkdir(path_dcmjpeglossless_nl) #製作nii資料夾            
-            #compress_dicom_into_jpeglossless(path_dcm_t, path_dcmjpeglossless_t)
-            #compress_dicom_into_jpeglossless(path_dcm_n, path_dcmjpeglossless_n)
-            #compress_dicom_into_jpeglossless(path_dcm_nl, path_dcmjpeglossless_nl)
-
-            #建立json檔
-            # path_json_out_t = os.path.join(path_tensorflow, 'JSON')
-            # if not os.path.isdir(path_json_out_t):  #如果資料夾不存在就建立
-            #     os.mkdir(path_json_out_t) #製作nii資料夾
             path_json_out_n = os.path.join(path_nnunet, 'JSON')
-            if not os.path.isdir(path_json_out_n):  #如果資料夾不存在就建立
-                os.mkdir(path_json_out_n) #製作nii資料夾
-            # path_json_out_nl = os.path.join(path_nnunetlow, 'JSON')
-            # if not os.path.isdir(path_json_out_nl):  #如果資料夾不存在就建立
-            #     os.mkdir(path_json_out_nl) #製作nii資料夾
-
-            #複製tensorflow的資料夾成multimodel資料夾，給後面新生成的group_id使用
-            # path_multimodel = os.path.join(path_processID, 'multimodel')
-            # if not os.path.isdir(path_multimodel):  
-            #     shutil.copytree(path_tensorflow, path_multimodel) #資料夾不存在就複製
-            # path_json_out_mu = os.path.join(path_multimodel, 'JSON')
-            # if not os.path.isdir(path_json_out_mu):  #如果資料夾不存在就建立
-            #     os.mkdir(path_json_out_mu) #製作nii資料夾
-            
-            # path_dcm_mu = os.path.join(path_multimodel, 'Dicom')
-            # if not os.path.isdir(path_dcm_mu):  #如果資料夾不存在就建立
-            #     os.mkdir(path_dcm_mu) #製作nii資料夾
-
-            Series = ['MRA_BRAIN', 'MIP_Pitch', 'MIP_Yaw']
-            #group_id1 = 53 # 君彥的模型
-            group_id2 = 56 # nnU-Net的模型
-            #group_id3 = 55 # nnU-Net的模型，低閾值
-            #group_id4 = 56 # 君彥的模型，但會跟CMB在後端合併，所以額外拉一個group_id
-            # model_id = '924d1538-597c-41d6-bc27-4b0b359111cf'
-            start_json = time.time()
-            # make_pred_json(ID, pathlib.Path(path_tensorflow), group_id1)  #(_id, path_root, group_id)
-            #make_aneurysm_pred_json(ID, pathlib.Path(path_nnunet), model_id)  #(_id, path_root, group_id)
-            make_pred_json(ID, pathlib.Path(path_nnunet), group_id2)  #(_id, path_root, group_id)
-            # make_pred_json(ID, pathlib.Path(path_nnunetlow), group_id3)  #(_id, path_root, group_id)
-            # make_pred_json(ID, pathlib.Path(path_multimodel), group_id4)  #(_id, path_root, group_id)
-            #make_pred_json(excel_file, path_dcm, path_nii, path_reslice, path_dicomseg, path_json_out, [ID], Series, group_id)
-            print(f"[Done make_pred_json... ] spend {time.time() - start_json:.0f} sec")
-            logging.info(f"[Done make_pred_json... ] spend {time.time() - start_json:.0f} sec")
-
-            #下面製作vessel dilate的dicom-seg跟json
-            # make_vessel_pred_json(ID, pathlib.Path(path_nnunet))
-
-            #接下來上傳dicom到orthanc
-            # path_zip_t = os.path.join(path_tensorflow, 'Dicom_zip')
-            # if not os.path.isdir(path_zip_t):
-            #     os.mkdir(path_zip_t)
             path_zip_n = os.path.join(path_nnunet, 'Dicom_zip')
-            if not os.path.isdir(path_zip_n):
-                os.mkdir(path_zip_n)
-            # path_zip_nl = os.path.join(path_nnunetlow, 'Dicom_zip')
-            # if not os.path.isdir(path_zip_nl): #如果資料夾不存在就建立
-            #     os.mkdir(path_zip_nl)  
-            # path_zip_mu = os.path.join(path_multimodel, 'Dicom_zip')
-            # if not os.path.isdir(path_zip_mu):  #如果資料夾不存在就建立
-            #     os.mkdir(path_zip_mu) #製作nii資料夾    
-
-            Series = ['MRA_BRAIN', 'MIP_Pitch', 'MIP_Yaw', 'Dicom-Seg']
-            start_upload_dicom = time.time()
-            # orthanc_zip_upload(path_dcm_t, path_zip_t, Series)
-            orthanc_zip_upload(path_dcm_n, path_zip_n, Series)
-            # orthanc_zip_upload(path_dcm_nl, path_zip_nl, Series)
-            # orthanc_zip_upload(path_dcm_mu, path_zip_mu, Series)
-            print(f"[Done start_upload_dicom... ] spend {time.time() - start_upload_dicom:.0f} sec")
-            logging.info(f"[Done start_upload_dicom... ] spend {time.time() - start_upload_dicom:.0f} sec")
-
-            #接下來，上傳json
-            # json_file_t = os.path.join(path_json_out_t, ID + '_platform_json.json')
+            for path_dir in [path_dcm_n, path_nii_n, path_reslice_n, path_excel_n, path_dcmjpeglossless_n,
+                             path_json_out_n, path_zip_n]:
+                os.makedirs(path_dir, exist_ok=True)  # 如果資料夾不存在就建立
+
+            path_png = os.path.join(path_code, 'png')
             json_file_n = os.path.join(path_json_out_n, ID + '_platform_json.json')
-            # json_file_nl = os.path.join(path_json_out_nl, ID + '_platform_json.json')
-            # json_file_mu = os.path.join(path_json_out_mu, ID + '_platform_json.json')
-            # upload_json_aiteam(json_file_t)
-            upload_json_aiteam(json_file_n)
-            # upload_json_aiteam(json_file_nl)
-            # upload_json_aiteam(json_file_mu)
-
-            #把json跟nii輸出到out資料夾，這裡只傳nnunet的結果，因為nnU-Net的結果比較好
-            shutil.copy(os.path.join(path_nnunet, 'Pred.nii.gz'), os.path.join(path_output, 'Pred_Aneurysm.nii.gz'))
-            shutil.copy(os.path.join(path_nnunet, 'Prob.nii.gz'), os.path.join(path_output, 'Prob_Aneurysm.nii.gz'))
-            shutil.copy(os.path.join(path_processID, 'Vessel.nii.gz'), os.path.join(path_output, 'Pred_Aneurysm_Vessel.nii.gz'))
-            shutil.copy(os.path.join(path_processID, 'Vessel_16.nii.gz'), os.path.join(path_output, 'Pred_Aneurysm_Vessel16.nii.gz'))
-            shutil.copy(os.path.join(path_json_out_n, ID + '_platform_json.json'), os.path.join(path_output, 'Pred_Aneurysm.json'))
-            shutil.copy(os.path.join(path_json_out_n, ID + '_platform_json.json'), os.path.join(path_output, 'Pred_Aneurysm_platform_json.json'))
+            group_id2 = 56 # nnU-Net的模型
+
+            #--- 以下每個stage是一個函式，後面用StageDAG宣告相依跟輸入輸出 ---
+            def stage_link_input():
+                #先判斷有無影像，複製過去
+                ctx.link(MRA_BRAIN_file, os.path.join(path_processID, 'MRA_BRAIN.nii.gz'))
+
+            def stage_inference():
+                #因為松諭會用排程，但因為ai跟mip都要用到gpu，所以還是要管gpu ram，#multiprocessing沒辦法釋放gpu，要改用subprocess.run()
+                print("Running stage 1: Aneurysm inference!!!")
+                logging.info("Running stage 1: Aneurysm inference!!!")
+
+                # 定義要傳入的參數，建立指令
+                cmd = [
+                       "python", "/data/4TB1/pipeline/chuan/code/gpu_aneurysm.py",
+                       "--path_code", path_code,
+                       "--path_process", path_processID,
+                       "--path_nnunet_model", path_nnunet_model,
+                       "--case", ID,
+                       "--path_log", path_log,
+                       "--gpu_n", str(gpu_n)  # 注意要轉成字串
+                      ]
+                if not check_gpu_memory:
+                    cmd.append("--skip_memory_gate")
+
+                #有常駐的gpu_aneurysm_worker就送給它(模型已載入)，沒有或連線失敗才走subprocess，CPU模式不送給佔著GPU的worker
+                worker_result = None
+                if worker_socket and gpu_n >= 0 and worker_is_alive(worker_socket):
+                    try:
+                        worker_result = submit_case(path_processID, ID, socket_path=worker_socket)
+                        logging.info(ID + ' gpu_aneurysm_worker result: ' + json.dumps(worker_result, ensure_ascii=False))
+                    except OSError:
+                        logging.error("gpu_aneurysm_worker unavailable, fall back to subprocess.", exc_info=True)
+                        worker_result = None
+                    if worker_result is not None and worker_result.get('code') != 0:
+                        raise RuntimeError(f"gpu_aneurysm_worker failed on {ID}: {worker_result.get('msg')}")
+                if worker_result is None:
+                    subprocess.run(cmd, check=True, env=tracer.child_env())  #子程序的span接在inference底下
+
+            def stage_link_nii():
+                #hard link不佔空間也不用重新壓縮，同一個inode在ctx裡只會解碼一次
+                ctx.link(os.path.join(path_processID, 'MRA_BRAIN.nii.gz'), os.path.join(path_nnunet, 'MRA_BRAIN.nii.gz'))
+                ctx.link(os.path.join(path_processID, 'MRA_BRAIN.nii.gz'), os.path.join(path_nii_n, 'MRA_BRAIN.nii.gz'))
+                ctx.link(os.path.join(path_nnunet, 'Pred.nii.gz'), os.path.join(path_nii_n, 'Pred.nii.gz'))
+                ctx.link(os.path.join(path_processID, 'Vessel.nii.gz'), os.path.join(path_nii_n, 'Vessel.nii.gz'))
+                ctx.link(os.path.join(path_processID, 'Vessel.nii.gz'), os.path.join(path_nnunet, 'Vessel.nii.gz'))
+                ctx.link(os.path.join(path_processID, 'Vessel_16.nii.gz'), os.path.join(path_nnunet, 'Vessel_16.nii.gz'))
+
+            def stage_reslice():
+                reslice_nifti_pred_nobrain(path_nii_n, path_reslice_n, ctx=ctx)
+
+            def stage_copy_dicom():
+                #複製dicom影像，中斷過的話先清掉不完整的資料夾
+                if os.path.isdir(os.path.join(path_dcm_n, 'MRA_BRAIN')):
+                    shutil.rmtree(os.path.join(path_dcm_n, 'MRA_BRAIN'))
+                shutil.copytree(path_outdcm, os.path.join(path_dcm_n, 'MRA_BRAIN'))
+
+            def stage_decompress():
+                #這邊對dicom進行解壓縮動作，執行gdcmconv 去還原影像後覆蓋
+                decompress_dicom_with_gdcm(path_dcm_n)
+
+            def stage_mip():
+                create_MIP_pred(path_dcm_n, path_reslice_n, path_png, gpu_n, ctx=ctx)
+                ctx.link(os.path.join(path_reslice_n, 'MIP_Pitch_pred.nii.gz'), os.path.join(path_nnunet, 'MIP_Pitch_pred.nii.gz'))
+                ctx.link(os.path.join(path_reslice_n, 'MIP_Yaw_pred.nii.gz'), os.path.join(path_nnunet, 'MIP_Yaw_pred.nii.gz'))
+
+            def stage_calculate():
+                #接下來是計算動脈瘤的各項數據，excel跟location表格只需要Pred/Vessel_16跟dicom header，可以跟MIP同時做
+                #header從原始輸入path_outdcm讀，不會讀到decompress正在就地覆蓋的檔案
+                aneurysm_analysis_pipeline = AneurysmPipeline(path_dcm_n, path_nnunet, path_excel_n, ID, ctx=ctx,
+                                                              path_dcm_series=path_outdcm)
+                aneurysm_analysis_pipeline.run_all()
+
+            def stage_pred_json():
+                #上線版不用做vessel，dicom-seg在make_pred_json裡面做
+                #將dicom壓縮不包含dicom-seg  Dicom_JPEGlossless => 由於要用numpy > 2.0，之後補強
+                #compress_dicom_into_jpeglossless(path_dcm_n, path_dcmjpeglossless_n)
+                os.makedirs(path_dicomseg_n, exist_ok=True)
+                make_pred_json(ID, pathlib.Path(path_nnunet), group_id2)  #(_id, path_root, group_id)
+
+            def stage_upload_dicom():
+                #接下來上傳dicom到orthanc
+                Series = ['MRA_BRAIN', 'MIP_Pitch', 'MIP_Yaw', 'Dicom-Seg']
+                orthanc_zip_upload(path_dcm_n, path_zip_n, Series)
+
+            def stage_upload_json():
+                #暫時性失敗的留在outbox，由cron執行json_delivery.py補送，不在這裡補送拖慢每個case
+                upload_json_aiteam(json_file_n, outbox=os.path.join(path_json, 'outbox'))
+
+            def stage_export():
+                #把json跟nii輸出到out資料夾，這裡只傳nnunet的結果，因為nnU-Net的結果比較好
+                ctx.link(os.path.join(path_nnunet, 'Pred.nii.gz'), os.path.join(path_output, 'Pred_Aneurysm.nii.gz'))
+                ctx.link(os.path.join(path_nnunet, 'Prob.nii.gz'), os.path.join(path_output, 'Prob_Aneurysm.nii.gz'))
+                ctx.link(os.path.join(path_processID, 'Vessel.nii.gz'), os.path.join(path_output, 'Pred_Aneurysm_Vessel.nii.gz'))
+                ctx.link(os.path.join(path_processID, 'Vessel_16.nii.gz'), os.path.join(path_output, 'Pred_Aneurysm_Vessel16.nii.gz'))
+                ctx.link(json_file_n, os.path.join(path_output, 'Pred_Aneurysm.json'))
+                ctx.link(json_file_n, os.path.join(path_output, 'Pred_Aneurysm_platform_json.json'))
+
+            #stage DAG: 彼此獨立的分支(dicom複製/解壓縮、reslice->MIP、excel/location表格)會同時執行，
+            #每個stage完成就記在checkpoint，當機後重跑會從最後完成的stage接著做
+            mra_file = os.path.join(path_processID, 'MRA_BRAIN.nii.gz')
+            pred_files = [os.path.join(path_nnunet, 'Pred.nii.gz'), os.path.join(path_nnunet, 'Prob.nii.gz'),
+                          os.path.join(path_processID, 'Vessel.nii.gz'), os.path.join(path_processID, 'Vessel_16.nii.gz')]
+            dag = StageDAG(os.path.join(path_processID, 'stage_checkpoint.json'), tracer=tracer)
+            dag.add('link_input', stage_link_input, inputs=[MRA_BRAIN_file], outputs=[mra_file])
+            dag.add('inference', stage_inference, deps=['link_input'], inputs=[mra_file], outputs=pred_files)
+            dag.add('link_nii', stage_link_nii, deps=['inference'], inputs=pred_files,
+                    outputs=[os.path.join(path_nii_n, 'Pred.nii.gz'), os.path.join(path_nnunet, 'Vessel_16.nii.gz')])
+            dag.add('reslice', stage_reslice, deps=['link_nii'], inputs=[path_nii_n], outputs=[path_reslice_n])
+            dag.add('copy_dicom', stage_copy_dicom, inputs=[path_outdcm], outputs=[os.path.join(path_dcm_n, 'MRA_BRAIN')])
+            dag.add('decompress', stage_decompress, deps=['copy_dicom'], inputs=[os.path.join(path_dcm_n, 'MRA_BRAIN')],
+                    outputs=[os.path.join(path_dcm_n, 'MRA_BRAIN')])
+            dag.add('mip', stage_mip, deps=['reslice', 'decompress'],
+                    inputs=[os.path.join(path_dcm_n, 'MRA_BRAIN'), path_reslice_n],
+                    outputs=[os.path.join(path_nnunet, 'MIP_Pitch_pred.nii.gz'), os.path.join(path_nnunet, 'MIP_Yaw_pred.nii.gz')])
+            dag.add('calculate', stage_calculate, deps=['link_nii'], inputs=pred_files + [path_excel_n, path_outdcm],
+                    outputs=[os.path.join(path_excel_n, 'Aneurysm_Pred_list.xlsx')])
+            dag.add('pred_json', stage_pred_json, deps=['mip', 'calculate'],
+                    inputs=[path_excel_n, os.path.join(path_nnunet, 'MIP_Pitch_pred.nii.gz'),
+                            os.path.join(path_nnunet, 'MIP_Yaw_pred.nii.gz')],
+                    outputs=[json_file_n, path_dicomseg_n])
+            dag.add('upload_dicom', stage_upload_dicom, deps=['pred_json'], inputs=[path_dcm_n])
+            dag.add('upload_json', stage_upload_json, deps=['pred_json'], inputs=[json_file_n])
+            dag.add('export', stage_export, deps=['pred_json'], inputs=[json_file_n] + pred_files,
+                    outputs=[os.path.join(path_output, 'Pred_Aneurysm.json')])
+
+            start = time.time()
+            dag.run(targets, require_done=require_done or ())
+            ctx.release()
 
             #radax步驟，接下來完成複製檔案到指定資料夾跟打api通知
             # upload_dir = '/home/david/ai-inference-result' #目的資料夾
@@ -506,12 +417,14 @@ def pipeline_aneurysm(ID,
     except Exception:
         logging.error('!!! ' + str(ID) + ' gpu have error code.')
         logging.error("Catch an exception.", exc_info=True)
+        code_pass = 1
         # 刪除資料夾
         # if os.path.isdir(path_process):  #如果資料夾存在
         #     shutil.rmtree(path_process) #清掉整個資料夾
    
+    tracer.end_all(error='failed' if code_pass else None)
     print('end!!!')
-    return
+    return code_pass
 
 #其意義是「模組名稱」。如果該檔案是被引用，其值會是模組名稱；但若該檔案是(透過命令列)直接執行，其值會是 __main__；。
 if __name__ == '__main__':
@@ -520,6 +433,10 @@ if __name__ == '__main__':
     parser.add_argument('--Inputs', type=str, nargs='+', default = ['/data/4TB1/pipeline/chuan/example_input/17390820_20250604_MR_21406040004/MRA_BRAIN.nii.gz'], help='用於輸入的檔案')
     parser.add_argument('--DicomDir', type=str, nargs='+', default = ['/data/4TB1/pipeline/chuan/example_inputDicom/17390820_20250604_MR_21406040004/MRA_BRAIN/'], help='用於輸入的檔案')
     parser.add_argument('--Output_folder', type=str, default = '/data/4TB1/pipeline/chuan/example_output/',help='用於輸出結果的資料夾')    
+    parser.add_argument('--gpu_n', type=int, default = 0, help='使用哪一顆gpu，負數代表只用CPU')
+    parser.add_argument('--targets', type=str, nargs='*', default = None, help='只跑到這些stage，例如 inference')
+    parser.add_argument('--skip_memory_gate', action='store_true', help='不檢查gpu使用率(由job_queue依記憶體預算排程)')
+    parser.add_argument('--require_done', type=str, nargs='*', default = None, help='必須已經完成的stage，沒完成就失敗，例如 inference')
     args = parser.parse_args()
 
     ID = str(args.ID)
@@ -546,7 +463,7 @@ if __name__ == '__main__':
     path_log = '/data/4TB1/pipeline/chuan/log/'  #log資料夾
 
     #自訂模型
-    gpu_n = 0  #使用哪一顆gpu
+    gpu_n = args.gpu_n  #使用哪一顆gpu
 
     # 建置資料夾
     os.makedirs(path_processModel, exist_ok=True) # 如果資料夾不存在就建立，製作nii資料夾
@@ -555,7 +472,9 @@ if __name__ == '__main__':
     os.makedirs(path_output,exist_ok=True)
 
     #直接當作function的輸入，因為可能會切換成nnUNet的版本，所以自訂化模型移到跟model一起，synthseg自己做，不用統一
-    pipeline_aneurysm(ID, MRA_BRAIN_file, path_output, path_code, path_nnunet_model, path_processModel, path_DcmDir, path_json, path_log, gpu_n)
+    code_pass = pipeline_aneurysm(ID, MRA_BRAIN_file, path_output, path_code, path_nnunet_model, path_processModel, path_DcmDir, path_json, path_log, gpu_n,
+                                  targets=args.targets, check_gpu_memory=not args.skip_memory_gate,
+                                  require_done=args.require_done)
     
 
     # #最後再讀取json檔結果
@@ -563,3 +482,5 @@ if __name__ == '__main__':
     #     data = json.load(f)
 
     # logging.info('Json!!! ' + str(data))
+
+    sys.exit(code_pass)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+pipeline stage的DAG排程，可從中斷處續跑
+
+每個stage宣告相依的stage、讀取的檔案/資料夾(inputs)、產生的檔案/資料夾(outputs)。
+相依都完成的stage丟進thread pool一起跑，所以彼此獨立的分支(例如MIP、excel/location表格、dicom解壓縮)會同時執行。
+stage完成後把inputs的內容hash記到checkpoint檔(json)，重跑時如果inputs的hash沒變、outputs都還在、上游也沒有重跑，
+這個stage就直接跳過，當機後重跑會從最後完成的stage接著做。
+檔案的hash依(大小, mtime)快取在checkpoint裡，沒變動的大檔案不會每次重新讀取。
+
+@author: chuan
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Stage:
+    def __init__(self, name, func, deps=(), inputs=(), outputs=()):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+
+class StageDAG:
+    def __init__(self, checkpoint_file, max_workers=3, tracer=None):
+        self.checkpoint_file = checkpoint_file
+        self.max_workers = max_workers
+        self.tracer = tracer  #stage_trace.Tracer，有的話每個stage記一個span
+        self.stages = {}  #依加入順序，add時相依的stage一定已經在前面
+        self._lock = threading.Lock()
+        self._state = {'stages': {}, 'files': {}}
+        if os.path.isfile(checkpoint_file):
+            try:
+                with open(checkpoint_file, 'r', encoding='utf-8') as f:
+                    self._state = json.load(f)
+            except (OSError, ValueError):
+                logging.error(f"checkpoint損毀，全部重跑: {checkpoint_file}", exc_info=True)
+
+    def add(self, name, func, deps=(), inputs=(), outputs=()):
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f'stage {name} 相依的 {dep} 還沒加入')
+        self.stages[name] = Stage(name, func, deps, inputs, outputs)
+        return self.stages[name]
+
+    #--- 內容hash ---
+    def _file_digest(self, path):
+        st = os.stat(path)
+        with self._lock:
+            cached = self._state['files'].get(path)
+        if cached is not None and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        h = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with self._lock:
+            self._state['files'][path] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def digest(self, paths):
+        #資料夾就依相對路徑排序後逐檔hash，不存在的路徑也納入(記成missing)
+        h = hashlib.blake2b(digest_size=16)
+        for path in paths:
+            h.update(path.encode('utf-8'))
+            if os.path.isdir(path):
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for name in sorted(files):
+                        file_path = os.path.join(root, name)
+                        h.update(os.path.relpath(file_path, path).encode('utf-8'))
+                        h.update(self._file_digest(file_path).encode('ascii'))
+            elif os.path.isfile(path):
+                h.update(self._file_digest(path).encode('ascii'))
+            else:
+                h.update(b'missing')
+        return h.hexdigest()
+
+    def _save(self):
+        with self._lock:
+            state = json.dumps(self._state, ensure_ascii=False)
+        path_tmp = self.checkpoint_file + '.tmp'
+        with open(path_tmp, 'w', encoding='utf-8') as f:
+            f.write(state)
+        os.replace(path_tmp, self.checkpoint_file)
+
+    def is_done(self, stage, rerun):
+        record = self._state['stages'].get(stage.name)
+        if record is None or any(dep in rerun for dep in stage.deps):
+            return False
+        if not all(os.path.exists(path) for path in stage.outputs):
+            return False
+        return record.get('inputs') == self.digest(stage.inputs)
+
+    @staticmethod
+    def _changed_time(path):
+        #ctx.link做的hard link沿用來源的mtime，但建立link會更新ctime，所以兩個取大的；資料夾看裡面最新的檔案
+        st = os.stat(path)
+        newest = max(st.st_mtime, st.st_ctime)
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                for name in dirs + files:
+                    st = os.stat(os.path.join(root, name))
+                    newest = max(newest, st.st_mtime, st.st_ctime)
+        return newest
+
+    def check_outputs(self, stage, start, tolerance=1.0):
+        #stage回傳了但outputs不在或還是舊的(例如子程序失敗卻沒有回傳錯誤碼)，不能記成完成
+        for path in stage.outputs:
+            if not os.path.exists(path):
+                raise RuntimeError(f'stage {stage.name} 沒有產生輸出: {path}')
+            if self._changed_time(path) < start - tolerance:
+                raise RuntimeError(f'stage {stage.name} 的輸出沒有更新: {path}')
+
+    def _run_stage(self, stage, parent=None):
+        start = time.time()
+        if self.tracer is not None:
+            with self.tracer.span(stage.name, parent=parent):
+                stage.func()
+        else:
+            stage.func()
+        self.check_outputs(stage, start)
+        #inputs的hash在stage完成後才算，就地修改inputs的stage(例如解壓縮)重跑時才會一致
+        record = {'inputs': self.digest(stage.inputs), 'spend': time.time() - start,
+                  'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+        with self._lock:
+            self._state['stages'][stage.name] = record
+        self._save()
+        return time.time() - start
+
+    def upstream(self, targets):
+        #targets跟它們所有上游的stage名稱
+        needed = set()
+        stack = list(targets)
+        while stack:
+            name = stack.pop()
+            if name not in needed:
+                needed.add(name)
+                stack.extend(self.stages[name].deps)
+        return needed
+
+    def check_done(self, names):
+        #names跟它們的上游都要已經完成(checkpoint在、outputs在、inputs沒變)，否則丟出RuntimeError，不會重跑
+        for name in self.upstream(names):
+            if not self.is_done(self.stages[name], set()):
+                raise RuntimeError(f'stage {name} 還沒完成或checkpoint已過期，不在這次執行裡重跑')
+
+    def run(self, targets=None, require_done=()):
+        """
+        依相依關係平行執行，任一stage失敗就不再送出新的stage，等執行中的結束後把例外拋出去
+        targets: 只跑到這些stage(含上游)，None就全部跑
+        require_done: 這些stage(含上游)必須已經完成，沒完成就直接失敗(例如CPU的post階段不能重跑inference)
+        return: {stage名稱: 'skip' 或 花費秒數}
+        """
+        if require_done:
+            self.check_done(require_done)
+        result = {}
+        rerun = set()
+        needed = self.upstream(targets) if targets else set(self.stages)
+        pending = {name: stage for name, stage in self.stages.items() if name in needed}
+        parent = self.tracer.current() if self.tracer is not None else None  #pool裡的thread沒有呼叫端的span堆疊
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if error is None:
+                    for name, stage in list(pending.items()):
+                        if any(dep in pending or dep in running.values() for dep in stage.deps):
+                            continue
+                        del pending[name]
+                        if self.is_done(stage, rerun):
+                            result[name] = 'skip'
+                            print(f"[Skip {name}... ] checkpoint")
+                            logging.info(f"[Skip {name}... ] checkpoint")
+                            continue
+                        rerun.add(name)
+                        running[executor.submit(self._run_stage, stage, parent)] = name
+                if not running:
+                    break
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        result[name] = future.result()
+                        print(f"[Done {name}... ] spend {result[name]:.0f} sec")
+                        logging.info(f"[Done {name}... ] spend {result[name]:.0f} sec")
+                    except Exception as e:
+                        logging.error(f"stage {name} failed.", exc_info=True)
+                        with self._lock:
+                            self._state['stages'].pop(name, None)
+                        if error is None:
+                            error = e
+        self._save()
+        if error is not None:
+            raise error
+        return result
+
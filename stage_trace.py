@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+pipeline各stage的tracing跟資源量測
+
+原本pipeline_aneurysm跟gpu_aneurysm只在文字log裡記time.time()的差。這邊每個stage是一個span，結束時記錄:
+    wall時間、這個thread的CPU時間跟整個process的CPU時間、目前RSS跟peak RSS(以及這個span讓peak長了多少)、
+    GPU記憶體(torch有載入且有cuda時記peak allocated，有pynvml時記整張卡的used)、/proc/self/io的讀寫bytes、
+    以及呼叫端用add_array加上的陣列shape/dtype/大小
+每個span結束就append一行json到trace檔(JSON lines)，to_otlp可以把它轉成OpenTelemetry的OTLP/JSON格式，
+匯入Jaeger/Tempo之類的工具。subprocess(例如gpu_aneurysm.py)用child_env傳trace id，子程序的span會掛在同一個trace下。
+
+使用:
+    tracer = Tracer('/path/trace.jsonl', case=ID)
+    with tracer.span('reslice') as sp:
+        sp.add_array('img', img)
+    python stage_trace.py to-otlp trace.jsonl trace_otlp.json
+
+@author: chuan
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+import resource
+import threading
+
+ENV_TRACE_FILE = 'ANEURYSM_TRACE_FILE'
+ENV_TRACE_ID = 'ANEURYSM_TRACE_ID'
+ENV_PARENT_SPAN = 'ANEURYSM_PARENT_SPAN'
+ENV_CASE = 'ANEURYSM_TRACE_CASE'
+
+
+def _rss_mb():
+    #目前RSS，從/proc讀，其他平台回傳None
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError):
+        return None
+
+
+def _peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / 1024 ** 2 if sys.platform == 'darwin' else usage / 1024
+
+
+def _io_counters():
+    #read_bytes/write_bytes是實際碰到儲存裝置的量，rchar/wchar含page cache
+    try:
+        with open('/proc/self/io', 'r') as f:
+            return {k: int(v) for k, v in (line.split(':') for line in f if ':' in line)}
+    except (OSError, ValueError):
+        return {}
+
+
+def _gpu_start():
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        try:
+            if torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+        except Exception:
+            pass
+
+
+def _gpu_metrics():
+    #只在torch/pynvml已經被pipeline載入時才量，不為了量測多載入套件
+    metrics = {}
+    torch = sys.modules.get('torch')
+    if torch is not None:
+        try:
+            if torch.cuda.is_available():
+                metrics['gpu.torch_peak_allocated_mb'] = torch.cuda.max_memory_allocated() / 1024 ** 2
+        except Exception:
+            pass
+    pynvml = sys.modules.get('pynvml')
+    if pynvml is not None:
+        try:
+            pynvml.nvmlInit()
+            for i in range(pynvml.nvmlDeviceGetCount()):
+                info = pynvml.nvmlDeviceGetMemoryInfo(pynvml.nvmlDeviceGetHandleByIndex(i))
+                metrics[f'gpu.{i}.used_mb'] = info.used / 1024 ** 2
+        except Exception:
+            pass
+    return metrics
+
+
+class Span:
+    def __init__(self, tracer, name, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = tracer.trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes)
+        self.status = 'ok'
+        self.error = None
+        self._start_ns = time.time_ns()
+        self._wall = time.perf_counter()
+        self._thread_cpu = time.thread_time()
+        self._process_cpu = time.process_time()
+        self._peak_rss = _peak_rss_mb()
+        self._io = _io_counters()
+        _gpu_start()
+
+    def set(self, key, value):
+        self.attributes[key] = value
+        return self
+
+    def add_array(self, name, array):
+        #記錄陣列的shape/dtype/大小，不保留陣列本身
+        shape = getattr(array, 'shape', None)
+        self.attributes[f'array.{name}.shape'] = list(shape) if shape is not None else None
+        self.attributes[f'array.{name}.dtype'] = str(getattr(array, 'dtype', type(array).__name__))
+        self.attributes[f'array.{name}.mb'] = getattr(array, 'nbytes', 0) / 1024 ** 2
+        return self
+
+    def end(self, error=None):
+        if error is not None:
+            self.status = 'error'
+            self.error = repr(error)
+        peak_rss = _peak_rss_mb()
+        io = _io_counters()
+        record = {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'case': self.tracer.case,
+            'pid': os.getpid(),
+            'thread': threading.current_thread().name,
+            'start_ns': self._start_ns,
+            'end_ns': time.time_ns(),
+            'wall_sec': time.perf_counter() - self._wall,
+            'cpu_thread_sec': time.thread_time() - self._thread_cpu,
+            'cpu_process_sec': time.process_time() - self._process_cpu,
+            'rss_mb': _rss_mb(),
+            'peak_rss_mb': peak_rss,
+            'peak_rss_growth_mb': peak_rss - self._peak_rss,
+            'io': {k: io[k] - self._io.get(k, 0) for k in ('read_bytes', 'write_bytes', 'rchar', 'wchar') if k in io},
+            'status': self.status,
+        }
+        record.update(_gpu_metrics())
+        if self.error is not None:
+            record['error'] = self.error
+        record['attributes'] = self.attributes
+        self.tracer.emit(record)
+        return record
+
+
+class Tracer:
+    """
+    path: JSON lines檔，None就只留在記憶體(self.records)
+    trace_id/parent_id: 不給就從環境變數(subprocess)讀，再沒有就新開一個trace
+    """
+
+    def __init__(self, path=None, case=None, trace_id=None, parent_id=None):
+        self.path = path
+        self.case = case if case is not None else os.environ.get(ENV_CASE)
+        self.trace_id = trace_id or os.environ.get(ENV_TRACE_ID) or uuid.uuid4().hex
+        self.root_parent = parent_id or os.environ.get(ENV_PARENT_SPAN)
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    @classmethod
+    def from_env(cls, default_path=None, case=None):
+        #子程序用: 父程序有設trace檔就寫到同一個檔案
+        return cls(os.environ.get(ENV_TRACE_FILE, default_path), case=case)
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self):
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def start(self, name, parent=None, **attributes):
+        """
+        開始一個span，parent不給就用這個thread目前的span；跨thread(例如StageDAG的pool)要明確傳parent
+        """
+        if parent is None:
+            parent = self.current()
+        parent_id = parent.span_id if parent is not None else self.root_parent
+        span = Span(self, name, parent_id, attributes)
+        self._stack().append(span)
+        return span
+
+    def end(self, span, error=None):
+        stack = self._stack()
+        if span in stack:
+            stack.remove(span)
+        return span.end(error)
+
+    def end_all(self, error=None):
+        #例外處理用: 把這個thread還開著的span由內而外全部結束
+        stack = self._stack()
+        while stack:
+            stack.pop().end(error)
+
+    def span(self, name, parent=None, **attributes):
+        return _SpanContext(self, name, parent, attributes)
+
+    def emit(self, record):
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        with self._lock:
+            self.records.append(record)
+            if self.path:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(line + '\n')
+
+    def child_env(self, span=None, env=None):
+        #給subprocess.run(env=...)，子程序的Tracer.from_env會接在span底下
+        env = dict(os.environ if env is None else env)
+        span = span or self.current()
+        env[ENV_TRACE_ID] = self.trace_id
+        if span is not None:
+            env[ENV_PARENT_SPAN] = span.span_id
+        if self.path:
+            env[ENV_TRACE_FILE] = os.path.abspath(self.path)
+        if self.case is not None:
+            env[ENV_CASE] = str(self.case)
+        return env
+
+
+class _SpanContext:
+    def __init__(self, tracer, name, parent, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.span = None
+
+    def __enter__(self):
+        self.span = self.tracer.start(self.name, parent=self.parent, **self.attributes)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tracer.end(self.span, error=exc)
+        return False
+
+
+#--- OpenTelemetry匯出 ---
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    if isinstance(value, (list, tuple)):
+        return {'arrayValue': {'values': [_otlp_value(v) for v in value]}}
+    return {'stringValue': str(value)}
+
+
+def _flatten(record):
+    #span的量測值跟attributes都攤平成OTLP attributes
+    skip = {'trace_id', 'span_id', 'parent_id', 'name', 'start_ns', 'end_ns', 'status', 'error', 'attributes', 'io'}
+    flat = {k: v for k, v in record.items() if k not in skip and v is not None}
+    flat.update({f'io.{k}': v for k, v in record.get('io', {}).items()})
+    flat.update({k: v for k, v in record.get('attributes', {}).items() if v is not None})
+    return flat
+
+
+def to_otlp(records, service_name='aneurysm-pipeline'):
+    """
+    span records(JSON lines讀進來的dict) => OTLP/JSON (ExportTraceServiceRequest)
+    """
+    spans = []
+    for record in records:
+        span = {'traceId': record['trace_id'],
+                'spanId': record['span_id'],
+                'name': record['name'],
+                'kind': 1,  # SPAN_KIND_INTERNAL
+                'startTimeUnixNano': str(record['start_ns']),
+                'endTimeUnixNano': str(record['end_ns']),
+                'attributes': [{'key': k, 'value': _otlp_value(v)} for k, v in _flatten(record).items()],
+                'status': {'code': 2, 'message': record.get('error', '')} if record.get('status') == 'error' else {'code': 1}}
+        if record.get('parent_id'):
+            span['parentSpanId'] = record['parent_id']
+        spans.append(span)
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service_name}}]},
+        'scopeSpans': [{'scope': {'name': 'stage_trace'}, 'spans': spans}]}]}
+
+
+def read_jsonl(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize(records, top=20):
+    #依span名稱彙總，找出最花時間跟最吃記憶體的stage
+    stats = {}
+    for record in records:
+        s = stats.setdefault(record['name'], {'count': 0, 'wall_sec': 0.0, 'max_wall_sec': 0.0, 'max_peak_rss_growth_mb': 0.0})
+        s['count'] += 1
+        s['wall_sec'] += record['wall_sec']
+        s['max_wall_sec'] = max(s['max_wall_sec'], record['wall_sec'])
+        s['max_peak_rss_growth_mb'] = max(s['max_peak_rss_growth_mb'], record.get('peak_rss_growth_mb') or 0)
+    return sorted(stats.items(), key=lambda item: -item[1]['wall_sec'])[:top]
+
+
+#其意義是「模組名稱」。如果該檔案是被引用，其值會是模組名稱；但若該檔案是(透過命令列)直接執行，其值會是 __main__；。
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_otlp = sub.add_parser('to-otlp', help='JSON lines轉OTLP/JSON')
+    p_otlp.add_argument('jsonl', type=str)
+    p_otlp.add_argument('out', type=str)
+    p_otlp.add_argument('--case', type=str, default=None, help='只匯出這個case')
+    p_summary = sub.add_parser('summary', help='各stage累計時間跟peak RSS增量')
+    p_summary.add_argument('jsonl', type=str)
+    p_summary.add_argument('--top', type=int, default=20)
+    args = parser.parse_args()
+
+    records = read_jsonl(args.jsonl)
+    if args.command == 'to-otlp':
+        if args.case:
+            records = [r for r in records if r.get('case') == args.case]
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(to_otlp(records), f, ensure_ascii=False)
+        print(len(records), 'spans =>', args.out)
+    else:
+        for name, s in summarize(records, args.top):
+            print(f"{name:40s} n={s['count']:<4d} total={s['wall_sec']:.1f}s max={s['max_wall_sec']:.1f}s "
+                  f"peak_rss_growth={s['max_peak_rss_growth_mb']:.0f}MB")
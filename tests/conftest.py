@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+"""
+舊做法跟新做法在合成volume上的對照測試，repo根目錄的模組直接import
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
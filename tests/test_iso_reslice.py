@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+IsoReslicer跟原本各channel分別呼叫nibabel.processing.conform的結果要完全相同
+"""
+import numpy as np
+import pytest
+
+nib = pytest.importorskip('nibabel')
+pytest.importorskip('scipy')
+from nibabel.processing import conform
+
+from iso_reslice import IsoReslicer
+
+
+def make_volume(shape, pixdim, lps=True, seed=0):
+    rng = np.random.default_rng(seed)
+    affine = np.diag([*pixdim, 1.0])
+    if lps:  # dicom轉出來的nifti常見的LPS方向
+        affine[0, 0] = -pixdim[0]
+        affine[1, 1] = -pixdim[1]
+    affine[:3, 3] = [12.5, -30.0, 7.25]
+    image = (rng.random(shape) * 1000).astype(np.float32)
+    return nib.Nifti1Image(image, affine)
+
+
+def make_label(img, kind, seed=1):
+    rng = np.random.default_rng(seed)
+    data = np.zeros(img.shape, dtype=np.uint8)
+    if kind == 'blobs':
+        data[rng.random(img.shape) > 0.97] = 1
+        data[3:7, 4:9, 2:5] = 2
+    elif kind == 'border':  # 標註貼著影像邊界
+        data[0, :, :] = 1
+        data[:, -1, :] = 2
+        data[:, :, 0] = 3
+    return nib.Nifti1Image(data, img.affine)
+
+
+def iso_target(img):
+    pixdim = img.header['pixdim']
+    x_i, y_i, z_i = img.shape
+    return (x_i, y_i, int(z_i * (pixdim[3] / pixdim[1]))), (pixdim[1], pixdim[2], pixdim[1])
+
+
+@pytest.mark.parametrize('shape, pixdim', [((33, 29, 11), (0.4, 0.4, 0.8)),
+                                           ((40, 40, 17), (0.35, 0.35, 1.2)),
+                                           ((17, 23, 5), (0.5, 0.45, 1.0))])
+@pytest.mark.parametrize('lps', [True, False])
+@pytest.mark.parametrize('label_kind', ['blobs', 'border', 'empty'])
+def test_matches_conform(shape, pixdim, lps, label_kind):
+    img = make_volume(shape, pixdim, lps)
+    label = make_label(img, label_kind)
+    out_shape, voxel_size = iso_target(img)
+
+    reslicer = IsoReslicer(img, out_shape, voxel_size, chunk_z=4, max_workers=3)
+    new_img, new_label = reslicer.resample_all([(img, 1), (label, 0)])
+    ref_img = conform(img, out_shape, voxel_size, order=1)
+    ref_label = conform(label, out_shape, voxel_size, order=0)
+
+    for new, ref in ((new_img, ref_img), (new_label, ref_label)):
+        assert new.shape == ref.shape
+        np.testing.assert_array_equal(new.affine, ref.affine)
+        assert np.asanyarray(new.dataobj).dtype == np.asanyarray(ref.dataobj).dtype
+        np.testing.assert_array_equal(np.asanyarray(new.dataobj), np.asanyarray(ref.dataobj))
+
+
+def test_spline_order_matches_conform():
+    img = make_volume((21, 19, 7), (0.4, 0.4, 0.9))
+    out_shape, voxel_size = iso_target(img)
+    new = IsoReslicer(img, out_shape, voxel_size).resample(img, order=3)
+    ref = conform(img, out_shape, voxel_size, order=3)
+    np.testing.assert_array_equal(np.asanyarray(new.dataobj), np.asanyarray(ref.dataobj))
+
+
+def test_label_on_other_grid_matches_conform():
+    # 跟參考影像不同grid的標註不能用快取的對應
+    img = make_volume((24, 22, 9), (0.4, 0.4, 0.8))
+    other = nib.Nifti1Image(make_label(img, 'blobs').get_fdata().astype(np.uint8), img.affine.copy())
+    other.affine[:3, 3] += [0.4, -0.8, 1.6]
+    out_shape, voxel_size = iso_target(img)
+    new = IsoReslicer(img, out_shape, voxel_size).resample(other, order=0)
+    ref = conform(other, out_shape, voxel_size, order=0)
+    np.testing.assert_array_equal(np.asanyarray(new.dataobj), np.asanyarray(ref.dataobj))
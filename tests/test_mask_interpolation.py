@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+mask_resample.mask_interpolation跟原本(逐張slice算整個volume的distance field再ndi.zoom)的結果要相同
+"""
+import numpy as np
+import pytest
+from scipy import ndimage as ndi
+
+from mask_resample import mask_interpolation
+
+
+def mask_interpolation_reference(mask, factor):
+    # 原本gpu_aneurysm.mask_interpolation的做法
+    mask_types = int(mask.max())
+    if mask_types > 1:
+        mask_mul = []
+        for i in range(mask_types):
+            mask_mul.append(np.where(mask == i+1, 1, 0))
+        mask_dist = mask_mul.copy()
+        for i in range(mask_types):
+            for z in range(mask.shape[-1]):
+                dist_field_inner = ndi.distance_transform_edt(mask_mul[i][:,:,z])
+                dist_field_outer = ndi.distance_transform_edt(np.logical_not(mask_mul[i][:,:,z]))
+                mask_dist[i][:,:,z] = dist_field_inner - dist_field_outer
+            mask_dist[i] = ndi.zoom(mask_dist[i], factor, order=1,
+                                    mode='grid-mirror', prefilter=True, grid_mode=False)
+        mask_new = np.zeros(mask_dist[0].shape)
+        for i in range(mask_types):
+            mask_dist[i] = np.where(mask_dist[i] > 0., 1, 0)
+        m_index = np.any(np.array(mask_dist) != 0, axis=0)
+        mask_new[m_index] = np.argmax(np.array(mask_dist)[:,m_index], axis=0) + 1
+        return mask_new.astype(mask.dtype)
+    else:
+        mask_dist = np.zeros(mask.shape)
+        for z in range(mask.shape[-1]):
+            dist_field_inner = ndi.distance_transform_edt(mask[:,:,z])
+            dist_field_outer = ndi.distance_transform_edt(np.logical_not(mask[:,:,z]))
+            mask_dist[:,:,z] = dist_field_inner - dist_field_outer
+        mask_dist = ndi.zoom(mask_dist, factor, order=1,
+                             mode='grid-mirror', prefilter=True, grid_mode=False)
+        mask_new = np.where(mask_dist > 0., 1, 0)
+        return mask_new.astype(mask.dtype)
+
+
+def threshold_ties(mask, factor, eps=1e-9):
+    # 內插值剛好落在門檻上的voxel(二值是0，多類別的整數輸出是0.5)，加總順序不同就可能差1e-16而結果不同
+    labels = [mask > 0] if int(mask.max()) <= 1 else [mask == i for i in range(1, int(mask.max()) + 1)]
+    ties = False
+    for label in labels:
+        dist = np.zeros(mask.shape)
+        for z in range(mask.shape[-1]):
+            dist[:,:,z] = ndi.distance_transform_edt(label[:,:,z]) - ndi.distance_transform_edt(np.logical_not(label[:,:,z]))
+        threshold = 0.
+        if len(labels) > 1:
+            dist, threshold = np.trunc(dist), 0.5
+        dist = ndi.zoom(dist, factor, order=1, mode='grid-mirror', prefilter=True, grid_mode=False)
+        ties = ties | (np.abs(dist - threshold) < eps)
+    return ties
+
+
+def random_blobs(shape, n_labels=1, seed=0):
+    # 平滑過的雜訊取門檻，得到形狀不規則的血管/病灶
+    rng = np.random.default_rng(seed)
+    mask = np.zeros(shape, dtype=np.uint8)
+    for i in range(1, n_labels + 1):
+        field = ndi.gaussian_filter(rng.random(shape), sigma=2)
+        mask[field > np.quantile(field, 0.93)] = i
+    return mask
+
+
+def border_mask(shape, n_labels=1):
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[0, :, :] = 1
+    mask[:, -3:, :] = n_labels
+    mask[5:9, 5:9, -1] = 1
+    mask[:, :, 0] = n_labels
+    return mask
+
+
+SHAPES = [(37, 41, 13), (20, 16, 7), (9, 11, 2)]
+FACTORS = [(1, 1, 2.3), (1, 1, 1.6666), (1.5, 0.8, 2.0), (1, 1, 0.5)]
+
+
+def check(mask, factor):
+    new = mask_interpolation(mask, factor)
+    ref = mask_interpolation_reference(mask, factor)
+    assert new.shape == ref.shape
+    assert new.dtype == ref.dtype
+    ties = threshold_ties(mask, factor)
+    np.testing.assert_array_equal(new[~ties], ref[~ties])
+    assert (new != ref).mean() < 1e-3
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('factor', FACTORS)
+def test_binary(shape, factor):
+    check(random_blobs(shape), factor)
+    check(random_blobs(shape).astype(bool), factor)
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('factor', FACTORS)
+def test_multi_label(shape, factor):
+    # 後面的類別會覆蓋前面，重疊跟相鄰的地方都有
+    check(random_blobs(shape, n_labels=3, seed=3), factor)
+
+
+@pytest.mark.parametrize('n_labels', [1, 2])
+@pytest.mark.parametrize('factor', FACTORS)
+def test_label_on_border(n_labels, factor):
+    check(border_mask((23, 19, 9), n_labels), factor)
+
+
+@pytest.mark.parametrize('factor', FACTORS)
+def test_empty_and_full(factor):
+    check(np.zeros((21, 17, 6), dtype=np.uint8), factor)
+    check(np.ones((21, 17, 6), dtype=np.uint8), factor)
+
+
+def test_missing_label_id():
+    # 只有1跟3，中間的類別是空的
+    mask = random_blobs((30, 27, 11), n_labels=1, seed=5)
+    mask[random_blobs((30, 27, 11), n_labels=1, seed=6) > 0] = 3
+    check(mask, (1, 1, 2.3))
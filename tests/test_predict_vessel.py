@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+predict_vessel(batch推論、就地累加)跟原本逐window tf.pad累加的sliding window結果要相同
+需要tensorflow跟gpu_aneurysm的所有相依套件，沒有的話skip
+"""
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+try:
+    import gpu_aneurysm as ga
+except ImportError as e:
+    pytest.skip(f'gpu_aneurysm無法import: {e}', allow_module_level=True)
+
+
+class FakeVesselModel:
+    # 固定kernel的3D卷積+sigmoid，輸出跟相鄰voxel有關，window的位置放錯就會不一樣
+    def __init__(self, n_class=1, seed=0):
+        rng = np.random.default_rng(seed)
+        self.kernel = tf.constant(rng.normal(0, 0.5, (3, 3, 3, 1, n_class)), dtype=tf.float32)
+
+    def serve(self, x):
+        return tf.sigmoid(tf.nn.conv3d(x, self.kernel, strides=[1, 1, 1, 1, 1], padding='SAME') * 4. - 1.)
+
+
+def predict_vessel_conf_reference(image_arr, brain_mask, model1, patch_size, sigma=0.125, n_class=1, overlap=0.5):
+    # 原本gpu_aneurysm.predict_vessel的做法，回傳threshold之前的confidence
+    # 修改兩處: 原本padding_size寫成(影像 - padded)，影像比patch小的時候tf.pad會出錯，這邊改成(padded - 影像)；
+    # 輸入先轉float32(新的做法也是)，原本是交給model自己轉
+    def sliding_window_inference1(inputs, roi_size, model, overlap, n_class, importance_map, strategy="overlap_inside", mask=None):
+        image_size = tuple(inputs.shape[1:-1])
+        roi_size = tuple(roi_size)
+        padded_image_size = tuple(max(image_size[i], roi_size[i]) for i in range(3))
+        padding_size = [image_x - input_x for image_x, input_x in zip(padded_image_size, image_size)]
+        paddings = [[0, 0]] + [[x // 2, x - x // 2] for x in padding_size] + [[0, 0]]
+        input_padded = tf.pad(inputs, paddings)
+        if mask is not None:
+            mask_padded = tf.pad(tf.convert_to_tensor(mask, dtype=tf.bool), paddings)
+
+        output_shape = (1, *padded_image_size, n_class)
+        output_sum = tf.zeros(output_shape, dtype=tf.float32)
+        output_weight_sum = tf.zeros(output_shape, dtype=tf.float32)
+        window_slices = ga.get_window_slices(padded_image_size, roi_size, overlap, strategy)
+
+        for i, window_slice in enumerate(window_slices):
+            if (mask is None) or ((mask is not None)and(tf.math.reduce_any(tf.slice(mask_padded, begin=window_slice[0], size=window_slice[1])))):
+                window = tf.slice(input_padded, begin=window_slice[0], size=window_slice[1])
+                pred = ga.run_model1(window, model, importance_map)
+                padding = [
+                    [start, output_size - (start + size)] for start, size, output_size in zip(*window_slice, output_shape)
+                ]
+                padding = padding[:-1] + [[0, 0]]
+                output_sum = output_sum + tf.pad(pred, padding)
+                output_weight_sum = output_weight_sum + tf.pad(importance_map, padding)
+
+        output = output_sum / tf.clip_by_value(output_weight_sum, 1, 256)
+        crop_slice = [slice(pad[0], pad[0] + input_x) for pad, input_x in zip(paddings, inputs.shape[:-1])]
+        return output[crop_slice]
+
+    image_arr = ga.custom_normalize_1(image_arr)
+    importance_kernel = ga.get_importance_kernel(patch_size, blend_mode="gaussian", sigma=sigma)
+    importance_map = tf.tile(tf.reshape(importance_kernel, shape=[1, *patch_size, 1]), multiples=[1, 1, 1, 1, n_class],)
+    vessel_conf = sliding_window_inference1(inputs=tf.convert_to_tensor(image_arr[np.newaxis,:,:,:,np.newaxis], dtype=tf.float32),
+                                            roi_size=patch_size, model=model1, overlap=overlap,
+                                            n_class=n_class, importance_map=importance_map,
+                                            mask=brain_mask[np.newaxis,:,:,:,np.newaxis])
+    return vessel_conf[0,:,:,:,0].numpy()
+
+
+def make_case(shape, mask_kind, seed=0):
+    rng = np.random.default_rng(seed)
+    image = (rng.random(shape) * 400).astype(np.float32)
+    image[rng.random(shape) > 0.9] += 600  # 亮的血管
+    mask = np.zeros(shape, dtype=bool)
+    if mask_kind == 'center':
+        c = [s // 2 for s in shape]
+        r = [max(s // 3, 1) for s in shape]
+        mask[c[0]-r[0]:c[0]+r[0], c[1]-r[1]:c[1]+r[1], c[2]-r[2]:c[2]+r[2]] = True
+    elif mask_kind == 'border':  # 只有角落跟一個面，window都在邊界
+        mask[:3, :3, :2] = True
+        mask[-1, :, :] = True
+    elif mask_kind == 'full':
+        mask[:] = True
+    return image, mask
+
+
+def check(shape, mask_kind, patch_size, batch_size, conf_th=0.5, overlap=0.5):
+    image, mask = make_case(shape, mask_kind)
+    model = FakeVesselModel()
+    new = ga.predict_vessel(image.copy(), mask, model, patch_size=patch_size, overlap=overlap,
+                            conf_th=conf_th, batch_size=batch_size)
+    ref_conf = predict_vessel_conf_reference(image.copy(), mask, model, patch_size, overlap=overlap)
+    assert new.shape == shape
+    # batch跟單一window的卷積在float32上可能差最後一位，只排除剛好在門檻上的voxel
+    near = np.abs(ref_conf - conf_th) < 1e-5
+    np.testing.assert_array_equal(new[~near], (ref_conf > conf_th)[~near])
+    return new
+
+
+@pytest.mark.parametrize('batch_size', [1, 3, 16])
+@pytest.mark.parametrize('mask_kind', ['center', 'border', 'full'])
+def test_odd_shape(mask_kind, batch_size):
+    check((45, 37, 19), mask_kind, (16, 16, 8), batch_size)
+
+
+@pytest.mark.parametrize('mask_kind', ['center', 'full'])
+def test_smaller_than_patch(mask_kind):
+    # 有的軸比patch小，要先pad
+    check((13, 40, 5), mask_kind, (16, 16, 8), batch_size=4)
+
+
+def test_empty_mask():
+    new = check((33, 29, 11), 'empty', (16, 16, 8), batch_size=4, conf_th=0.1)
+    assert not new.any()
+
+
+def test_multi_batch_tail():
+    # window數不是batch_size的倍數，最後一個batch比較小
+    check((50, 50, 20), 'full', (16, 16, 8), batch_size=7, overlap=0.25)
@@ -5,21 +5,24 @@
 
 import io
 import os
-import shutil
 import argparse
 import bz2
 import gzip
 import json
-import os
 import requests
 import sys
 import tarfile
 import zipfile
 import glob
 import pydicom
-import zipfile
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 def write_slice_zip(dcm, img_data, slice_index, zip_file,series_description):
     """
@@ -46,47 +49,179 @@ def write_slice_zip(dcm, img_data, slice_index, zip_file,series_description):
     dcm.ds.save_as(dicom_buffer, write_like_original=False)
     zip_file.writestr(f'{series_description}/{output_filename}', dicom_buffer.getvalue())
 
-def zip_folder(folder, output_zip):
-    with zipfile.ZipFile(output_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(folder):
-            for file in files:
-                file_path = os.path.join(root, file)
-                # 計算檔案在 zip 檔案中的相對路徑
-                arcname = os.path.relpath(file_path, start=folder)
-                zipf.write(file_path, arcname=arcname)
-
-def zip_folders_individually(folders):
-    for folder in folders:
+#預設的orthanc
+#ORTHANC_URL = 'http://10.103.21.40:8042/instances'
+ORTHANC_URL = 'http://10.103.1.193:8042/instances'
+
+def make_session(pool_size=4, retries=3, backoff_factor=0.5):
+    #keep-alive的連線池，5xx跟連線錯誤自動重試(指數退避)
+    session = requests.Session()
+    retry = Retry(total=retries, connect=retries, read=retries, backoff_factor=backoff_factor,
+                  status_forcelist=[429, 500, 502, 503, 504], allowed_methods=frozenset(['POST']),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def iter_series_payloads(path_dcm, Series, mode='zip', files_per_zip=64, compression=zipfile.ZIP_DEFLATED):
+    """
+    在記憶體中產生要上傳的內容，不再copytree跟寫zip到硬碟
+    mode='zip'      : 每個series切成多個小zip(每個最多files_per_zip張)，yield (名稱, zip bytes, 'zip')
+    mode='instance' : 一張一張dicom，yield (名稱, dicom bytes, 'instance')
+    """
+    for series in Series:
+        folder = os.path.join(path_dcm, series)
         if not os.path.isdir(folder):
             print(f"資料夾 {folder} 不存在")
             continue
-        zip_filename = f"{folder}.zip"
-        zip_folder(folder, zip_filename)
-        print(f"{folder} 已壓縮成 {zip_filename}")
-
-def upload_data(path_dcm, path_zip, Series):
-    shutil.copytree(path_dcm, path_zip, dirs_exist_ok=True)
-    
-    # 要壓縮的資料夾清單
-    folders_to_zip = [os.path.join(path_zip, y) for y in Series]  # 替換成你的資料夾路徑
-
-    #針對每個series生成壓縮檔# 將每個資料夾壓縮成單獨的 ZIP 檔案
-    zip_folders_individually(folders_to_zip)
-
-    #接下來用curl一筆一筆上傳到orthanc上       
-    # 設定 URL 和檔案路徑
-    #url = 'http://10.103.21.40:8042/instances'
-    url = 'http://10.103.1.193:8042/instances'
-
-    files_zip = [y + '.zip' for y in folders_to_zip]
-
-    for file_zip in files_zip:
-        # 使用 'rb' 模式開啟檔案並發送 POST 請求
-        with open(file_zip, 'rb') as f:
-            response = requests.post(url, files={'file': f})
-
-        # 輸出伺服器回應
-        print(response.status_code)
-        print(response.text)
-    
-    return print('OK!!!')
\ No newline at end of file
+        files = []
+        for root, dirs, names in os.walk(folder):
+            for name in sorted(names):
+                files.append(os.path.join(root, name))
+
+        if mode == 'instance':
+            for file_path in files:
+                with open(file_path, 'rb') as f:
+                    yield os.path.relpath(file_path, start=path_dcm), f.read(), 'instance'
+            continue
+
+        for i in range(0, len(files), files_per_zip):
+            buffer = io.BytesIO()
+            with zipfile.ZipFile(buffer, 'w', compression) as zipf:
+                for file_path in files[i:i + files_per_zip]:
+                    # 計算檔案在 zip 檔案中的相對路徑
+                    zipf.write(file_path, arcname=os.path.relpath(file_path, start=folder))
+            yield f'{series}_{i // files_per_zip:03d}.zip', buffer.getvalue(), 'zip'
+
+class OrthancUploader:
+    """
+    上傳到orthanc /instances，同時最多max_workers個request，記憶體中最多排2*max_workers個待上傳的payload(backpressure)
+    requests沒有保證Session是thread-safe，所以每個worker thread各自一個keep-alive session
+    """
+    def __init__(self, url=ORTHANC_URL, max_workers=4, retries=3, timeout=120, mode='zip', files_per_zip=64):
+        self.url = url
+        self.max_workers = max_workers
+        self.retries = retries
+        self.timeout = timeout
+        self.mode = mode
+        self.files_per_zip = files_per_zip
+        self._local = threading.local()
+        self._sessions = []
+        self._sessions_lock = threading.Lock()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = make_session(pool_size=1, retries=self.retries)
+            self._local.session = session
+            with self._sessions_lock:
+                self._sessions.append(session)
+        return session
+
+    def _post(self, name, payload, kind):
+        session = self._session()
+        if kind == 'zip':
+            #跟原本一樣以multipart file上傳zip
+            response = session.post(self.url, files={'file': (name, payload)}, timeout=self.timeout)
+        else:
+            response = session.post(self.url, data=payload, headers={'Content-Type': 'application/dicom'},
+                                    timeout=self.timeout)
+        return name, len(payload), response.status_code, response.text
+
+    def upload(self, path_dcm, Series):
+        start = time.time()
+        results = []
+        slots = threading.BoundedSemaphore(2 * self.max_workers)
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for name, payload, kind in iter_series_payloads(path_dcm, Series, self.mode, self.files_per_zip):
+                slots.acquire()
+                future = executor.submit(self._post, name, payload, kind)
+                future.add_done_callback(lambda _: slots.release())
+                futures.append(future)
+            for future in futures:
+                results.append(future.result())
+
+        total_mb = sum(r[1] for r in results) / 1024 ** 2
+        spend = max(time.time() - start, 1e-6)
+        failed = [r for r in results if r[2] != 200]
+        for name, size, status, text in failed:
+            print(f'upload failed: {name} {status} {text}')
+        print(f'[Done upload orthanc] {len(results)} requests, {total_mb:.1f} MB, {total_mb / spend:.1f} MB/s, failed {len(failed)}')
+        if failed:
+            #retry後還是失敗就讓呼叫端(upload_dicom stage)知道，不能當作上傳完成
+            raise RuntimeError(f"upload orthanc failed {len(failed)}/{len(results)}: " +
+                               ', '.join(f'{name}({status})' for name, size, status, text in failed))
+        return results
+
+    def close(self):
+        with self._sessions_lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions.clear()
+
+def upload_data(path_dcm, path_zip, Series, url=ORTHANC_URL, max_workers=4, mode='zip'):
+    """
+    path_zip: 沒有用到，只是保留給舊的呼叫方式(orthanc_zip_upload)；zip都在記憶體中產生，不會寫到硬碟
+    """
+    uploader = OrthancUploader(url, max_workers=max_workers, mode=mode)
+    try:
+        uploader.upload(path_dcm, Series)
+    finally:
+        uploader.close()
+    return print('OK!!!')
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    #假的orthanc，只收POST /instances並計算收到的bytes，用來離線測試上傳速度
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        received = 0
+        while received < length:
+            chunk = self.rfile.read(min(1024 * 1024, length - received))
+            if not chunk:
+                break
+            received += len(chunk)
+        self.server.received_bytes += received
+        self.server.received_requests += 1
+        body = json.dumps({'Status': 'Success', 'Bytes': received}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_standin_server(host='127.0.0.1', port=0):
+    #在背景thread啟動假的orthanc，回傳(server, /instances的url)，用server.shutdown()關閉
+    server = ThreadingHTTPServer((host, port), _StandInHandler)
+    server.received_bytes = 0
+    server.received_requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://{server.server_address[0]}:{server.server_address[1]}/instances'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path_dcm', type=str, help='包含各series資料夾的dicom路徑')
+    parser.add_argument('--series', type=str, nargs='+', default=['MRA_BRAIN', 'MIP_Pitch', 'MIP_Yaw', 'Dicom-Seg'])
+    parser.add_argument('--url', type=str, default=None, help='orthanc /instances，不給就用本機假的orthanc測速')
+    parser.add_argument('--max_workers', type=int, default=4)
+    parser.add_argument('--mode', type=str, default='zip', choices=['zip', 'instance'])
+    args = parser.parse_args()
+
+    server = None
+    url = args.url
+    if url is None:
+        server, url = start_standin_server()
+        print('stand-in orthanc:', url)
+    uploader = OrthancUploader(url, max_workers=args.max_workers, mode=args.mode)
+    try:
+        uploader.upload(args.path_dcm, args.series)
+    finally:
+        uploader.close()
+        if server is not None:
+            print(f'stand-in received {server.received_requests} requests, {server.received_bytes / 1024 ** 2:.1f} MB')
+            server.shutdown()
@@ -39,6 +39,8 @@ from collections import OrderedDict
 from scipy import ndimage
 from upload_orthanc import upload_data
 import requests
+import subprocess
+from json_delivery import deliver_json, UPLOAD_DATA_JSON_URL
 
 import tensorflow as tf
 import tensorflow.keras.backend as K
@@ -51,6 +53,12 @@ from collections import defaultdict
 import torch
 from torchvision.transforms.functional import rotate as rotate_torch
 from torchvision.transforms import InterpolationMode
+from mip_rotation import RotationEngine, place_mip, project_labels
+from mip_series_writer import MIPSeriesWriter
+from case_context import load_nii, save_nii
+from volume_io import read_image, read_label
+from iso_reslice import IsoReslicer
+from code_ai.pipeline.dicomseg.utils.base import DicomSegWriter
 
 from create_dicomseg_multi_file_json_claude import load_and_sort_dicom_files, make_study_json, MaskRequest, make_study_series_json
 
@@ -85,15 +93,14 @@ def nii_img_replace(data, new_img):
     new_nii = nib.nifti1.Nifti1Image(new_img, affine, header=header)
     return new_nii
 
-def reslice_nifti_pred_nobrain(path_nii, path_reslice):
-    img_nii = nib.load(os.path.join(path_nii, 'MRA_BRAIN.nii.gz')) #
-    img = np.array(img_nii.dataobj) #讀出label的array矩陣      #
-    pred_nii = nib.load(os.path.join(path_nii, 'Pred.nii.gz')) #
-    vessel_nii = nib.load(os.path.join(path_nii, 'Vessel.nii.gz')) #
+def reslice_nifti_pred_nobrain(path_nii, path_reslice, ctx=None):
+    #ctx: CaseContext，有的話直接用已解碼的影像，輸出也留在快取給後面的MIP使用
+    img_nii = load_nii(os.path.join(path_nii, 'MRA_BRAIN.nii.gz'), ctx) #
+    pred_nii = load_nii(os.path.join(path_nii, 'Pred.nii.gz'), ctx) #
+    vessel_nii = load_nii(os.path.join(path_nii, 'Vessel.nii.gz'), ctx) #
     original_affine = img_nii.affine.copy()  # 原始 affine
         
-    img = data_translate(img, img_nii)
-    y_i, x_i, z_i = img.shape #y, x, z 
+    x_i, y_i, z_i = img_nii.shape[:3] #只需要大小，data_translate後是y, x, z，不用先解碼整個影像
         
     header_img = img_nii.header.copy() #抓出nii header 去算體積 
     pixdim_img = header_img['pixdim']  #可以借此從nii的header抓出voxel size
@@ -102,9 +109,9 @@ def reslice_nifti_pred_nobrain(path_nii, path_reslice):
     new_y_i = int(z_i * (pixdim_img[3] / pixdim_img[1]))
 
     #先把影像從 original*original*103轉成 original*original*103 * (pixdim_img[3] / pixdim_img[1])
-    new_img_nii = nibabel.processing.conform(img_nii, ((x_i, y_i, new_y_i)),(pixdim_img[1], pixdim_img[2], pixdim_img[1]),order = 1) #影像用
-    new_pred_nii = nibabel.processing.conform(pred_nii, ((x_i, y_i, new_y_i)),(pixdim_img[1], pixdim_img[2], pixdim_img[1]),order = 0) #影像用
-    new_vessel_nii = nibabel.processing.conform(vessel_nii, ((x_i, y_i, new_y_i)),(pixdim_img[1], pixdim_img[2], pixdim_img[1]),order = 0) #影像用
+    #目標grid跟voxel對應只算一次，影像order 1、標註nearest，沿z分chunk平行算，結果跟各自conform一樣
+    reslicer = IsoReslicer(img_nii, (x_i, y_i, new_y_i), (pixdim_img[1], pixdim_img[2], pixdim_img[1]))
+    new_img_nii, new_pred_nii, new_vessel_nii = reslicer.resample_all([(img_nii, 1), (pred_nii, 0), (vessel_nii, 0)])
     
     #讀出矩陣，然後第一值是負就反存，讀取 conform 後的 affine
     conformed_affine = new_img_nii.affine.copy()
@@ -114,27 +121,26 @@ def reslice_nifti_pred_nobrain(path_nii, path_reslice):
         conformed_affine[0, :] *= -1  # 翻轉 X 軸方向
     
     # 建立新的影像
-    fixed_img_nii = nib.Nifti1Image(new_img_nii.get_fdata(), conformed_affine, new_img_nii.header)
-    fixed_pred_nii = nib.Nifti1Image(new_pred_nii.get_fdata().astype(int), conformed_affine, new_pred_nii.header)
-    fixed_vessel_nii = nib.Nifti1Image(new_vessel_nii.get_fdata().astype(int), conformed_affine, new_vessel_nii.header)
+    # 影像float32、標註uint8/int16，不產生float64/int64的複本
+    fixed_img_nii = nib.Nifti1Image(read_image(new_img_nii), conformed_affine, new_img_nii.header)
+    fixed_pred_nii = nib.Nifti1Image(read_label(new_pred_nii), conformed_affine, new_pred_nii.header)
+    fixed_vessel_nii = nib.Nifti1Image(read_label(new_vessel_nii), conformed_affine, new_vessel_nii.header)
 
     #輸出結果
-    nib.save(fixed_img_nii, os.path.join(path_reslice, 'MRA_BRAIN.nii.gz'))
-    nib.save(fixed_pred_nii, os.path.join(path_reslice, 'Pred.nii.gz')) 
-    nib.save(fixed_vessel_nii, os.path.join(path_reslice, 'Vessel.nii.gz')) 
+    save_nii(fixed_img_nii, os.path.join(path_reslice, 'MRA_BRAIN.nii.gz'), ctx)
+    save_nii(fixed_pred_nii, os.path.join(path_reslice, 'Pred.nii.gz'), ctx) 
+    save_nii(fixed_vessel_nii, os.path.join(path_reslice, 'Vessel.nii.gz'), ctx) 
 
     return print('reslice OK!!!')
 
 def reslice_nifti_label_pred_nobrain(path_nii, path_reslice):
     img_nii = nib.load(os.path.join(path_nii, 'MRA_BRAIN.nii.gz')) #
-    img = np.array(img_nii.dataobj) #讀出label的array矩陣      #
     label_nii = nib.load(os.path.join(path_nii, 'Label.nii.gz')) #
     pred_nii = nib.load(os.path.join(path_nii, 'Pred.nii.gz')) #
     vessel_nii = nib.load(os.path.join(path_nii, 'Vessel.nii.gz')) #
     original_affine = img_nii.affine.copy()  # 原始 affine
         
-    img = data_translate(img, img_nii)
-    y_i, x_i, z_i = img.shape #y, x, z 
+    x_i, y_i, z_i = img_nii.shape[:3] #只需要大小，data_translate後是y, x, z，不用先解碼整個影像
         
     header_img = img_nii.header.copy() #抓出nii header 去算體積 
     pixdim_img = header_img['pixdim']  #可以借此從nii的header抓出voxel size
@@ -143,10 +149,9 @@ def reslice_nifti_label_pred_nobrain(path_nii, path_reslice):
     new_y_i = int(z_i * (pixdim_img[3] / pixdim_img[1]))
 
     #先把影像從 original*original*103轉成 original*original*103 * (pixdim_img[3] / pixdim_img[1])
-    new_img_nii = nibabel.processing.conform(img_nii, ((x_i, y_i, new_y_i)),(pixdim_img[1], pixdim_img[2], pixdim_img[1]),order = 1) #影像用
-    new_label_nii = nibabel.processing.conform(label_nii, ((x_i, y_i, new_y_i)),(pixdim_img[1], pixdim_img[2], pixdim_img[1]),order = 0) #影像用
-    new_pred_nii = nibabel.processing.conform(pred_nii, ((x_i, y_i, new_y_i)),(pixdim_img[1], pixdim_img[2], pixdim_img[1]),order = 0) #影像用
-    new_vessel_nii = nibabel.processing.conform(vessel_nii, ((x_i, y_i, new_y_i)),(pixdim_img[1], pixdim_img[2], pixdim_img[1]),order = 0) #影像用
+    reslicer = IsoReslicer(img_nii, (x_i, y_i, new_y_i), (pixdim_img[1], pixdim_img[2], pixdim_img[1]))
+    new_img_nii, new_label_nii, new_pred_nii, new_vessel_nii = reslicer.resample_all(
+        [(img_nii, 1), (label_nii, 0), (pred_nii, 0), (vessel_nii, 0)])
     
     #讀出矩陣，然後第一值是負就反存，讀取 conform 後的 affine
     conformed_affine = new_img_nii.affine.copy()
@@ -156,10 +161,10 @@ def reslice_nifti_label_pred_nobrain(path_nii, path_reslice):
         conformed_affine[0, :] *= -1  # 翻轉 X 軸方向
     
     # 建立新的影像
-    fixed_img_nii = nib.Nifti1Image(new_img_nii.get_fdata(), conformed_affine, new_img_nii.header)
-    fixed_label_nii = nib.Nifti1Image(new_label_nii.get_fdata(), conformed_affine, new_label_nii.header)
-    fixed_pred_nii = nib.Nifti1Image(new_pred_nii.get_fdata().astype(int), conformed_affine, new_pred_nii.header)
-    fixed_vessel_nii = nib.Nifti1Image(new_vessel_nii.get_fdata().astype(int), conformed_affine, new_vessel_nii.header)
+    fixed_img_nii = nib.Nifti1Image(read_image(new_img_nii), conformed_affine, new_img_nii.header)
+    fixed_label_nii = nib.Nifti1Image(read_label(new_label_nii), conformed_affine, new_label_nii.header)
+    fixed_pred_nii = nib.Nifti1Image(read_label(new_pred_nii), conformed_affine, new_pred_nii.header)
+    fixed_vessel_nii = nib.Nifti1Image(read_label(new_vessel_nii), conformed_affine, new_vessel_nii.header)
 
     #輸出結果
     nib.save(fixed_img_nii, os.path.join(path_reslice, 'MRA_BRAIN.nii.gz'))
@@ -169,7 +174,7 @@ def reslice_nifti_label_pred_nobrain(path_nii, path_reslice):
 
     return print('reslice OK!!!')
 
-def create_MIP_pred(path_dcm, path_nii, path_png, gpu_num, create_label_mip=False):
+def create_MIP_pred(path_dcm, path_nii, path_png, gpu_num, create_label_mip=False, use_dcm2niix=False, ctx=None):
 
     #gpu_available = tf.config.list_physical_devices('GPU')
     #print(gpu_available)
@@ -255,198 +260,6 @@ def create_MIP_pred(path_dcm, path_nii, path_png, gpu_num, create_label_mip=Fals
         x_di = ndimage.binary_dilation(x, structure=kernel, iterations=15) #亂做n次，kernel越小算越快
         return x_di
 
-    def rotate_tf(x, i, axes):
-        c = np.zeros((int(x.shape[0]), int(x.shape[1]), 1))
-        for j in range(0,i*5, i):
-            r_x = rotate(x, j, axes, reshape=False)
-            MIP_x = createMIP(r_x)
-            c = np.concatenate([c, np.expand_dims(MIP_x, axis=-1)], axis = -1)
-        #把第一個去除
-        return c[:,:,1:]
-
-    def rotation_3d(X, axis, theta, expand=True, fill=0.0, label=False, gpu=None):
-        """
-        The rotation is based on torchvision.transforms.functional.rotate, which is originally made for a 2d image rotation
-        :param X: the data that should be rotated, a torch.tensor or an ndarray, with lenx * leny * lenz shape.
-        :param axis: the rotation axis based on the keynote request. 0 for x axis, 1 for y axis, and 2 for z axis.
-        :param expand:  (bool, optional) – Optional expansion flag. If true, expands the output image to make it large enough to hold the entire rotated image. If false or omitted, make the output image the same size as the input image. Note that the expand flag assumes rotation around the center and no translation.
-        :param fill:  (sequence or number, optional) –Pixel fill value for the area outside the transformed image. If given a number, the value is used for all bands respectively.
-        :param theta: the rotation angle, Counter-clockwise rotation, [-180, 180] degrees.
-        :return: rotated tensor.
-        expand=True時要修正旋轉的大小
-        原版是Z, H, W這樣的矩陣方向再去旋轉
-        我這邊矩陣放 H, W, Z，所以在axis=0時變成左右轉
-        """
-        #先獲得x的長寬以用於更新尺寸
-        #device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
-        """
-        初始化類並設置裝置。
-        
-        參數：
-        - gpu：可選的整數，指定要使用的 GPU 設備編號（例如0、1、2、3等）。如果為 None，則根據 CUDA 是否可用選擇默認 GPU。
-        """
-        if gpu is not None:
-            device = f'cuda:{gpu}'
-        else:
-            device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
-
-        if isinstance(X, np.ndarray):
-            # Make a copy of the array to avoid negative strides issue
-            X = np.copy(X)
-            X = np.copy(X)
-            X = torch.from_numpy(X).float()
-            
-        X = X.to(device)
-
-        if axis == 0:
-            interpolation_mode = InterpolationMode.NEAREST if label else InterpolationMode.BILINEAR
-            X = rotate_torch(X, interpolation=interpolation_mode, angle=theta, expand=expand, fill=fill)
-            
-        elif axis == 1:
-            X = X.permute((1, 0, 2))
-            interpolation_mode = InterpolationMode.NEAREST if label else InterpolationMode.BILINEAR
-            X = rotate_torch(X, interpolation=interpolation_mode, angle=theta, expand=expand, fill=fill)
-            X = X.permute((1, 0, 2))
-            X = torch.flip(X, [2])
-
-        elif axis == 2:
-            X = X.permute((2, 1, 0))
-            interpolation_mode = InterpolationMode.NEAREST if label else InterpolationMode.BILINEAR
-            X = rotate_torch(X, interpolation=interpolation_mode, angle=-theta, expand=expand, fill=fill)
-            X = X.permute((2, 1, 0))
-            X = torch.flip(X, [2]) #這個還要修正
-            
-        else:
-            raise Exception('Not invalid axis')
-
-        return X.squeeze(0)
-
-    # def createMIP_single(np_img):
-    #     Mip_z = np.max(np_img, axis=-1)
-    #     return Mip_z
-    def createMIP_single(tensor3d):
-        return torch.amax(tensor3d, dim=-1)    
-
-    class createMIP:
-        # 使用示例：
-        # createMIP
-        #createMIP = createMIP()
-
-        # 假設已定義了translated_vessel_img、angle、angle_one、y_i和x_i
-        # 呼叫process_images方法來處理圖像
-        #processed_images = rotator.process_images(translated_vessel_img, angle, angle_one, y_i, x_i)
-        
-        def __init__(self):
-            #__init__：初始化類並設置裝置（如果GPU可用則為'cuda:0'，否則為'cpu'）。
-            #self.device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
-            return
-
-        def rotation_3d(self, X, axis, theta, expand=True, fill=0.0, label=False):
-            """
-            將一個3D tensor或numpy陣列沿指定軸進行旋轉。
-
-            參數：
-            - X：torch.tensor或np.ndarray，輸入的資料，形狀為(lenx, leny, lenz)。
-            - axis：整數，旋轉軸（0表示x軸，1表示y軸，2表示z軸）。 0目前是水平轉, 1是垂直轉, 2是側手翻
-            - theta：浮點數，旋轉角度（遞減角度為正）。
-            - expand：布林值，可選，擴展輸出圖像大小（默認為True）。
-            - fill：序列或數字，可選，填充值，用於轉換圖像外部區域。
-            - label：布林值，可選，對標籤使用最近鄰插值（默認為False）。
-
-            返回：
-            - 旋轉後的tensor：torch.tensor，旋轉後的輸入tensor。
-            """
-            if isinstance(X, np.ndarray):
-                X = np.copy(X)
-                #X = torch.from_numpy(X).float()
-                X = torch.from_numpy(X)
-            
-            X = X.to(self.device)
-
-            if axis == 0:
-                interpolation_mode = InterpolationMode.NEAREST if label else InterpolationMode.BILINEAR
-                X = rotate_torch(X, interpolation=interpolation_mode, angle=theta, expand=expand, fill=fill)
-            
-            elif axis == 1:
-                X = X.permute((1, 0, 2))
-                interpolation_mode = InterpolationMode.NEAREST if label else InterpolationMode.BILINEAR
-                X = rotate_torch(X, interpolation=interpolation_mode, angle=theta, expand=expand, fill=fill)
-                X = X.permute((1, 0, 2))
-                X = torch.flip(X, [2]) #這個還要修正
-
-            elif axis == 2:
-                X = X.permute((2, 1, 0))
-                interpolation_mode = InterpolationMode.NEAREST if label else InterpolationMode.BILINEAR
-                X = rotate_torch(X, interpolation=interpolation_mode, angle=-theta, expand=expand, fill=fill)
-                X = X.permute((2, 1, 0))
-                X = torch.flip(X, [2]) #這個還要修正
-        
-            else:
-                raise ValueError('無效的軸值。預期為0、1或2。')
-
-            return X
-
-        def process_images(self, translated_img, angle, angle_step, y_i, x_i, axis, label=False, gpu=None):
-            """
-            初始化類並設置裝置。
-            
-            參數：
-            - gpu：可選的整數，指定要使用的 GPU 設備編號（例如0、1、2、3等）。如果為 None，則根據 CUDA 是否可用選擇默認 GPU。
-            """
-            if gpu is not None:
-                self.device = f'cuda:{gpu}'
-            else:
-                self.device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
-
-            img_list = []
-
-            #這邊補0的大小要跟axial view一樣
-
-
-            angle_list = np.arange(0, angle, angle_step)
-            
-            for i in angle_list:
-                if axis == 0:
-                    output1 = self.rotation_3d(translated_img, 0, -float(i), expand=True, label=label) #水平
-                elif axis == 1:
-                    output1 = self.rotation_3d(translated_img, 1, -float(i), expand=True, label=label)  # 垂直旋轉
-                    
-                MIP = torch.zeros(y_i, x_i).to(self.device)
-
-                #到一個output1 => 4g
-                MIP_r = output1.amax(-1)
-                y_r, x_r = MIP_r.shape[0], MIP_r.shape[1]
-
-                if axis == 0:
-                    if x_r > x_i:
-                        slice_y = int((y_i - y_r) / 2)
-                        slice_x = int((x_r - x_i) / 2)
-                        MIP[slice_y:slice_y+y_r,:] = MIP_r[:,slice_x:slice_x+x_i]
-                    else:
-                        slice_y = int((y_i - y_r) / 2)
-                        slice_x = int((x_i - x_r) / 2)
-                        MIP[slice_y:slice_y+y_r,slice_x:slice_x+x_r] = MIP_r            
-                
-                elif axis == 1:
-                    if y_r > y_i:
-                        slice_y = int((y_r - y_i) / 2)
-                        slice_x = int((x_r - x_i) / 2)
-                        MIP = MIP_r[slice_y:slice_y + y_i, slice_x:slice_x + x_i]
-                    else:
-                        slice_y = int((y_i - y_r) / 2)
-                        slice_x = int((x_i - x_r) / 2)
-                        MIP[slice_y:slice_y + y_r, slice_x:slice_x + x_r] = MIP_r
-
-                img_list.append(MIP)
-
-            mip_img = torch.stack(img_list, dim=-1)
-            #mip_img = torch.flip(mip_img, dims=[0])
-            #mip_img = mip_img.permute(1, 2, 0)
-            mip_img_np = mip_img.cpu().numpy()
-
-            return mip_img_np
-        
-    
     #以下開始製作MIP跟label
     angle = 180
     angle_step = 3
@@ -457,16 +270,16 @@ def create_MIP_pred(path_dcm, path_nii, path_png, gpu_num, create_label_mip=Fals
     start = time.time()
     path_dcms = os.path.join(path_dcm, 'MRA_BRAIN')
     #先讀影像
-    img_nii = nib.load(os.path.join(path_nii, 'MRA_BRAIN.nii.gz')) #ADC要讀因為會取ADC值判斷
+    img_nii = load_nii(os.path.join(path_nii, 'MRA_BRAIN.nii.gz'), ctx) #ADC要讀因為會取ADC值判斷
     img = np.array(img_nii.dataobj) #讀出label的array矩陣      #256*256*22
-    pred_nii = nib.load(os.path.join(path_nii, 'Pred.nii.gz')) #ADC要讀因為會取ADC值判斷
+    pred_nii = load_nii(os.path.join(path_nii, 'Pred.nii.gz'), ctx) #ADC要讀因為會取ADC值判斷
     pred = np.array(pred_nii.dataobj) #讀出label的array矩陣      #256*256*22 
-    vessel_nii = nib.load(os.path.join(path_nii, 'Vessel.nii.gz')) #ADC要讀因為會取ADC值判斷
+    vessel_nii = load_nii(os.path.join(path_nii, 'Vessel.nii.gz'), ctx) #ADC要讀因為會取ADC值判斷
     vessel = np.array(vessel_nii.dataobj) #讀出label的array矩陣      #256*256*22     
     
     # 可選載入 label_nii，處理方式與 pred_nii 完全相同
     if create_label_mip:
-        label_nii = nib.load(os.path.join(path_nii, 'Label.nii.gz'))
+        label_nii = load_nii(os.path.join(path_nii, 'Label.nii.gz'), ctx)
         label = np.array(label_nii.dataobj) #讀出label的array矩陣      #256*256*22
     
     img = data_translate(img, img_nii)
@@ -534,14 +347,21 @@ def create_MIP_pred(path_dcm, path_nii, path_png, gpu_num, create_label_mip=Fals
     translated_vessel = np.swapaxes(vessel,0,-1).copy()
     #translated_vessel = np.flip(translated_vessel, 1)
     translated_pred = np.swapaxes(pred,0,-1).copy()
-    translated_pred = torch.from_numpy(translated_pred).to(torch.int16).to("cuda")
     if create_label_mip:
         translated_label = np.swapaxes(label,0,-1).copy()
         # 先四捨五入，再轉成int16，避免浮點數截斷導致標籤值錯誤
         translated_label = np.round(translated_label).astype(np.int16)
-        translated_label = torch.from_numpy(translated_label).to("cuda")
+        label_num = int(np.round(np.max(label)))
+
+    #旋轉引擎，有GPU用GPU，沒有就用CPU多執行緒，每個角度的grid只算一次
+    #vessel、pred、label用nearest疊在一起一次轉完，轉好的vessel同時給MIP血管跟所有aneurysm的遮擋計算共用
+    engine = RotationEngine(gpu=gpu_num)
+    translated_vessel_img = engine.to_tensor(translated_vessel_img)
+    label_volumes = [engine.to_tensor(translated_vessel, torch.float32), engine.to_tensor(translated_pred, torch.int16).to(torch.float32)]
+    if create_label_mip:
+        label_volumes.append(engine.to_tensor(translated_label, torch.float32))
 
-    print('img.shape:', img.shape,'translated_pred:', translated_pred.shape) 
+    print('img.shape:', img.shape,'translated_pred:', translated_pred.shape, 'device:', engine.device) 
     for series in Series:
         path_vesselMIP = os.path.join(path_dcm, series)    
         if not os.path.isdir(path_vesselMIP):
@@ -562,181 +382,39 @@ def create_MIP_pred(path_dcm, path_nii, path_png, gpu_num, create_label_mip=Fals
             
         #先做垂直轉Pitch，再做水平轉Yaw
         start_img = time.time()
-        createrMIP = createMIP()
-        # 假設已定義了translated_vessel_img、angle、angle_one、y_i和x_i。 y_i和x_i是轉出目標影像的大小，以背景補0為主
-        # 呼叫process_images方法來處理圖像
-        MIP_images = createrMIP.process_images(translated_vessel_img, angle, angle_step, y_i, x_i, axis=axis, label=False, gpu=gpu_num).astype('int16')
-        #print('Time taken for {} sec\n'.format(time.time()-start_img), ' MIP_images is OK!!!, Next...')
-    
+        angle_list = np.arange(0, angle, angle_step)
+        MIP_images = torch.zeros((y_i, x_i, angle_list.shape[0]), dtype=torch.float32, device=engine.device)
         #血管確認是否有阻擋是改成前後一起看，所以可以當作MIP後確認重疊比例，所以可以label也做mip、vessel也做mip
         #MIP血管還是要做，因為要產生血管的mask
-        MIP_vessels = createrMIP.process_images(translated_vessel, angle, angle_step, y_i, x_i, axis=axis, label=True, gpu=gpu_num).astype('int16')
-        #print('Time taken for {} sec\n'.format(time.time()-start), 'MIP_images.shape:', MIP_images.shape)
-
-        #label比較麻煩，需要重新根據旋轉的血管結果修正
-        count_pred = 0 #紀錄現在是第幾張
-        cover_ranges_pred = np.zeros((int(MIP_images.shape[-1]) , pred_num)) #記錄哪張血管遮擋最少
-
-        angle_list = np.arange(0, angle, angle_step)
-        #new_pred = np.zeros((y_i, x_i, angle_list.shape[0])) #會跟mip的影像一樣大，雖已知大小，但跟for迴圈有關，跟旋轉的角度一樣多
-        # Rewritten version for CUDA computation
-        new_pred = torch.zeros((y_i, x_i, angle_list.shape[0]), dtype=torch.int16, device='cuda')
-
-        for i in angle_list:
-            #結果還是要做出血管個別旋轉的圖
-            if axis == 0:
-                rotated_vessel = rotation_3d(translated_vessel,  axis, -float(i), expand=True, label=True, gpu=gpu_num) #rotated_vessel大小會一直變動
-            elif axis ==1:
-                rotated_vessel = rotation_3d(translated_vessel,  axis, -float(i),  expand=True, label=True, gpu=gpu_num) #rotated_vessel大小會一直變動
-            
-            new_pred_slice = torch.zeros((y_i, x_i), dtype=torch.int16, device='cuda')
-            for j in range(pred_num):
-                pred_one = (translated_pred == j + 1).to(torch.uint8)
-
-                if axis == 0:
-                    rotated_pred_one = rotation_3d(pred_one,  axis, -float(i), expand=True, label=True, gpu=gpu_num) #rotated_vessel大小會一直變動
-                elif axis == 1:
-                    rotated_pred_one = rotation_3d(pred_one,  axis, -float(i),  expand=True, label=True, gpu=gpu_num) #rotated_vessel大小會一直變動
-
-                pred_z = rotated_pred_one.sum(dim=(0, 1)) #對z軸sum
-                pred_z_list = torch.nonzero(pred_z > 0, as_tuple=False).squeeze() #做前面那點label是在哪裡
-
-                if pred_z_list.numel() == 0:
-                    pred_z_list = torch.tensor([1], device='cuda')
-                
-                index_front = max(int(pred_z_list[0]) - 3, 1)
-                index_back = min(int(pred_z_list[-1]) + 3, rotated_vessel.shape[-1] - 1)
-
-                #對label做projection去獲得投影後的x,y
-                pred_mip = createMIP_single(rotated_pred_one)
-                pred_mip_s = pred_mip.clone() #原版都沒阻擋
-
-                vessel_mip_front = createMIP_single(rotated_vessel[:, :, :index_front])
-                pred_mip[vessel_mip_front > 0] = 0 #前面有阻擋到的就等於0
-
-                vessel_mip_back = createMIP_single(rotated_vessel[:, :, index_back:])
-                pred_cover = pred_mip.clone()
-                pred_cover[vessel_mip_back > 0] = 0 #後面有阻擋到的就等於0
-
-                extra_pred = torch.zeros((y_i, x_i), dtype=torch.int16, device='cuda')
-                y_r, x_r = pred_mip.shape
-                
-                if axis == 0:
-                    if x_r > x_i:
-                        slice_y = (y_i - y_r) // 2
-                        slice_x = (x_r - x_i) // 2
-                        extra_pred[slice_y:slice_y + y_r, :] = pred_mip[:, slice_x:slice_x + x_i]
-                    else:
-                        slice_y = (y_i - y_r) // 2
-                        slice_x = (x_i - x_r) // 2
-                        extra_pred[slice_y:slice_y + y_r, slice_x:slice_x + x_r] = pred_mip
-                else:
-                    if y_r > y_i:
-                        slice_y = (y_r - y_i) // 2
-                        slice_x = (x_r - x_i) // 2
-                        extra_pred = pred_mip[slice_y:slice_y + y_i, slice_x:slice_x + x_i]
-                    else:
-                        slice_y = (y_i - y_r) // 2
-                        slice_x = (x_i - x_r) // 2
-                        extra_pred[slice_y:slice_y + y_r, slice_x:slice_x + x_r] = pred_mip
-                
-                new_pred_slice[extra_pred > 0] = j + 1
-    
-                #這邊先根據MIP計算出遮擋最大值，這邊統計一個數字是標註被血管擋掉的百分比(前後)，減少跑for迴圈
-                #print('slice:', i, ' ane:', j, ' np.sum(label_cover):', np.sum(label_cover), ' np.sum(extra_label):', np.sum(extra_label))
-                if torch.sum(extra_pred) > 0:
-                    cover_range = torch.sum(pred_cover).float() / torch.sum(pred_mip_s).float()
-                    cover_range = min(cover_range.item(), 0.98)
-                else:
-                    cover_range = 0.0
-                cover_ranges_pred[count_pred, j] = cover_range
-
-            new_pred[:, :, count_pred] = new_pred_slice
-            count_pred += 1
-
-        # 將 pred 移到 CPU（但不刪除 translated_pred，因為下一個 series 還需要使用）
+        MIP_vessels = torch.zeros((y_i, x_i, angle_list.shape[0]), dtype=torch.float32, device=engine.device)
+        new_pred = torch.zeros((y_i, x_i, angle_list.shape[0]), dtype=torch.int16, device=engine.device)
+        cover_ranges_pred = np.zeros((angle_list.shape[0], pred_num)) #記錄哪張血管遮擋最少
+        if create_label_mip:
+            new_label = torch.zeros((y_i, x_i, angle_list.shape[0]), dtype=torch.int16, device=engine.device)
+            cover_ranges_label = np.zeros((angle_list.shape[0], label_num))
+
+        for count, i in enumerate(angle_list):
+            #影像用bilinear
+            rotated_img = engine.rotate3d(translated_vessel_img, axis, -float(i), label=False)
+            MIP_images[:, :, count] = place_mip(rotated_img.amax(-1), y_i, x_i, axis)
+            del rotated_img
+
+            #vessel跟label用nearest一次轉完
+            rotated = engine.rotate3d_stack(label_volumes, axis, -float(i), label=True)
+            rotated_vessel, rotated_pred = rotated[0], rotated[1]
+            MIP_vessels[:, :, count] = place_mip(rotated_vessel.amax(-1), y_i, x_i, axis)
+
+            new_pred[:, :, count], cover_ranges_pred[count, :] = project_labels(rotated_pred, rotated_vessel, pred_num, y_i, x_i, axis)
+            if create_label_mip:
+                new_label[:, :, count], cover_ranges_label[count, :] = project_labels(rotated[2], rotated_vessel, label_num, y_i, x_i, axis)
+            del rotated, rotated_vessel, rotated_pred
+
+        MIP_images = MIP_images.cpu().numpy().astype('int16')
+        MIP_vessels = MIP_vessels.cpu().numpy().astype('int16')
         new_pred = new_pred.cpu().numpy().astype(np.int16)
-        
-        # 如果需要處理 label，在 pred 處理完成後才開始（節省 GPU RAM）
         if create_label_mip:
-            print('開始處理 label MIP...')
-            count_label = 0
-            label_num = int(np.round(np.max(label)))
-            cover_ranges_label = np.zeros((int(MIP_images.shape[-1]) , label_num))
-            new_label = torch.zeros((y_i, x_i, angle_list.shape[0]), dtype=torch.int16, device='cuda')
-            
-            for i in angle_list:
-                # 重新計算旋轉的血管（與 pred 循環相同）
-                if axis == 0:
-                    rotated_vessel = rotation_3d(translated_vessel,  axis, -float(i), expand=True, label=True, gpu=gpu_num)
-                elif axis ==1:
-                    rotated_vessel = rotation_3d(translated_vessel,  axis, -float(i),  expand=True, label=True, gpu=gpu_num)
-                
-                new_label_slice = torch.zeros((y_i, x_i), dtype=torch.int16, device='cuda')
-                for j in range(label_num):
-                    label_one = (translated_label == j + 1).to(torch.uint8)
-
-                    if axis == 0:
-                        rotated_label_one = rotation_3d(label_one,  axis, -float(i), expand=True, label=True, gpu=gpu_num)
-                    elif axis == 1:
-                        rotated_label_one = rotation_3d(label_one,  axis, -float(i),  expand=True, label=True, gpu=gpu_num)
-
-                    label_z = rotated_label_one.sum(dim=(0, 1))
-                    label_z_list = torch.nonzero(label_z > 0, as_tuple=False).squeeze()
-
-                    if label_z_list.numel() == 0:
-                        label_z_list = torch.tensor([1], device='cuda')
-                    
-                    index_front = max(int(label_z_list[0]) - 3, 1)
-                    index_back = min(int(label_z_list[-1]) + 3, rotated_vessel.shape[-1] - 1)
-
-                    label_mip = createMIP_single(rotated_label_one)
-                    label_mip_s = label_mip.clone()
-
-                    vessel_mip_front = createMIP_single(rotated_vessel[:, :, :index_front])
-                    label_mip[vessel_mip_front > 0] = 0
-
-                    vessel_mip_back = createMIP_single(rotated_vessel[:, :, index_back:])
-                    label_cover = label_mip.clone()
-                    label_cover[vessel_mip_back > 0] = 0
-
-                    extra_label = torch.zeros((y_i, x_i), dtype=torch.int16, device='cuda')
-                    y_r, x_r = label_mip.shape
-                    
-                    if axis == 0:
-                        if x_r > x_i:
-                            slice_y = (y_i - y_r) // 2
-                            slice_x = (x_r - x_i) // 2
-                            extra_label[slice_y:slice_y + y_r, :] = label_mip[:, slice_x:slice_x + x_i]
-                        else:
-                            slice_y = (y_i - y_r) // 2
-                            slice_x = (x_i - x_r) // 2
-                            extra_label[slice_y:slice_y + y_r, slice_x:slice_x + x_r] = label_mip
-                    else:
-                        if y_r > y_i:
-                            slice_y = (y_r - y_i) // 2
-                            slice_x = (x_r - x_i) // 2
-                            extra_label = label_mip[slice_y:slice_y + y_i, slice_x:slice_x + x_i]
-                        else:
-                            slice_y = (y_i - y_r) // 2
-                            slice_x = (x_i - x_r) // 2
-                            extra_label[slice_y:slice_y + y_r, slice_x:slice_x + x_r] = label_mip
-                    
-                    new_label_slice[extra_label > 0] = j + 1
-        
-                    if torch.sum(extra_label) > 0:
-                        cover_range = torch.sum(label_cover).float() / torch.sum(label_mip_s).float()
-                        cover_range = min(cover_range.item(), 0.98)
-                    else:
-                        cover_range = 0.0
-                    cover_ranges_label[count_label, j] = cover_range
-
-                new_label[:, :, count_label] = new_label_slice
-                count_label += 1
-            
-            # 將 label 移到 CPU（但不刪除 translated_label，因為下一個 series 還需要使用）
             new_label = new_label.cpu().numpy().astype(np.int16)
-            print('label MIP 處理完成')
+        print(f"[Done {series} rotation... ] spend {time.time() - start_img:.0f} sec")
 
         #這邊在第一張時多做一個含有landmark的圖
         MIP_mark = MIP_images[:,:,0].astype('int16').copy()
@@ -751,28 +429,37 @@ def create_MIP_pred(path_dcm, path_nii, path_png, gpu_num, create_label_mip=Fals
         fig_pitch[y_displacement:pitch_resize.shape[0]+y_displacement, x_displacement:pitch_resize.shape[1]+x_displacement] = pitch_resize
         fig_pitch[fig_pitch > 0] = np.max(MIP_images[:,:,0]) #因為疊上去讓他報數值，這樣背景就會變暗
         output_pitch = cv2.add(MIP_mark, fig_pitch)  # 疊加第一張
-        dcm_slice = pydicom.dcmread(dcms_tofmra[-1]) #dicom每次都會連著修改一下，所以範本要在迴圈中讀取
-        print("Transfer syntax:", dcm_slice.file_meta.TransferSyntaxUID)
-        img_example = dcm_slice.pixel_array
-        print("Image shape:", img_example.shape, "dtype:", img_example.dtype)
-        new_dcm_seg = img_to_MIPdicom(dcm_slice, output_pitch, series, series_uid, SE, '00', 0, 
-                                       fixed_slice_thickness=calculated_spacing) #從0開始，使用統一的 slice_thickness
-        new_dcm_seg.save_as(os.path.join(path_vesselMIP, series + '_' + str(0).rjust(4,'0') + '_.dcm')) #存出新dicom，同存同一層，因為有壓時間，所以不會互相覆蓋        
-
-        #因為做出新標註需要影像的affine matrix，所以這邊先做出dicom並轉出nifti
-        for k in range(int(MIP_images.shape[-1])):    
+        if use_dcm2niix:
             dcm_slice = pydicom.dcmread(dcms_tofmra[-1]) #dicom每次都會連著修改一下，所以範本要在迴圈中讀取
-            new_dcm_seg = img_to_MIPdicom(dcm_slice, MIP_images[:,:,k], series, series_uid, SE, k, k+1,
-                                          fixed_slice_thickness=calculated_spacing) #最後一項是image position所以多下降一次，使用統一的 slice_thickness
-            new_dcm_seg.save_as(os.path.join(path_vesselMIP, series + '_' + str(k).rjust(4,'0') + '.dcm')) #存出新dicom，同存同一層，因為有壓時間，所以不會互相覆蓋        
-    
-        #先製作出影像的nifti，如後讀取後將相關資訊套用到新label中，以下跑dcm2niix
-        bash_line = 'dcm2niix -z y -f ' + series + ' -o ' + path_nii + ' ' + path_vesselMIP #把tag檔案複製，-v : verbose (n/y or 0/1/2, default 0) [no, yes, logorrheic]
-        #print('bash_line:', bash_line)
-        os.system(bash_line) 
+            new_dcm_seg = img_to_MIPdicom(dcm_slice, output_pitch, series, series_uid, SE, '00', 0, 
+                                           fixed_slice_thickness=calculated_spacing) #從0開始，使用統一的 slice_thickness
+            new_dcm_seg.save_as(os.path.join(path_vesselMIP, series + '_' + str(0).rjust(4,'0') + '_.dcm')) #存出新dicom，同存同一層，因為有壓時間，所以不會互相覆蓋        
+
+            #因為做出新標註需要影像的affine matrix，所以這邊先做出dicom並轉出nifti
+            for k in range(int(MIP_images.shape[-1])):    
+                dcm_slice = pydicom.dcmread(dcms_tofmra[-1]) #dicom每次都會連著修改一下，所以範本要在迴圈中讀取
+                new_dcm_seg = img_to_MIPdicom(dcm_slice, MIP_images[:,:,k], series, series_uid, SE, k, k+1,
+                                              fixed_slice_thickness=calculated_spacing) #最後一項是image position所以多下降一次，使用統一的 slice_thickness
+                new_dcm_seg.save_as(os.path.join(path_vesselMIP, series + '_' + str(k).rjust(4,'0') + '.dcm')) #存出新dicom，同存同一層，因為有壓時間，所以不會互相覆蓋        
         
-        #讀取nifti取得新affine matrix
-        img_pitch_nii = nib.load(os.path.join(path_nii, series + '.nii.gz')) #ADC要讀因為會取ADC值判斷
+            #先製作出影像的nifti，如後讀取後將相關資訊套用到新label中，以下跑dcm2niix
+            bash_line = 'dcm2niix -z y -f ' + series + ' -o ' + path_nii + ' ' + path_vesselMIP #把tag檔案複製，-v : verbose (n/y or 0/1/2, default 0) [no, yes, logorrheic]
+            #print('bash_line:', bash_line)
+            os.system(bash_line) 
+            
+            #讀取nifti取得新affine matrix
+            img_pitch_nii = nib.load(os.path.join(path_nii, series + '.nii.gz')) #ADC要讀因為會取ADC值判斷
+        else:
+            #範本只讀一次，thread pool寫出landmark + 每個角度的dicom，nifti直接由記憶體中的MIP算出，不再跑dcm2niix
+            start_write = time.time()
+            writer = MIPSeriesWriter(dcms_tofmra[-1], series, series_uid, SE, calculated_spacing)
+            mip_slices = [(output_pitch, '00', 0, series + '_' + str(0).rjust(4,'0') + '_.dcm')]
+            mip_slices += [(MIP_images[:,:,k], k, k+1, series + '_' + str(k).rjust(4,'0') + '.dcm') for k in range(int(MIP_images.shape[-1]))]
+            writer.write_series(mip_slices, path_vesselMIP)
+
+            img_pitch_nii = writer.to_nifti(np.stack([output_pitch.astype('int16')] + [MIP_images[:,:,k] for k in range(int(MIP_images.shape[-1]))], axis=-1))
+            nib.save(img_pitch_nii, os.path.join(path_nii, series + '.nii.gz'))
+            print(f"[Done {series} dicom/nifti... ] spend {time.time() - start_write:.0f} sec")
 
         #這邊先做血管mask存出mask，取完前三張，最後加上1張最頂端landmark，再重組回去
         vessel_landmark = np.zeros((y_i, x_i, 1))
@@ -846,15 +533,16 @@ def create_MIP_pred(path_dcm, path_nii, path_png, gpu_num, create_label_mip=Fals
         #print('Time taken for {} sec\n'.format(time.time()-start))
 
     # 所有 series 處理完成後，釋放 GPU 記憶體
-    del translated_pred
-    if create_label_mip:
-        del translated_label
-    torch.cuda.empty_cache()
+    del label_volumes, translated_vessel_img
+    if engine.device.type == 'cuda':
+        torch.cuda.empty_cache()
 
 
 class AneurysmPipeline:
-    def __init__(self, path_dcm, path_nii, path_excel, patient_id):
+    def __init__(self, path_dcm, path_nii, path_excel, patient_id, ctx=None, path_dcm_series=None):
         self.path_dcm = path_dcm
+        self.path_dcm_series = path_dcm_series  #直接指定dicom series資料夾(例如原始輸入)，不用等複製/解壓縮完
+        self.ctx = ctx  #CaseContext，同一個Pred.nii.gz在各步驟只解壓縮一次
         self.path_nii = path_nii
         self.path_excel = path_excel
         self.patient_id = patient_id
@@ -900,11 +588,11 @@ class AneurysmPipeline:
         return new_nii
 
     def make_aneurysm_vessel_location_16labels_pred(self):
-        label_nii = nib.load(os.path.join(self.path_nii, 'Pred.nii.gz'))
+        label_nii = load_nii(os.path.join(self.path_nii, 'Pred.nii.gz'), self.ctx)
         label = np.array(label_nii.dataobj)
         label = self.data_translate(label, label_nii)
 
-        vessel_nii = nib.load(os.path.join(self.path_nii, 'Vessel_16.nii.gz'))
+        vessel_nii = load_nii(os.path.join(self.path_nii, 'Vessel_16.nii.gz'), self.ctx)
         vessel = np.array(vessel_nii.dataobj)
         vessel = self.data_translate(vessel, vessel_nii)
 
@@ -931,7 +619,7 @@ class AneurysmPipeline:
 
         new_label_back = self.data_translate_back(new_label, label_nii).astype(int)
         new_label_nii = self.nii_img_replace(label_nii, new_label_back)
-        nib.save(new_label_nii, os.path.join(self.path_nii, 'Pred_Location16labels.nii.gz'))
+        save_nii(new_label_nii, os.path.join(self.path_nii, 'Pred_Location16labels.nii.gz'), self.ctx)
 
     def calculate_aneurysm_long_axis_make_pred(self):
         excel_file = os.path.join(self.path_excel, 'Aneurysm_Pred_long_axis_list.xlsx')
@@ -944,13 +632,16 @@ class AneurysmPipeline:
         Sdate = self.patient_id[9:17]
         AN = '_'.join(self.patient_id.split('/')[-1].split('_')[3:4])
 
-        img_nii = nib.load(os.path.join(self.path_nii, 'MRA_BRAIN.nii.gz'))
+        img_nii = load_nii(os.path.join(self.path_nii, 'MRA_BRAIN.nii.gz'), self.ctx)
         img_array = np.array(img_nii.dataobj)
         img_array = self.data_translate(img_array, img_nii)
 
         # 嘗試讀取DICOM資訊取得pixel_size及spacing
         try:
-            if os.path.isdir(os.path.join(self.path_dcm, 'TOF_MRA')):
+            if self.path_dcm_series is not None:
+                img_list = sorted(os.listdir(self.path_dcm_series))
+                dcm = pydicom.dcmread(os.path.join(self.path_dcm_series, img_list[1]))
+            elif os.path.isdir(os.path.join(self.path_dcm, 'TOF_MRA')):
                 img_list = sorted(os.listdir(os.path.join(self.path_dcm, 'TOF_MRA')))
                 dcm = pydicom.dcmread(os.path.join(self.path_dcm, 'TOF_MRA', img_list[1]))
             elif os.path.isdir(os.path.join(self.path_dcm, 'MRA_BRAIN')):
@@ -967,11 +658,11 @@ class AneurysmPipeline:
             pixdim = header_true['pixdim']
             ml_size = (pixdim[1] * pixdim[2] * pixdim[3]) / 1000
 
-        nii = nib.load(os.path.join(self.path_nii, 'Pred.nii.gz'))
+        nii = load_nii(os.path.join(self.path_nii, 'Pred.nii.gz'), self.ctx)
         mask_array = np.array(nii.dataobj)
         mask_array = self.data_translate(mask_array, nii)
 
-        prob_nii = nib.load(os.path.join(self.path_nii, 'Prob.nii.gz'))
+        prob_nii = load_nii(os.path.join(self.path_nii, 'Prob.nii.gz'), self.ctx)
         prob = np.array(prob_nii.dataobj)
         prob = self.data_translate(prob, prob_nii)
 
@@ -1140,11 +831,11 @@ class AneurysmPipeline:
                 # 特殊排除案例
                 continue
 
-            label_nii = nib.load(os.path.join(self.path_nii, 'Pred.nii.gz'))
+            label_nii = load_nii(os.path.join(self.path_nii, 'Pred.nii.gz'), self.ctx)
             label = np.array(label_nii.dataobj)
             label = self.data_translate(label, label_nii).astype('int16')
 
-            labels16_nii = nib.load(os.path.join(self.path_nii, 'Pred_Location16labels.nii.gz'))
+            labels16_nii = load_nii(os.path.join(self.path_nii, 'Pred_Location16labels.nii.gz'), self.ctx)
             labels16 = np.array(labels16_nii.dataobj)
             labels16 = self.data_translate(labels16, labels16_nii).astype('int16')
 
@@ -1437,84 +1128,111 @@ def create_dicomseg_multi_file(path_code, path_img_dcm, path_nii, path_nii_resam
             #dcm_seg.save_as(os.path.join(path_dcmseg, ID + '_' + series + '_' + labels_vessel[1]['SegmentLabel'] + '.dcm')) # 
         
             
-            #以下做動脈瘤，要一顆一顆做，血管一定有標註所以有dicom-seg，動脈瘤沒標註就沒有dicom-seg
-            for i in range(int(np.max(Pred))):
-                new_Pred = np.zeros((Pred.shape))
-                new_Pred[Pred==i+1] = 1
-                
-                labels_ane = {}
-                labels_ane[1] = {'SegmentLabel': 'A' + str(i+1), 'color': 'red'}
-                
-                #底下做成dicom-seg
-                dcm_seg = make_dicomseg(new_Pred.astype('uint8'), path_dcms, dcm_example, model_name, labels_ane)
-                dcm_seg.save_as(os.path.join(path_dcmseg, ID + '_' + series + '_' + labels_ane[1]['SegmentLabel'] + '.dcm')) # 
+            #以下做動脈瘤，每顆一個dicom-seg，血管一定有標註所以有dicom-seg，動脈瘤沒標註就沒有dicom-seg
+            #series只讀一次，所有動脈瘤一次編碼成multi-segment，再從同一份frame切成每顆的dicom-seg
+            Pred = np.round(Pred).astype(int)
+            labels_ane = {i + 1: {'SegmentLabel': 'A' + str(i + 1), 'color': 'red'}
+                          for i in range(int(np.max(Pred))) if np.any(Pred == i + 1)}
+            if len(labels_ane) == 0:
+                continue
+
+            sorted_dcms, image, dcm_one, source_images = load_and_sort_dicom_files(path_dcms)
+            seg_writer = DicomSegWriter(image, dcm_one, source_images, dcm_example=dcm_example)
+            dcm_seg_all = seg_writer.encode(Pred, get_dicom_seg_template(model_name, labels_ane))
+            for segment_number, dcm_seg in seg_writer.split_segments(dcm_seg_all).items():
+                dcm_seg.save_as(os.path.join(path_dcmseg, ID + '_' + series + '_' + labels_ane[segment_number]['SegmentLabel'] + '.dcm')) # 
 
     return print('Dicom-SEG ok!!!')
 
 
-def decompress_dicom_with_gdcm(path_base):
+def _decompress_one_dicom(dcm_file, use_pydicom=True):
+    """
+    解壓縮單一dicom並覆蓋原檔，回傳實際做法: 'skip' / 'pydicom' / 'gdcmconv'，兩種都失敗回傳'error'
+    已經是未壓縮的transfer syntax就直接跳過
+    """
+    import subprocess
+
+    meta = pydicom.filereader.read_file_meta_info(dcm_file)
+    transfer_syntax = meta.get('TransferSyntaxUID', None)
+    if transfer_syntax is not None and not transfer_syntax.is_compressed:
+        return 'skip'
+
+    #有pylibjpeg/gdcm等pixel handler就在process內解碼，先寫暫存檔再rename，中途失敗不會留下壞檔
+    if use_pydicom:
+        path_tmp = dcm_file + '.tmp'
+        try:
+            ds = pydicom.dcmread(dcm_file)
+            ds.decompress()
+            ds.save_as(path_tmp)
+            os.replace(path_tmp, dcm_file)
+            return 'pydicom'
+        except Exception as e:
+            logging.warning(f"pydicom decompress failed, fall back to gdcmconv: {dcm_file}: {e!r}")
+            if os.path.exists(path_tmp):
+                os.remove(path_tmp)
+
+    # 使用系統的 gdcmconv (apt版本)
+    cmd = ['gdcmconv', '--raw', dcm_file, dcm_file]
+    try:
+        subprocess.run(cmd, capture_output=True, text=True, check=True)
+    except subprocess.CalledProcessError as e:
+        print(f"Error processing {dcm_file}: {e}")
+        logging.error(f"gdcmconv failed: {dcm_file}: {e} {e.stderr or ''}")
+        return 'error'
+    except FileNotFoundError:
+        print("Error: gdcmconv not found. Please install with: sudo apt-get install libgdcm-tools")
+        raise
+    return 'gdcmconv'
+
+def decompress_dicom_with_gdcm(path_base, max_workers=None, use_pydicom=True):
     """
-    使用系統的 gdcmconv (apt版本) 解壓縮 DICOM 檔案
-    功能等同於 Decompress_JEPG.sh
+    解壓縮 DICOM 檔案，功能等同於 Decompress_JEPG.sh
+    優先用pydicom的pixel handler(pylibjpeg/gdcm)在process內解碼，不行才呼叫系統的 gdcmconv (apt版本)，
+    已經未壓縮的檔案直接跳過；檔案之間用thread pool平行處理(gdcmconv是子程序，解碼的C函式庫也不太吃GIL)
     
     參數:
         path_base: 包含子資料夾的基礎路徑，會遍歷所有子資料夾並解壓縮其中的 .dcm 檔案
+        max_workers: 平行數量，預設為cpu數量
+        use_pydicom: False時全部走gdcmconv
     """
-    import subprocess
     import glob
+    from concurrent.futures import ThreadPoolExecutor
     
     # 獲取所有子資料夾（排序後倒序）
     folders = sorted([f for f in os.listdir(path_base) 
                      if os.path.isdir(os.path.join(path_base, f))], reverse=True)
     
+    # 找到所有資料夾中的 .dcm 檔案
+    dcm_files = []
     for folder in folders:
         folder_path = os.path.join(path_base, folder)
-        
-        # 找到該資料夾中所有的 .dcm 檔案
-        dcm_files = glob.glob(os.path.join(folder_path, "*.dcm"))
-        
-        # 對每個 .dcm 檔案執行 gdcmconv --raw
-        for dcm_file in dcm_files:
-            # 使用系統的 gdcmconv (apt版本)
-            cmd = ['gdcmconv', '--raw', dcm_file, dcm_file]
-            try:
-                result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            except subprocess.CalledProcessError as e:
-                print(f"Error processing {dcm_file}: {e}")
-                if e.stderr:
-                    print(f"stderr: {e.stderr}")
-            except FileNotFoundError:
-                print("Error: gdcmconv not found. Please install with: sudo apt-get install libgdcm-tools")
-                raise
-
-def compress_dicom_into_jpeglossless(path_dcm_in, path_dcm_out):
+        dcm_files += glob.glob(os.path.join(folder_path, "*.dcm"))
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        methods = list(executor.map(lambda f: _decompress_one_dicom(f, use_pydicom), dcm_files))
+
+    counts = Counter(methods)
+    print(f"decompress: {len(dcm_files)} files, skip {counts['skip']}, pydicom {counts['pydicom']}, gdcmconv {counts['gdcmconv']}, error {counts['error']}")
+    logging.info(f"decompress: {len(dcm_files)} files, skip {counts['skip']}, pydicom {counts['pydicom']}, gdcmconv {counts['gdcmconv']}, error {counts['error']}")
+    if counts['error'] > 0:
+        #還有壓縮中的檔案，後面的MIP/DICOM-SEG會讀錯，讓decompress stage失敗
+        failed = [f for f, m in zip(dcm_files, methods) if m == 'error']
+        raise RuntimeError(f"decompress failed for {counts['error']} dicom files: {failed[:5]}")
+
+def compress_dicom_into_jpeglossless(path_dcm_in, path_dcm_out, max_workers=None):
+    """
+    把dicom壓成JPEG-LS lossless，用subprocess執行dicom_compress.py，process pool開在那個只import pydicom的程序裡，
+    不會在這個已經載入tensorflow/torch的程序裡fork或spawn
+    max_workers: None就用dicom_compress的預設(min(4, cpu數))
+    """
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dicom_compress.py'),
+           path_dcm_in, path_dcm_out]
+    if max_workers is not None:
+        cmd += ['--workers', str(max_workers)]
+    subprocess.run(cmd, check=True)
 
-    Series = ['MRA_BRAIN', 'MIP_Pitch', 'MIP_Yaw']
-  
-    for jdx, series in enumerate(Series):
-        if not os.path.isdir(os.path.join(path_dcm_out, series)):
-            os.mkdir(os.path.join(path_dcm_out, series))
-        
-        #讀取dicom影像，然後轉成jpeglossless
-        dcms = sorted(os.listdir(os.path.join(path_dcm_in, series)))
-        for dcm in dcms:
-            dcm_slice = pydicom.dcmread(os.path.join(path_dcm_in, series, dcm)) #ADC的切片
-            #(0002,0003) Media Stored SOP Instance UID  [1.2.840.113619.2.260.6945.3202356.28278.1273105263.493]
-            SOPUID = dcm_slice[0x08, 0x0018].value #(0008,0018) SOP Instance UID [1.2.840.113619.2.260.6945.3202356.28278.1273105263.493]
-            dcm_slice.compress(JPEGLSLossless)
-            #dcm_slice[0x02, 0x0003].value = SOPUID
-            dcm_slice[0x08, 0x0018].value = SOPUID
-
-            # Need to set this flag to indicate the Pixel Data is compressed
-            #dcm_slice['PixelData'].is_undefined_length = True
-
-            # The Transfer Syntax UID needs to match the type of (JPEG) compression
-            # For example, if you were to compress using JPEG Lossless, Hierarchical, First-Order Prediction (1.2.840.10008.1.2.4.70)
-            #from pydicom.uid import JPEGLosslessSV1 
-            #dcm_slice.file_meta.TransferSyntaxUID = JPEGLosslessSV1
-
-            dcm_slice.save_as(os.path.join(path_dcm_out, series, dcm))
-    
     #最後複製dicom-seg
     shutil.copytree(os.path.join(path_dcm_in, 'Dicom-Seg'), os.path.join(path_dcm_out, 'Dicom-Seg'))
 
@@ -1713,9 +1431,8 @@ def upload_json(path_json):
                 if len(str(json_data['Aneurysm_Number'])) > 0:
                     if json_data['Aneurysm_Number'] > 0:
                         bash_line = 'cd /var/www/shh-pacs && php artisan import:mask ' + os.path.join(path_json, ID + '_' + series + '.json')
-                        uploadJSON_line_line  = os.popen(bash_line)
-                        print('uploadJSON_line_line:', uploadJSON_line_line.read())
-                        time.sleep(2)
+                        uploadJSON_line_line = subprocess.run(bash_line, shell=True, capture_output=True, text=True)
+                        print('uploadJSON_line_line:', uploadJSON_line_line.stdout)
             
             else:
                 #這邊就不用上傳study list了
@@ -1728,15 +1445,13 @@ def upload_json(path_json):
                 if len(str(json_data['Aneurysm_Number'])) > 0:
                     if json_data['Aneurysm_Number'] > 0:
                         bash_line = 'cd /var/www/shh-pacs && php artisan import:mask ' + os.path.join(path_json, ID + '_' + series + '.json')
-                        uploadJSON_line_line  = os.popen(bash_line)
-                        print('uploadJSON_line_line:', uploadJSON_line_line.read())
-                        time.sleep(2)
+                        uploadJSON_line_line = subprocess.run(bash_line, shell=True, capture_output=True, text=True)
+                        print('uploadJSON_line_line:', uploadJSON_line_line.stdout)
         
         #sort可以放到最後上傳mask後做，上傳完study list，接下來 快取某 series 的 imageIds 順序到 DB
         bash_line = 'cd /var/www/shh-pacs && php artisan import:sorted-image-ids ' + os.path.join(path_json, ID + '_sort.json')
-        sortDcm_line  = os.popen(bash_line)
-        print('sortDcm_line:', sortDcm_line.read())
-        time.sleep(2)
+        sortDcm_line = subprocess.run(bash_line, shell=True, capture_output=True, text=True)
+        print('sortDcm_line:', sortDcm_line.stdout)
 
 import warnings
 import httpx
@@ -1746,29 +1461,13 @@ import argparse
 
 warnings.filterwarnings("ignore")  # 忽略 SSL 警告
 
-def upload_json_aiteam(json_file):                               
-    UPLOAD_DATA_JSON_URL = 'http://localhost:84/api/ai_team/create_or_update'
-    client = httpx.Client(timeout=10.0, verify=False)  # 加入 timeout/不驗證 SSL
-
-    def post_json(path):
-        with open(path, 'rb') as f:
-            data = orjson.loads(f.read())
-        response = client.post(UPLOAD_DATA_JSON_URL, json=data)
-        print(f"\n📤 Uploaded: {os.path.basename(path)}")
-        print(f"✅ Status: {response.status_code}")
-        try:
-            print("📥 Response:", response.json())
-        except Exception:
-            print("📥 Response (raw):", response.text)
-
-    with client:
-        if isinstance(json_file, str):
-            post_json(json_file)
-        elif isinstance(json_file, list):
-            for path in json_file:
-                post_json(path)
-        else:
-            print("❌ Invalid input: must be a str or list of str")
+def upload_json_aiteam(json_file, max_concurrency=4, retries=3, outbox=None):
+    #多個json用AsyncClient同時送，暫時性的失敗重試，重試完還是失敗的放進outbox(有給的話)等cron執行json_delivery.py補送
+    if not isinstance(json_file, (str, list)):
+        print("❌ Invalid input: must be a str or list of str")
+        return []
+    return deliver_json(json_file, UPLOAD_DATA_JSON_URL, max_concurrency=max_concurrency, retries=retries,
+                        outbox=outbox)
 
 
 #建立字典找出日期的配對
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+有型態的volume讀取: 強度影像用float32，標註(Pred、Vessel、Vessel_16...)用uint8/int16
+
+nib的get_fdata()預設會產生float64的複本，而且快取在image物件裡(caching='fill')，
+標註也被轉成float64甚至.astype(int)變int64，一個case同時有好幾份8 bytes/voxel的陣列。
+這邊統一:
+    read_image : scl_slope/inter換算後直接是float32，caching='unchanged'不在image物件裡留快取
+    read_label : 不經過float，沿用檔案的整數型態；檔案是float的話四捨五入後依數值範圍用uint8或int16(也可以指定dtype)
+slicer有給的話用dataobj[slicer]只解碼需要的部分；記憶體中的影像(CaseContext快取)回傳複本，改陣列不會影響快取。
+
+@author: chuan
+"""
+import numpy as np
+import nibabel as nib
+
+from case_context import load_nii
+
+
+def label_dtype(data):
+    #放得下的最小整數型態
+    if data.size == 0:
+        return np.uint8
+    lo, hi = data.min(), data.max()
+    if lo >= 0 and hi <= np.iinfo(np.uint8).max:
+        return np.uint8
+    if lo >= np.iinfo(np.int16).min and hi <= np.iinfo(np.int16).max:
+        return np.int16
+    return np.int32
+
+
+def _read(img, slicer, dtype):
+    dataobj = img.dataobj
+    if nib.is_proxy(dataobj):
+        if slicer is not None:
+            return np.asarray(dataobj[slicer], dtype=dtype)
+        if dtype is not None and np.issubdtype(dtype, np.floating):
+            return img.get_fdata(dtype=dtype, caching='unchanged')
+        return np.asarray(dataobj)
+    data = dataobj[slicer] if slicer is not None else dataobj
+    return np.array(data, dtype=dtype)
+
+
+def read_image(img, dtype=np.float32, slicer=None):
+    return _read(img, slicer, dtype)
+
+
+def read_label(img, dtype=None, slicer=None):
+    data = _read(img, slicer, None)
+    if np.issubdtype(data.dtype, np.floating):
+        data = np.rint(data)
+    if dtype is None:
+        # 檔案本來就是整數就沿用(存檔時不用再轉換)，float存的標註才依數值範圍挑
+        disk_dtype = img.get_data_dtype()
+        dtype = disk_dtype if np.issubdtype(disk_dtype, np.integer) else label_dtype(data)
+    return data.astype(dtype, copy=False)
+
+
+def load_image(path, ctx=None, dtype=np.float32, slicer=None):
+    #回傳(陣列, nii)，nii給affine/header用
+    img = load_nii(path, ctx)
+    return read_image(img, dtype, slicer), img
+
+
+def load_label(path, ctx=None, dtype=None, slicer=None):
+    img = load_nii(path, ctx)
+    return read_label(img, dtype, slicer), img